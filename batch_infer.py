@@ -1,7 +1,10 @@
+import bisect
 import importlib
+import json
 import pathlib
+import sys
 from csv import DictReader, DictWriter
-from typing import List
+from typing import Dict, List, Tuple
 
 import click
 import librosa
@@ -10,19 +13,31 @@ import yaml
 
 import inference
 from utils.config_utils import print_config
+from utils.multiprocess_utils import chunked_multiprocess_run
 from utils.slicer2 import Slicer
 
 task_inference_mapping = {
     'training.MIDIExtractionTask': 'inference.MIDIExtractionInference',
     'training.QuantizedMIDIExtractionTask': 'inference.QuantizedMIDIExtractionInference',
+    'training.DistillationMIDIExtractionTask': 'inference.MIDIExtractionInference',
 }
 
 
-def model_init(model_path):
+def model_init(
+        model_path, backend='torch', threads=0, inter_threads=0, cache_dir=None, precision='fp32', graph_mode='eager'
+):
     model_path = pathlib.Path(model_path)
     with open(model_path.with_name('config.yaml'), 'r', encoding='utf8') as f:
         config = yaml.safe_load(f)
+    if cache_dir is not None:
+        config['feature_cache_dir'] = cache_dir
     print_config(config)
+    if backend == 'onnx':
+        model = inference.ONNXInference(
+            config=config, model_path=model_path.with_suffix('.onnx'),
+            intra_op_threads=threads, inter_op_threads=inter_threads
+        )
+        return model, config
     infer_cls = task_inference_mapping[config['task_cls']]
 
     pkg = ".".join(infer_cls.split(".")[:-1])
@@ -30,7 +45,9 @@ def model_init(model_path):
     infer_cls = getattr(importlib.import_module(pkg), cls_name)
     assert issubclass(infer_cls, inference.BaseInference), \
         f'Binarizer class {infer_cls} is not a subclass of {inference.BaseInference}.'
-    model = infer_cls(config=config, model_path=model_path)
+    model = infer_cls(
+        config=config, model_path=model_path, precision=precision, graph_mode=graph_mode, warmup=True
+    )
     return model, config
 
 
@@ -46,13 +63,20 @@ def calc_seq(note_midi, note_rest):
     return seq if not note_rest else 'rest'
 
 
-def infer(wav, infer_ins, config):
+def load_chunks(wav, sample_rate):
     wav_path = pathlib.Path(wav)
-    waveform, _ = librosa.load(wav_path, sr=config['audio_sample_rate'], mono=True)
-    slicer = Slicer(sr=config['audio_sample_rate'], max_sil_kept=1000)
-    chunks = slicer.slice(waveform)
-    midis = infer_ins.infer([c['waveform'] for c in chunks])
+    waveform, _ = librosa.load(wav_path, sr=sample_rate, mono=True)
+    slicer = Slicer(sr=sample_rate, max_sil_kept=1000)
+    return slicer.slice(waveform)
 
+
+def load_row_chunks(row_idx, wav, sample_rate):
+    # Only decoding and slicing run in the workers; the mel spectrograms and the f0 are extracted by the
+    # model process, where RMVPE runs batched over the chunks of a whole group.
+    return row_idx, load_chunks(wav, sample_rate)
+
+
+def chunks_to_notes(chunks, midis):
     res: list = []
     for offset, segment in zip([c['offset'] for c in chunks], midis):
         offset = round(offset, 6)
@@ -81,6 +105,12 @@ def infer(wav, infer_ins, config):
     return res
 
 
+def infer(wav, infer_ins, config, max_batch_frames=0):
+    chunks = load_chunks(wav, config['audio_sample_rate'])
+    midis = infer_ins.infer([c['waveform'] for c in chunks], max_batch_frames=max_batch_frames)
+    return chunks_to_notes(chunks, midis)
+
+
 def get_word_durs(ph_durs, ph_nums):
     res = []
     cur = 0
@@ -95,6 +125,37 @@ def get_word_durs(ph_durs, ph_nums):
 
 
 def midi_align(midi_res, midi_durs, tolerance=0.05):
+    """
+    Snap note boundaries to word boundaries within the tolerance.
+    Equivalent to checking every boundary for every note, but only visits the boundaries within the
+    tolerance of each note, which are found by binary search over the (sorted) word boundaries.
+    """
+    res = []
+    bound = [x[0] for x in midi_durs] + [midi_durs[-1][1]]
+    if any(bound[i] > bound[i + 1] for i in range(len(bound) - 1)):
+        return _midi_align_naive(midi_res, midi_durs, tolerance=tolerance)
+    upper = [b + tolerance for b in bound]
+
+    def snap(t):
+        # Boundaries are visited in the same order as the naive scan; a matched boundary replaces t,
+        # and the following ones are compared against the replaced value.
+        for i in range(bisect.bisect_left(upper, t), len(bound)):
+            if t < bound[i] - tolerance:
+                break
+            if bound[i] - tolerance <= t <= bound[i] + tolerance:
+                t = bound[i]
+        return t
+
+    for mid in midi_res:
+        mid['start_time'] = snap(mid['start_time'])
+        mid['end_time'] = snap(mid['end_time'])
+        mid['note_dur'] = round(mid['end_time'] - mid['start_time'], 6)
+        if mid['note_dur'] > 0:
+            res.append(mid)
+    return res
+
+
+def _midi_align_naive(midi_res, midi_durs, tolerance=0.05):
     res = []
     bound = [x[0] for x in midi_durs] + [midi_durs[-1][1]]
 
@@ -110,6 +171,56 @@ def midi_align(midi_res, midi_durs, tolerance=0.05):
     return res
 
 
+class NoteIndex:
+    """
+    Sorted index over note segments for overlap queries.
+    Notes are sorted by start time, together with the running maximum of their end times, so that
+    the notes that may overlap an interval form a contiguous range found by two binary searches.
+    Query results are identical to get_all_overlap_midis() and get_max_overlap_midi(), including
+    the order of the returned notes and the tie-breaking between equal overlaps.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.order = sorted(range(len(segments)), key=lambda i: segments[i]['start_time'])
+        self.starts = [segments[i]['start_time'] for i in self.order]
+        self.max_ends = []
+        max_end = float('-inf')
+        for i in self.order:
+            max_end = max(max_end, segments[i]['end_time'])
+            self.max_ends.append(max_end)
+
+    def candidates(self, interval):
+        # Overlapping notes satisfy start <= interval[1] and end >= interval[0].
+        lo = bisect.bisect_left(self.max_ends, interval[0])
+        hi = bisect.bisect_right(self.starts, interval[1])
+        return sorted(self.order[lo:hi])
+
+    def all_overlaps(self, interval):
+        res = []
+        for i in self.candidates(interval):
+            segment = self.segments[i]
+            if interval[0] < segment['start_time'] < interval[1]:
+                res.append(segment)
+            elif interval[0] < segment['end_time'] < interval[1]:
+                res.append(segment)
+            elif segment['start_time'] <= interval[0] and interval[1] <= segment['end_time']:
+                res.append(segment)
+        return res
+
+    def max_overlap(self, interval):
+        matching_segment = 'rest'
+        max_overlap = 0
+
+        for i in self.candidates(interval):
+            segment = self.segments[i]
+            overlap = max(0, min(interval[1], segment['end_time']) - max(interval[0], segment['start_time']))
+            if overlap > max_overlap:
+                max_overlap = overlap
+                matching_segment = segment['note_seq']
+        return matching_segment
+
+
 def get_all_overlap_midis(interval, segments):
     res = []
     for segment in segments:
@@ -134,6 +245,82 @@ def get_max_overlap_midi(interval, segments):
     return matching_segment
 
 
+def align_row(row, result, round_midi):
+    ph_dur = [round(float(x), 6) for x in row['ph_dur'].split(" ")]
+    ph_num = [int(x) for x in row['ph_num'].split(" ")]
+    note_seq = []
+    note_dur = []
+
+    midi_dur_list = get_word_durs(ph_dur, ph_num)
+    result = midi_align(result, midi_dur_list)
+    index = NoteIndex(result)
+
+    for (start_time, end_time) in midi_dur_list:
+        word_duration = round(end_time - start_time, 6)
+        if round_midi:
+            match_seq = index.max_overlap((start_time, end_time))
+            note_seq.append(match_seq)
+            note_dur.append(word_duration)
+        else:
+            temp_seq = []
+            temp_dur = []
+            match_midi = index.all_overlaps((start_time, end_time))
+
+            for midi in match_midi:
+                if midi['start_time'] <= start_time:
+                    temp_seq.append(midi['note_seq'])
+                    midi_dur = round(min(end_time, midi['end_time']) - start_time, 6)
+                elif midi['end_time'] >= end_time:
+                    temp_seq.append(midi['note_seq'])
+                    midi_dur = round(end_time - max(start_time, midi['start_time']), 6)
+                elif midi['start_time'] <= start_time and midi['end_time'] >= end_time:
+                    temp_seq.append(midi['note_seq'])
+                    midi_dur = word_duration
+                else:
+                    temp_seq.append(midi['note_seq'])
+                    midi_dur = round(midi['note_dur'], 6)
+                temp_dur.append(midi_dur)
+
+            if not match_midi:
+                temp_seq.append('rest')
+                temp_dur.append(word_duration)
+
+            if round(sum(temp_dur), 6) < word_duration:
+                temp_seq.append('rest')
+                temp_dur.append(word_duration - round(sum(temp_dur), 6))
+
+            note_seq.extend(temp_seq)
+            note_dur.extend(temp_dur)
+
+    assert len(note_seq) == len(note_dur)
+    return " ".join([str(x) for x in note_seq]), " ".join([str(round(x, 6)) for x in note_dur])
+
+
+def read_journal(journal_path: pathlib.Path, header: dict) -> Dict[str, Tuple[str, str]]:
+    """
+    Read the finished rows from the append-only journal of a previous run.
+    The first line of the journal records the settings it was produced with.
+    """
+    done = {}
+    if not journal_path.exists():
+        return done
+    with open(journal_path, 'r', encoding='utf8') as f:
+        lines = f.readlines()
+    if len(lines) > 0 and json.loads(lines[0]) != header:
+        raise RuntimeError(
+            f'The journal \'{journal_path}\' was produced with different settings: {lines[0].strip()}. '
+            f'Please remove it to start over.'
+        )
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            # The last line may be incomplete if the previous run was killed while writing it.
+            continue
+        done[entry['name']] = (entry['note_seq'], entry['note_dur'])
+    return done
+
+
 @click.command(help='Batch inference on existing DiffSinger dataset.')
 @click.option(
     '--dataset', required=True, metavar='RAW_DATA_DIR',
@@ -146,13 +333,49 @@ def get_max_overlap_midi(interval, segments):
     help='Path to the output transcriptions.csv file (default to the same file in the dataset)'
 )
 @click.option('--overwrite', is_flag=True, help='Overwrite the existing transcriptions.csv file')
-def batch_infer(dataset, model, round_midi, csv, overwrite):
+@click.option(
+    '--max_batch_frames', type=int, default=0, metavar='FRAMES',
+    help='Maximum number of frames in each inference batch (default to 0, which disables batching)'
+)
+@click.option(
+    '--num_workers', type=int, default=0, metavar='WORKERS',
+    help='Number of worker processes for audio loading and slicing (default to 0, which loads in the main process)'
+)
+@click.option(
+    '--group_size', type=int, default=16, metavar='FILES',
+    help='Number of files whose chunks are batched together for the model'
+)
+@click.option(
+    '--backend', type=click.Choice(['torch', 'onnx']), default='torch',
+    help='Inference backend; onnx runs the model exported by export.py (*.onnx next to the checkpoint) with ONNX Runtime'
+)
+@click.option(
+    '--precision', type=click.Choice(['fp32', 'bf16', 'int8']), default='fp32',
+    help='Precision of the model (torch backend only); int8 quantizes the linear layers dynamically (CPU only)'
+)
+@click.option(
+    '--graph', type=click.Choice(['eager', 'script', 'compile']), default='eager',
+    help='Execution of the model (torch backend only); script or compile runs one compiled graph per padded batch shape'
+)
+@click.option('--threads', type=int, default=0, metavar='THREADS', help='Number of intra-op threads of the onnx backend')
+@click.option('--inter_threads', type=int, default=0, metavar='THREADS', help='Number of inter-op threads of the onnx backend')
+@click.option(
+    '--cache_dir', type=str, required=False, metavar='CACHE_DIR',
+    help='Directory of the on-disk cache of mel spectrograms and f0 (torch backend only)'
+)
+def batch_infer(
+        dataset, model, round_midi, csv, overwrite, max_batch_frames, num_workers, group_size,
+        backend, precision, graph, threads, inter_threads, cache_dir
+):
     data_path = pathlib.Path(dataset)
     model_path = pathlib.Path(model)
     csv_path = pathlib.Path(csv) if csv is not None else data_path / 'transcriptions.csv'
     if csv_path.exists() and not overwrite:
         raise FileExistsError(f'The CSV path \'{csv_path}\' already exists. Please re-try with --overwrite option.')
-    infer_ins, config = model_init(model_path)
+    infer_ins, config = model_init(
+        model_path, backend=backend, threads=threads, inter_threads=inter_threads, cache_dir=cache_dir,
+        precision=precision, graph_mode=graph
+    )
 
     # count = 0
     csv_data: List[dict] = []
@@ -161,69 +384,90 @@ def batch_infer(dataset, model, round_midi, csv, overwrite):
         for row in reader:
             csv_data.append(row)
 
-    for row in tqdm.tqdm(csv_data):
+    # Finished rows are appended to the journal, so that an interrupted run can be resumed.
+    journal_path = csv_path.with_name(f'{csv_path.name}.journal')
+    journal_header = {
+        'model': model_path.resolve().as_posix(), 'backend': backend, 'precision': precision, 'round_midi': round_midi
+    }
+    done = read_journal(journal_path, journal_header)
+    if len(done) > 0:
+        print(f'| resume from \'{journal_path}\': {len(done)} rows already finished.')
+
+    args = []
+    for row_idx, row in enumerate(csv_data):
+        if row['name'] in done:
+            continue
         audio_path = data_path / 'wavs' / f"{row['name']}.wav"
         if not audio_path.exists():
             print(f'WARNING: audio file does not exist: \'{audio_path}\'')
             continue
-        # print(f"\r\n{audio_path}: start")
-        result = infer(audio_path, infer_ins, config)
-
-        ph_dur = [round(float(x), 6) for x in row['ph_dur'].split(" ")]
-        ph_num = [int(x) for x in row['ph_num'].split(" ")]
-        note_seq = []
-        note_dur = []
-
-        midi_dur_list = get_word_durs(ph_dur, ph_num)
-        result = midi_align(result, midi_dur_list)
-
-        for (start_time, end_time) in midi_dur_list:
-            word_duration = round(end_time - start_time, 6)
-            if round_midi:
-                match_seq = get_max_overlap_midi((start_time, end_time), result)
-                note_seq.append(match_seq)
-                note_dur.append(word_duration)
-            else:
-                temp_seq = []
-                temp_dur = []
-                match_midi = get_all_overlap_midis((start_time, end_time), result)
-
-                for midi in match_midi:
-                    if midi['start_time'] <= start_time:
-                        temp_seq.append(midi['note_seq'])
-                        midi_dur = round(min(end_time, midi['end_time']) - start_time, 6)
-                    elif midi['end_time'] >= end_time:
-                        temp_seq.append(midi['note_seq'])
-                        midi_dur = round(end_time - max(start_time, midi['start_time']), 6)
-                    elif midi['start_time'] <= start_time and midi['end_time'] >= end_time:
-                        temp_seq.append(midi['note_seq'])
-                        midi_dur = word_duration
-                    else:
-                        temp_seq.append(midi['note_seq'])
-                        midi_dur = round(midi['note_dur'], 6)
-                    temp_dur.append(midi_dur)
-
-                if not match_midi:
-                    temp_seq.append('rest')
-                    temp_dur.append(word_duration)
-
-                if round(sum(temp_dur), 6) < word_duration:
-                    temp_seq.append('rest')
-                    temp_dur.append(word_duration - round(sum(temp_dur), 6))
-
-                note_seq.extend(temp_seq)
-                note_dur.extend(temp_dur)
-
-        assert len(note_seq) == len(note_dur)
-        row['note_seq'] = " ".join([str(x) for x in note_seq])
-        row['note_dur'] = " ".join([str(round(x, 6)) for x in note_dur])
-        # print(f" {audio_path}:\r\nnote_seq: {note_seq}\r\nnote_dur: {note_dur}")
-        # count += 1
-
-    with open(csv_path, 'w', encoding='utf8', newline='') as f:
-        writer = DictWriter(f, fieldnames=['name', 'ph_seq', 'ph_dur', 'ph_num', 'note_seq', 'note_dur'])
+        args.append((row_idx, audio_path, config['audio_sample_rate']))
+    if num_workers > 0:
+        loader = chunked_multiprocess_run(load_row_chunks, args, num_workers=num_workers)
+    else:
+        loader = (load_row_chunks(*a) for a in args)
+
+    # Rows are written to the CSV as their groups finish. Files are loaded in the order of the rows, so all rows
+    # before the last row of a finished group are final. The rows go to a partial file first, which replaces the
+    # CSV at the end, because the CSV may also be the input of an interrupted run.
+    partial_path = csv_path.with_name(f'{csv_path.name}.partial')
+    with open(journal_path, 'a', encoding='utf8') as journal, \
+            open(partial_path, 'w', encoding='utf8', newline='') as partial:
+        if journal.tell() == 0:
+            journal.write(json.dumps(journal_header) + '\n')
+        writer = DictWriter(partial, fieldnames=['name', 'ph_seq', 'ph_dur', 'ph_num', 'note_seq', 'note_dur'])
         writer.writeheader()
-        writer.writerows(csv_data)
+        num_written = 0
+
+        def write_rows(end):
+            nonlocal num_written
+            for row in csv_data[num_written:end]:
+                if row['name'] in done:
+                    row['note_seq'], row['note_dur'] = done[row['name']]
+                writer.writerow(row)
+            partial.flush()
+            num_written = end
+
+        def process_group(group):
+            # Chunks from all files in the group share the same inference batches.
+            midis = infer_ins.infer(
+                [c['waveform'] for _, chunks in group for c in chunks], max_batch_frames=max_batch_frames
+            )
+            for row_idx, chunks in group:
+                row = csv_data[row_idx]
+                result = chunks_to_notes(chunks, midis[:len(chunks)])
+                midis = midis[len(chunks):]
+                done[row['name']] = align_row(row, result, round_midi)
+                journal.write(json.dumps({
+                    'name': row['name'], 'note_seq': done[row['name']][0], 'note_dur': done[row['name']][1]
+                }) + '\n')
+            journal.flush()
+            write_rows(group[-1][0] + 1)
+
+        pending = []
+        num_failed = 0
+        for item in tqdm.tqdm(loader, total=len(args)):
+            if item is None:
+                num_failed += 1
+                print('WARNING: failed to load an audio file; it will be retried in the next run.')
+                continue
+            pending.append(item)
+            if len(pending) >= group_size:
+                process_group(pending)
+                pending = []
+        if len(pending) > 0:
+            process_group(pending)
+        write_rows(len(csv_data))
+    partial_path.replace(csv_path)
+    if num_failed > 0:
+        # Keep the journal, so that re-running with --overwrite only processes the failed files.
+        print(f'WARNING: {num_failed} audio files failed; their rows are left unchanged. '
+              f'Re-run with --overwrite to retry them; finished rows are read from \'{journal_path}\'.')
+    else:
+        journal_path.unlink()
+    if backend == 'onnx' and 'torch' in sys.modules:
+        # The ONNX Runtime backend, including the loading workers, runs without PyTorch.
+        print('WARNING: PyTorch was imported by the ONNX Runtime backend.')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+import copy
+import time
+
+import click
+import numpy as np
+
+import batch_infer
+
+
+class NaiveNoteIndex:
+    """
+    Reference index that scans all notes for every query.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+
+    def all_overlaps(self, interval):
+        return batch_infer.get_all_overlap_midis(interval, self.segments)
+
+    def max_overlap(self, interval):
+        return batch_infer.get_max_overlap_midi(interval, self.segments)
+
+
+def synth_utterance(rng: np.random.Generator, n_words: int):
+    """
+    Generate a transcription row and detected notes that roughly follow the word boundaries.
+    """
+    ph_num = rng.integers(1, 4, size=n_words)
+    ph_dur = np.round(rng.uniform(0.03, 0.25, size=ph_num.sum()), 6)
+    row = {
+        'ph_dur': ' '.join(str(x) for x in ph_dur),
+        'ph_num': ' '.join(str(x) for x in ph_num),
+    }
+    total = float(ph_dur.sum())
+    # Notes are jittered around the phoneme boundaries, so that some of them snap to word boundaries.
+    bounds = np.sort(np.clip(np.cumsum(ph_dur) + rng.normal(0., 0.04, size=ph_dur.shape[0]), 0., total))
+    notes = []
+    last = 0.
+    for b in bounds:
+        if b - last < 1e-3:
+            continue
+        notes.append({
+            'start_time': round(last, 6),
+            'end_time': round(float(b), 6),
+            'note_seq': 'rest' if rng.random() < 0.1 else f'C{rng.integers(2, 6)}',
+            'note_dur': round(float(b) - last, 6),
+        })
+        last = round(float(b), 6)
+    return row, notes
+
+
+def run(rows, round_midi, naive):
+    midi_align, note_index = batch_infer.midi_align, batch_infer.NoteIndex
+    if naive:
+        batch_infer.midi_align, batch_infer.NoteIndex = batch_infer._midi_align_naive, NaiveNoteIndex
+    try:
+        start_time = time.time()
+        results = [batch_infer.align_row(row, notes, round_midi) for row, notes in rows]
+        return results, time.time() - start_time
+    finally:
+        batch_infer.midi_align, batch_infer.NoteIndex = midi_align, note_index
+
+
+@click.command(help='Benchmark note alignment of batch_infer on synthetic long utterances')
+@click.option('--words', type=int, default=2000, metavar='WORDS', help='Number of words in each utterance')
+@click.option('--utterances', type=int, default=10, metavar='UTTERANCES', help='Number of utterances')
+@click.option('--seed', type=int, default=0, metavar='SEED', help='Random seed')
+def bench_align(words, utterances, seed):
+    rng = np.random.default_rng(seed)
+    rows = [synth_utterance(rng, words) for _ in range(utterances)]
+    print(f'| {utterances} utterances, {words} words, {sum(len(n) for _, n in rows) / utterances:.0f} notes on average')
+    for round_midi in [False, True]:
+        res_naive, t_naive = run(copy.deepcopy(rows), round_midi, naive=True)
+        res_fast, t_fast = run(copy.deepcopy(rows), round_midi, naive=False)
+        assert res_naive == res_fast, 'Alignment results differ from the naive implementation.'
+        print(
+            f'| round_midi={round_midi}: naive {t_naive * 1000:.1f} ms, indexed {t_fast * 1000:.1f} ms, '
+            f'speedup {t_naive / t_fast:.1f}x (outputs identical)'
+        )
+
+
+if __name__ == '__main__':
+    bench_align()
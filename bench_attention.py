@@ -0,0 +1,87 @@
+import pathlib
+import time
+
+import click
+import torch
+import yaml
+
+from inference.benchmark import build_inference, load_songs, songs_accuracy
+from modules.attention.base_attention import set_attention_window
+
+
+def attention_memory(config: dict, n_frames: int, window: int, overlap: int) -> int:
+    """
+    Bytes of the attention scores of one Attention module over a slice of n_frames (fp32).
+    """
+    heads = config['midi_extractor_args']['attention_heads']
+    if 0 < window < n_frames:
+        n_keys = window + 2 * overlap
+        n_frames = (n_frames + window - 1) // window * window
+    else:
+        n_keys = n_frames
+    return heads * n_frames * n_keys * 4
+
+
+@click.command(help='Compare the notes, latency and memory of windowed attention with full attention')
+@click.option('--model', required=True, metavar='CKPT_PATH', help='Path to the model checkpoint (*.ckpt)')
+@click.option('--wav', required=True, multiple=True, metavar='WAV_PATH', help='Input wav files')
+@click.option(
+    '--window', 'windows', multiple=True, type=int, default=[256, 512, 1024], metavar='FRAMES',
+    help='Block sizes of windowed attention to compare'
+)
+@click.option('--overlap', type=int, default=64, metavar='FRAMES', help='Frames on each side of a block')
+@click.option(
+    '--no-slice', is_flag=True,
+    help='Run each song as one slice, as for a long phrase that the slicer cannot split'
+)
+@click.option('--tolerance', type=float, default=0.5, metavar='SEMITONES', help='Pitch tolerance of the frame agreement')
+@click.option(
+    '--min-accuracy', type=float, default=0., metavar='ACCURACY',
+    help='Fail if the frame accuracy of a window against full attention is below this value'
+)
+def bench_attention(model, wav, windows, overlap, no_slice, tolerance, min_accuracy):
+    model_path = pathlib.Path(model)
+    with open(model_path.with_name('config.yaml'), 'r', encoding='utf8') as f:
+        config = yaml.safe_load(f)
+    config['infer_attention_window'] = 0
+    infer_ins = build_inference(model_path, config, 'fp32')
+    timestep = infer_ins.timestep
+
+    songs = load_songs(infer_ins, wav, config, slicing=not no_slice)
+    longest = max(infer_ins.num_frames(c) for s in songs for c in s[0])
+    print(f'| {len(songs)} songs, longest slice {longest} frames')
+
+    def run(window):
+        set_attention_window(infer_ins.model, window, overlap)
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        start_time = time.time()
+        results = [infer_ins.infer(chunks, offsets=offsets, f0=f0) for chunks, offsets, f0, _ in songs]
+        elapsed = time.time() - start_time
+        peak = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None
+        return results, elapsed, peak
+
+    def memory_info(window, peak):
+        info = f'attention scores {attention_memory(config, longest, window, overlap) / 2 ** 20:.1f} MB per module'
+        if peak is not None:
+            info += f', CUDA peak {peak / 2 ** 20:.1f} MB'
+        return info
+
+    ref_results, ref_time, ref_peak = run(0)
+    print(f'| full: {ref_time:.2f} s, {memory_info(0, ref_peak)}')
+    failed = []
+    for window in windows:
+        results, elapsed, peak = run(window)
+        accuracy = songs_accuracy(songs, results, ref_results, timestep, tolerance=tolerance)
+        print(
+            f'| window {window}: {elapsed:.2f} s, {memory_info(window, peak)}; '
+            f'frame accuracy against full attention {accuracy:.4f}'
+        )
+        if accuracy < min_accuracy:
+            failed.append(str(window))
+    if len(failed) > 0:
+        raise click.ClickException(f'Accuracy below {min_accuracy}: windows {", ".join(failed)}')
+
+
+if __name__ == '__main__':
+    bench_attention()
@@ -0,0 +1,83 @@
+import time
+
+import click
+import numpy as np
+
+import compressor as compressor_module
+from compressor import Compressor, vocal_compressor
+
+
+def vocal_compressor_reference(y, sr, threshold=-20.0, ratio=4.0, attack=0.005, release=0.05, makeup_gain=0.0):
+    """
+    The original per-sample implementation, kept as the reference.
+    """
+    y_abs = np.abs(y)
+    y_db = 20 * np.log10(y_abs + 1e-10)
+    gain_reduction = np.zeros_like(y_db)
+    env = np.zeros_like(y_db)
+    attack_coef = np.exp(-1.0 / (attack * sr))
+    release_coef = np.exp(-1.0 / (release * sr))
+    for i in range(1, len(y)):
+        env[i] = max(y_db[i], release_coef * env[i - 1] + (1 - attack_coef) * y_db[i])
+        if env[i] > threshold:
+            excess = env[i] - threshold
+            gain_reduction[i] = excess * (1 - 1 / ratio)
+    gain = np.power(10, -gain_reduction / 20.0)
+    gain = gain * np.power(10, makeup_gain / 20.0)
+    y_compressed = y * gain
+    max_val = np.max(np.abs(y_compressed))
+    if max_val > 1.0:
+        y_compressed = y_compressed / max_val
+    return y_compressed
+
+
+def synth_vocal(rng: np.random.Generator, sr: int, seconds: float) -> np.ndarray:
+    """
+    A harmonic tone with syllable-like amplitude bursts and pauses.
+    """
+    t = np.arange(int(sr * seconds)) / sr
+    f0 = 220 * 2 ** (np.cumsum(rng.normal(0, 0.002, size=t.shape[0])) / 12)
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    tone = sum(np.sin(k * phase) / k for k in range(1, 6))
+    envelope = np.repeat(rng.uniform(0, 1, size=int(seconds * 4) + 1) ** 2, sr // 4)[:t.shape[0]]
+    return (0.3 * tone * envelope + rng.normal(0, 1e-3, size=t.shape[0])).astype(np.float32)
+
+
+@click.command(help='Benchmark the vectorized compressor against the per-sample reference')
+@click.option('--seconds', type=float, default=30., metavar='SECONDS', help='Length of the test signal')
+@click.option('--sr', type=int, default=44100, metavar='SR', help='Sampling rate')
+@click.option('--chunk', type=float, default=0.1, metavar='SECONDS', help='Chunk length of the streaming test')
+@click.option('--seed', type=int, default=0, metavar='SEED', help='Random seed')
+def bench_compressor(seconds, sr, chunk, seed):
+    rng = np.random.default_rng(seed)
+    y = synth_vocal(rng, sr, seconds)
+    kwargs = dict(threshold=-28.0, ratio=2.0, attack=0.015, release=0.15, makeup_gain=4.0)
+
+    start_time = time.time()
+    y_ref = vocal_compressor_reference(y, sr, **kwargs)
+    t_ref = time.time() - start_time
+    print(f'| {seconds:.0f} s at {sr} Hz: reference {t_ref:.2f} s')
+    numba = compressor_module.numba
+    engines = [('numba', numba), ('scan', None)] if numba is not None else [('scan', None)]
+    for name, engine in engines:
+        compressor_module.numba = engine
+        vocal_compressor(y[:sr], sr, **kwargs)  # warm up
+        start_time = time.time()
+        y_vec = vocal_compressor(y, sr, **kwargs)
+        t_vec = time.time() - start_time
+        print(
+            f'| {name}: {t_vec:.3f} s ({t_ref / t_vec:.0f}x), '
+            f'max abs difference from reference: {np.abs(y_ref - y_vec).max():.2e}'
+        )
+    compressor_module.numba = numba
+
+    compressor = Compressor(sr, **kwargs)
+    chunk_size = int(chunk * sr)
+    y_stream = np.concatenate([compressor.process(y[i: i + chunk_size]) for i in range(0, y.shape[0], chunk_size)])
+    y_offline = Compressor(sr, **kwargs).process(y)
+    print(f'| streaming ({chunk * 1000:.0f} ms chunks) vs offline max abs difference: '
+          f'{np.abs(y_stream - y_offline).max():.2e}')
+
+
+if __name__ == '__main__':
+    bench_compressor()
@@ -0,0 +1,64 @@
+import pathlib
+
+import click
+import yaml
+
+from inference.benchmark import build_inference, load_songs, run_songs, songs_accuracy
+
+
+def load_model(model: str, precision: str):
+    model_path = pathlib.Path(model)
+    with open(model_path.with_name('config.yaml'), 'r', encoding='utf8') as f:
+        config = yaml.safe_load(f)
+    return build_inference(model_path, config, precision), config
+
+
+@click.command(help='Report the speed and the accuracy of distilled students against their teacher')
+@click.option('--teacher', required=True, metavar='CKPT_PATH', help='Path to the teacher checkpoint (*.ckpt)')
+@click.option(
+    '--student', 'students', required=True, multiple=True, metavar='CKPT_PATH',
+    help='Paths to the student checkpoints (*.ckpt)'
+)
+@click.option('--wav', required=True, multiple=True, metavar='WAV_PATH', help='Input wav files')
+@click.option(
+    '--precision', type=click.Choice(['fp32', 'bf16', 'int8']), default='fp32',
+    help='Precision of all models'
+)
+@click.option('--batch-frames', type=int, default=0, metavar='BATCH_FRAMES', help='Maximum number of frames in each batch')
+@click.option('--repeats', type=int, default=3, metavar='REPEATS', help='Number of timed runs over all songs')
+@click.option('--tolerance', type=float, default=0.5, metavar='SEMITONES', help='Pitch tolerance of the frame agreement')
+def bench_distill(teacher, students, wav, precision, batch_frames, repeats, tolerance):
+    teacher_ins, config = load_model(teacher, precision)
+    timestep = teacher_ins.timestep
+
+    # The pitch is extracted once and shared by all models.
+    songs = load_songs(teacher_ins, wav, config)
+    duration = sum(s[3] for s in songs) * timestep
+    print(f'| {len(songs)} songs, {duration:.1f} s of audio, {repeats} runs, {precision}')
+
+    def num_params(infer_ins):
+        return sum(p.numel() for p in infer_ins.model.parameters()) / 1e6
+
+    run_songs(teacher_ins, songs[:1], batch_frames, 1)  # warm up
+    ref_results, ref_time = run_songs(teacher_ins, songs, batch_frames, repeats)
+    print(
+        f'| teacher: {num_params(teacher_ins):.1f}M params, {ref_time * 1000:.0f} ms per song, '
+        f'RTF {ref_time * len(songs) / duration:.4f}'
+    )
+    for student in students:
+        student_ins, student_config = load_model(student, precision)
+        assert student_config['hop_size'] == config['hop_size'] \
+               and student_config['audio_sample_rate'] == config['audio_sample_rate'], \
+            f'The frames of the student \'{student}\' do not match the teacher.'
+        run_songs(student_ins, songs[:1], batch_frames, 1)
+        results, elapsed = run_songs(student_ins, songs, batch_frames, repeats)
+        accuracy = songs_accuracy(songs, results, ref_results, timestep, tolerance=tolerance)
+        print(
+            f'| {student}: {num_params(student_ins):.1f}M params, {elapsed * 1000:.0f} ms per song, '
+            f'speedup {ref_time / elapsed:.2f}x; frame accuracy against the teacher {accuracy:.4f}'
+        )
+        del student_ins
+
+
+if __name__ == '__main__':
+    bench_distill()
@@ -0,0 +1,60 @@
+import pathlib
+
+import click
+import yaml
+
+from inference.benchmark import build_inference, load_songs, run_songs, songs_accuracy
+
+
+@click.command(help='Compare the notes and latency of the inference precisions with fp32')
+@click.option('--model', required=True, metavar='CKPT_PATH', help='Path to the model checkpoint (*.ckpt)')
+@click.option('--wav', required=True, multiple=True, metavar='WAV_PATH', help='Input wav files')
+@click.option(
+    '--precision', 'precisions', multiple=True, type=click.Choice(['bf16', 'int8']), default=['bf16', 'int8'],
+    help='Precisions to compare with fp32 (default to all)'
+)
+@click.option('--batch-frames', type=int, default=0, metavar='BATCH_FRAMES', help='Maximum number of frames in each batch')
+@click.option('--repeats', type=int, default=3, metavar='REPEATS', help='Number of timed runs over all songs')
+@click.option('--tolerance', type=float, default=0.5, metavar='SEMITONES', help='Pitch tolerance of the frame agreement')
+@click.option(
+    '--min-accuracy', type=float, default=0., metavar='ACCURACY',
+    help='Fail if the frame accuracy of a precision against fp32 is below this value'
+)
+def bench_precision(model, wav, precisions, batch_frames, repeats, tolerance, min_accuracy):
+    model_path = pathlib.Path(model)
+    with open(model_path.with_name('config.yaml'), 'r', encoding='utf8') as f:
+        config = yaml.safe_load(f)
+    reference = build_inference(model_path, config, 'fp32')
+    timestep = reference.timestep
+
+    # The pitch always runs in fp32; it is extracted once and shared by all precisions.
+    songs = load_songs(reference, wav, config)
+    duration = sum(s[3] for s in songs) * timestep
+    print(f'| {len(songs)} songs, {duration:.1f} s of audio, {repeats} runs')
+
+    run_songs(reference, songs[:1], batch_frames, 1)  # warm up
+    ref_results, ref_time = run_songs(reference, songs, batch_frames, repeats)
+    print(f'| fp32: {ref_time * 1000:.0f} ms per song')
+    failed = []
+    for precision in precisions:
+        infer_ins = build_inference(model_path, config, precision)
+        run_songs(infer_ins, songs[:1], batch_frames, 1)
+        results, elapsed = run_songs(infer_ins, songs, batch_frames, repeats)
+        accuracy = songs_accuracy(songs, results, ref_results, timestep, tolerance=tolerance)
+        num_notes = num_ref_notes = 0
+        for segments, ref_segments in zip(results, ref_results):
+            num_notes += sum(int((~s['note_rest']).sum()) for s in segments)
+            num_ref_notes += sum(int((~s['note_rest']).sum()) for s in ref_segments)
+        print(
+            f'| {precision}: {elapsed * 1000:.0f} ms per song, speedup {ref_time / elapsed:.2f}x; '
+            f'frame accuracy against fp32 {accuracy:.4f}, {num_notes} notes (fp32: {num_ref_notes})'
+        )
+        if accuracy < min_accuracy:
+            failed.append(precision)
+        del infer_ins
+    if len(failed) > 0:
+        raise click.ClickException(f'Accuracy below {min_accuracy}: {", ".join(failed)}')
+
+
+if __name__ == '__main__':
+    bench_precision()
@@ -0,0 +1,63 @@
+import asyncio
+import pathlib
+import time
+
+import click
+import librosa
+import numpy as np
+from aiohttp import ClientSession
+
+
+async def run_load(url, model, payloads, concurrency, num_requests, velocity):
+    latencies = []
+    statuses = {}
+    next_request = 0
+
+    async def client(session: ClientSession):
+        nonlocal next_request
+        while next_request < num_requests:
+            data = payloads[next_request % len(payloads)]
+            next_request += 1
+            start_time = time.time()
+            params = {'velocity': int(velocity)}
+            if model is not None:
+                params['model'] = model
+            async with session.post(f'{url}/infer', params=params, data=data) as response:
+                await response.read()
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+                if response.status == 200:
+                    latencies.append(time.time() - start_time)
+
+    async with ClientSession() as session:
+        start_time = time.time()
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+        elapsed = time.time() - start_time
+    return np.array(latencies), statuses, elapsed
+
+
+@click.command(help='Load generator for serve.py: concurrent clients send audio files and wait for the MIDI files')
+@click.option('--url', default='http://127.0.0.1:7861', metavar='URL', help='Base URL of the server')
+@click.option('--model', required=False, metavar='MODEL', help='Relative path of the model on the server')
+@click.option('--wav', required=True, multiple=True, metavar='WAV_PATH', help='Audio files to send, in turn')
+@click.option('--concurrency', type=int, default=8, metavar='CLIENTS', help='Number of concurrent clients')
+@click.option('--requests', 'num_requests', type=int, default=64, metavar='REQUESTS', help='Total number of requests')
+@click.option('--velocity', is_flag=True, default=False, help='Request velocity calculation')
+def bench_server(url, model, wav, concurrency, num_requests, velocity):
+    payloads = [pathlib.Path(w).read_bytes() for w in wav]
+    audio_duration = [librosa.get_duration(path=w) for w in wav]
+    latencies, statuses, elapsed = asyncio.run(
+        run_load(url, model, payloads, concurrency, num_requests, velocity)
+    )
+    num_ok = latencies.shape[0]
+    processed_audio = sum(audio_duration[i % len(wav)] for i in range(num_requests)) * num_ok / num_requests
+    print(f'| {num_requests} requests, {concurrency} clients, {elapsed:.2f} s; status codes: {statuses}')
+    if num_ok == 0:
+        return
+    print(
+        f'| throughput: {num_ok / elapsed:.2f} requests/s, {processed_audio / elapsed:.1f} s of audio/s; '
+        f'latency p50 {np.percentile(latencies, 50) * 1000:.0f} ms, p99 {np.percentile(latencies, 99) * 1000:.0f} ms'
+    )
+
+
+if __name__ == '__main__':
+    bench_server()
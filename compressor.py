@@ -1,6 +1,126 @@
 import numpy as np
 import librosa
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def envelope_scan(x, attack_coef, release_coef, env0=0.0, block_size=256):
+    """
+    Envelope follower env[i] = max(x[i], release_coef * env[i-1] + (1 - attack_coef) * x[i]), env[-1] = env0,
+    computed without a per-sample loop.
+
+    Each step is a map e -> max(C, R * e + D), and the composition of two such maps is again one of them,
+    so the prefix maps can be computed with a parallel (Hillis-Steele) scan inside blocks of samples.
+    The blocks are then chained through their end states.
+    Parameters:
+    - x: Input level in dB
+    - attack_coef, release_coef: Smoothing coefficients
+    - env0: Envelope before the first sample
+    - block_size: Number of samples in each block of the scan
+    Returns the envelope (float64, same length as x)
+    """
+    n = len(x)
+    if n == 0:
+        return np.zeros(0, dtype=np.float64)
+    a = 1 - attack_coef
+    r = release_coef
+    block_size = min(block_size, n)
+    pad = (-n) % block_size
+    c = np.pad(np.asarray(x, dtype=np.float64), (0, pad)).reshape(-1, block_size)  # C of each step
+    d = a * c  # D of each step; R of each step is r
+    s = 1
+    while s < block_size:
+        # Compose the map of the previous s steps with the map of the current s steps.
+        r_s = r ** s
+        c_new = np.maximum(c[:, s:], r_s * c[:, :-s] + d[:, s:])
+        d_new = r_s * d[:, :-s] + d[:, s:]
+        c[:, s:] = c_new
+        d[:, s:] = d_new
+        s *= 2
+    r_pow = r ** np.arange(1, block_size + 1, dtype=np.float64)  # R of the prefix maps
+
+    # Chain the blocks: the state entering each block is the end state of the previous one.
+    env_in = np.empty(c.shape[0], dtype=np.float64)
+    e = env0
+    for b in range(c.shape[0]):
+        env_in[b] = e
+        e = max(c[b, -1], r_pow[-1] * e + d[b, -1])
+    env = np.maximum(c, r_pow[None, :] * env_in[:, None] + d)
+    return env.reshape(-1)[:n]
+
+
+def _envelope_loop(x, attack_coef, release_coef, env0):
+    env = np.empty(x.shape[0], dtype=np.float64)
+    e = env0
+    for i in range(x.shape[0]):
+        e = max(x[i], release_coef * e + (1 - attack_coef) * x[i])
+        env[i] = e
+    return env
+
+
+if numba is not None:
+    _envelope_loop = numba.njit(cache=True)(_envelope_loop)
+
+
+def envelope_follower(x, attack_coef, release_coef, env0=0.0):
+    """
+    Envelope follower env[i] = max(x[i], release_coef * env[i-1] + (1 - attack_coef) * x[i]), env[-1] = env0.
+    Uses a compiled loop if numba is available, otherwise envelope_scan().
+    """
+    if numba is not None:
+        return _envelope_loop(np.asarray(x, dtype=np.float64), float(attack_coef), float(release_coef), float(env0))
+    return envelope_scan(x, attack_coef, release_coef, env0=env0)
+
+
+class Compressor:
+    """
+    Vocal compressor that can process audio chunk by chunk.
+    The envelope state is carried across calls to process(), so processing the chunks of a signal in order
+    gives the same result as processing the whole signal at once (before the final peak normalization of
+    vocal_compressor(), which needs the whole signal).
+    """
+
+    def __init__(self, sr, threshold=-20.0, ratio=4.0, attack=0.005, release=0.05, makeup_gain=0.0):
+        self.threshold = threshold
+        self.ratio = ratio
+        self.attack_coef = np.exp(-1.0 / (attack * sr))  # Attack smoothing coefficient
+        self.release_coef = np.exp(-1.0 / (release * sr))  # Release smoothing coefficient
+        self.makeup_gain = makeup_gain
+        self.env = None
+        self.reset()
+
+    def reset(self):
+        self.env = None  # envelope of the last processed sample; None before the first sample
+
+    def process(self, y):
+        if len(y) == 0:
+            return y.copy()
+        # Convert signal to dB scale (take absolute value and apply log)
+        y_db = 20 * np.log10(np.abs(y) + 1e-10)  # Add small value to avoid log(0)
+        first = self.env is None
+        env = np.empty(len(y), dtype=np.float64)
+        if first:
+            # The very first sample is left untouched and starts the envelope from 0.
+            env[0] = 0.0
+            env[1:] = envelope_follower(y_db[1:], self.attack_coef, self.release_coef, env0=0.0)
+        else:
+            env[:] = envelope_follower(y_db, self.attack_coef, self.release_coef, env0=self.env)
+        self.env = env[-1]
+
+        # Apply compression to levels exceeding threshold
+        gain_reduction = np.maximum(env - self.threshold, 0) * (1 - 1 / self.ratio)
+        if first:
+            gain_reduction[0] = 0
+
+        # Convert gain reduction from dB to linear scale and apply makeup gain
+        gain = np.power(10, -gain_reduction / 20.0)  # Convert dB reduction to amplitude
+        gain = gain * np.power(10, self.makeup_gain / 20.0)  # Apply makeup gain
+        return (y * gain).astype(y.dtype)
+
+
 def vocal_compressor(y, sr, threshold=-20.0, ratio=4.0, attack=0.005, release=0.05, makeup_gain=0.0):
     """
     Apply a compressor effect optimized for vocals
@@ -13,39 +133,14 @@ def vocal_compressor(y, sr, threshold=-20.0, ratio=4.0, attack=0.005, release=0.
     - release: Release time in seconds
     - makeup_gain: Output gain compensation in dB
     """
-    
-    # Convert signal to dB scale (take absolute value and apply log)
-    y_abs = np.abs(y)
-    y_db = 20 * np.log10(y_abs + 1e-10)  # Add small value to avoid log(0)
-    
-    # Initialize array for gain reduction
-    gain_reduction = np.zeros_like(y_db)
-    
-    # Variables for envelope follower
-    env = np.zeros_like(y_db)
-    attack_coef = np.exp(-1.0 / (attack * sr))  # Attack smoothing coefficient
-    release_coef = np.exp(-1.0 / (release * sr))  # Release smoothing coefficient
-    
-    # Calculate envelope and apply gain reduction
-    for i in range(1, len(y)):
-        # Envelope follower: track signal level with attack/release
-        env[i] = max(y_db[i], release_coef * env[i-1] + (1 - attack_coef) * y_db[i])
-        
-        # Apply compression to levels exceeding threshold
-        if env[i] > threshold:
-            excess = env[i] - threshold
-            gain_reduction[i] = excess * (1 - 1/ratio)
-    
-    # Convert gain reduction from dB to linear scale and apply makeup gain
-    gain = np.power(10, -gain_reduction / 20.0)  # Convert dB reduction to amplitude
-    gain = gain * np.power(10, makeup_gain / 20.0)  # Apply makeup gain
-    
-    # Apply gain to original signal
-    y_compressed = y * gain
-    
+    compressor = Compressor(
+        sr, threshold=threshold, ratio=ratio, attack=attack, release=release, makeup_gain=makeup_gain
+    )
+    y_compressed = compressor.process(y)
+
     # Prevent clipping by normalizing if needed
     max_val = np.max(np.abs(y_compressed))
     if max_val > 1.0:
         y_compressed = y_compressed / max_val
-        
+
     return y_compressed
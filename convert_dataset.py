@@ -0,0 +1,61 @@
+import pathlib
+import random
+import time
+
+import click
+
+from utils.indexed_datasets import IndexedDataset, MMapIndexedDataset, convert_hdf5_to_mmap
+
+
+@click.group(help='Tools for binary datasets')
+def main():
+    pass
+
+
+@main.command(help='Convert HDF5 binary datasets (*.data) into the memory-mapped format (*.mmap)')
+@click.option('--path', required=True, metavar='BINARY_DATA_DIR', help='Path to the binary data directory')
+@click.option(
+    '--prefix', multiple=True, default=['train', 'valid'], metavar='PREFIX',
+    help='Prefixes of the datasets to convert (default to train and valid)'
+)
+def convert(path, prefix):
+    for p in prefix:
+        if not (pathlib.Path(path) / f'{p}.data').exists():
+            print(f'| skip \'{p}\': {p}.data not found.')
+            continue
+        num_items = convert_hdf5_to_mmap(path, p)
+        print(f'| convert \'{p}\': {num_items} items.')
+
+
+@main.command(help='Compare the read throughput of the HDF5 and memory-mapped datasets')
+@click.option('--path', required=True, metavar='BINARY_DATA_DIR', help='Path to the binary data directory')
+@click.option('--prefix', default='train', metavar='PREFIX', help='Prefix of the dataset')
+@click.option('--reads', type=int, default=10000, metavar='READS', help='Number of random item reads')
+@click.option(
+    '--attr', multiple=True, metavar='ATTR',
+    help='Attributes to read from each item (default to all attributes)'
+)
+def bench(path, prefix, reads, attr):
+    hdf5_ds = IndexedDataset(path, prefix)
+    mmap_ds = MMapIndexedDataset(path, prefix)
+    assert len(hdf5_ds) == len(mmap_ds), 'The two datasets have different numbers of items.'
+    attrs = list(attr) if len(attr) > 0 else list(mmap_ds.attrs)
+    indices = [random.randrange(len(mmap_ds)) for _ in range(reads)]
+
+    for name, ds in [('hdf5', hdf5_ds), ('mmap', mmap_ds)]:
+        num_bytes = 0
+        start_time = time.time()
+        for i in indices:
+            item = ds[i]
+            for k in attrs:
+                v = item[k]
+                num_bytes += v.nbytes if hasattr(v, 'nbytes') else 8
+        elapsed = time.time() - start_time
+        print(
+            f'| {name}: {reads / elapsed:.1f} items/s, {num_bytes / elapsed / 1024 ** 2:.1f} MB/s '
+            f'({", ".join(attrs)})'
+        )
+
+
+if __name__ == '__main__':
+    main()
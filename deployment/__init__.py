@@ -5,4 +5,5 @@ from .me_quant_onnx_module import QuantizedMIDIExtractionONNXModule
 task_module_mapping = {
     'training.MIDIExtractionTask': 'deployment.MIDIExtractionONNXModule',
     'training.QuantizedMIDIExtractionTask': 'deployment.QuantizedMIDIExtractionONNXModule',
+    'training.DistillationMIDIExtractionTask': 'deployment.MIDIExtractionONNXModule',
 }
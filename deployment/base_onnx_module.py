@@ -1,11 +1,13 @@
 import pathlib
 from collections import OrderedDict
 
-from librosa.filters import mel
 import torch
+import torch.nn.functional as F
 from torch import nn
 
 from utils import build_object_from_class_name
+from utils.dsp_kernels import mel_basis
+from utils.infer_utils import fuse_model
 
 
 class BaseONNXModule(nn.Module):
@@ -31,8 +33,28 @@ class BaseONNXModule(nn.Module):
         })
         model.load_state_dict(state_dict, strict=True)
         print(f'| load \'{prefix_in_ckpt}\' from \'{self.model_path}\'.')
+        # The exported graph is checked against the unfused model once, at export time.
+        model = fuse_model(model, self.config['units_dim'], check=True)
         return model
 
+    def build_pitch_extractor(self):
+        if self.config['pe'] == 'rmvpe':
+            from .rmvpe_onnx_module import RMVPE_ONNX
+            if self.config.get('pe_viterbi', False):
+                print('| WARNING: Viterbi decoding cannot be exported, the local average is used instead.')
+            return RMVPE_ONNX(
+                self.config['pe_ckpt'], sample_rate=self.config['audio_sample_rate'],
+                hop_size=self.config['hop_size'], device=self.device
+            )
+        # Other pitch extractors cannot be exported; the model is fed with zero pitch.
+        print(f'| WARNING: pitch extractor \'{self.config["pe"]}\' cannot be exported, using zero pitch instead.')
+        return None
+
+    def get_pitch(self, waveform: torch.Tensor, length) -> torch.Tensor:
+        if self.rmvpe is None:
+            return torch.zeros((waveform.shape[0], length), dtype=torch.float32, device=self.device)
+        return self.rmvpe(waveform, length)
+
 
 class MelSpectrogram_ONNX(nn.Module):
     def __init__(
@@ -48,15 +70,8 @@ class MelSpectrogram_ONNX(nn.Module):
     ):
         super().__init__()
         n_fft = win_length if n_fft is None else n_fft
-        mel_basis = mel(
-            sr=sampling_rate,
-            n_fft=n_fft,
-            n_mels=n_mel_channels,
-            fmin=mel_fmin,
-            fmax=mel_fmax,
-            htk=True)
-        mel_basis = torch.from_numpy(mel_basis).float()
-        self.register_buffer("mel_basis", mel_basis)
+        basis = mel_basis(sampling_rate, n_fft, n_mel_channels, fmin=mel_fmin, fmax=mel_fmax)
+        self.register_buffer("mel_basis", basis.clone())
         self.n_fft = win_length if n_fft is None else n_fft
         self.hop_length = hop_length
         self.win_length = win_length
@@ -65,13 +80,16 @@ class MelSpectrogram_ONNX(nn.Module):
         self.clamp = clamp
 
     def forward(self, audio, center=True):
+        if center:
+            # Zero padding, the same as modules.rmvpe.MelSpectrogram
+            audio = F.pad(audio, (self.win_length // 2, (self.win_length + 1) // 2))
         fft = torch.stft(
             audio,
             n_fft=self.n_fft,
             hop_length=self.hop_length,
             win_length=self.win_length,
             window=torch.hann_window(self.win_length, device=audio.device),
-            center=center,
+            center=False,
             return_complex=False
         )
         magnitude = torch.sqrt(torch.sum(fft ** 2, dim=-1))
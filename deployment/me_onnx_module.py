@@ -14,7 +14,7 @@ class MIDIExtractionONNXModule(BaseONNXModule):
             win_length=self.config['win_size'], hop_length=self.config['hop_size'],
             mel_fmin=self.config['fmin'], mel_fmax=self.config['fmax']
         ).to(self.device)
-        self.rmvpe = None
+        self.rmvpe = self.build_pitch_extractor()
         self.midi_min = self.config['midi_min']
         self.midi_max = self.config['midi_max']
         self.midi_deviation = self.config['midi_prob_deviation']
@@ -22,7 +22,7 @@ class MIDIExtractionONNXModule(BaseONNXModule):
 
     def forward(self, waveform: torch.Tensor):
         units = self.mel_extractor(waveform).transpose(1, 2)
-        pitch = torch.zeros(units.shape[:2], dtype=torch.float32, device=self.device)
+        pitch = self.get_pitch(waveform, units.shape[1])
         masks = torch.ones_like(pitch, dtype=torch.bool)
         probs, bounds = self.model(x=units, f0=pitch, mask=masks, sig=True)
         probs *= masks[..., None]
@@ -14,11 +14,11 @@ class QuantizedMIDIExtractionONNXModule(BaseONNXModule):
             win_length=self.config['win_size'], hop_length=self.config['hop_size'],
             mel_fmin=self.config['fmin'], mel_fmax=self.config['fmax']
         ).to(self.device)
-        self.rmvpe = None
+        self.rmvpe = self.build_pitch_extractor()
 
     def forward(self, waveform: torch.Tensor):
         units = self.mel_extractor(waveform).transpose(1, 2)
-        pitch = torch.zeros(units.shape[:2], dtype=torch.float32, device=self.device)
+        pitch = self.get_pitch(waveform, units.shape[1])
         masks = torch.ones_like(pitch, dtype=torch.bool)
         probs, bounds = self.model(x=units, f0=pitch, mask=masks, sig=True)
         probs *= masks[..., None]
@@ -0,0 +1,115 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+import modules.rmvpe
+from modules.rmvpe.constants import *
+from utils.dsp_kernels import resampler
+from .base_onnx_module import MelSpectrogram_ONNX
+
+
+def interp_uv_onnx(f0: torch.Tensor) -> torch.Tensor:
+    """
+    Fill unvoiced frames by linear interpolation in log scale, the same as utils.pitch_utils.interp_f0().
+    :param f0: [T], 0 for unvoiced frames
+    :return: [T]
+    """
+    uv = f0 == 0
+    voiced_idx = torch.nonzero(~uv).squeeze(1)  # [V]
+    num_voiced = (~uv).long().sum()
+    # A sentinel keeps the gathers valid when there are no voiced frames.
+    voiced_idx = torch.cat((voiced_idx, voiced_idx.new_zeros(1)), dim=0)
+    log_f0 = torch.log2(f0 + uv)
+    cnt = torch.cumsum((~uv).long(), dim=0)  # number of voiced frames up to each frame
+    max_idx = (num_voiced - 1).clamp(min=0)
+    prev_idx = voiced_idx[(cnt - 1).clamp(min=0).clamp(max=max_idx)]
+    next_idx = voiced_idx[cnt.clamp(max=max_idx)]
+    span = next_idx - prev_idx
+    frames = torch.arange(f0.shape[0], device=f0.device)
+    weight = (frames - prev_idx).float() / (span + (span == 0)).float()
+    log_f0_interp = log_f0[prev_idx] + (log_f0[next_idx] - log_f0[prev_idx]) * weight
+    log_f0 = torch.where(uv, log_f0_interp, log_f0)
+    return torch.where(num_voiced > 0, 2 ** log_f0, torch.zeros_like(f0))
+
+
+def resample_align_curve_onnx(
+        points: torch.Tensor, original_timestep: float, target_timestep: float, align_length
+) -> torch.Tensor:
+    """
+    Linearly resample a curve to another timestep, the same as utils.pitch_utils.resample_align_curve().
+    :param points: [T]
+    :param align_length: length of the returned curve, either an int or a scalar tensor
+    :return: [align_length]
+    """
+    n_points = points.shape[0]
+    # Number of points in np.arange(0, t_max, target_timestep); the curve is padded with its last point.
+    t_max = (n_points - 1) * original_timestep
+    n_interp = torch.ceil(torch.as_tensor(t_max / target_timestep)).long().clamp(min=1)
+    t = torch.arange(align_length, device=points.device).clamp(max=n_interp - 1) * target_timestep
+    pos = (t / original_timestep).clamp(max=n_points - 1)
+    lo = pos.floor().long()
+    hi = (lo + 1).clamp(max=n_points - 1)
+    return points[lo] + (points[hi] - points[lo]) * (pos - lo)
+
+
+class RMVPE_ONNX(nn.Module):
+    """
+        RMVPE pitch extractor for ONNX export, including resampling, local-average decoding,
+        unvoiced interpolation and alignment to the frames of the main model.
+        Given the same waveform, the result matches modules.rmvpe.RMVPE.get_pitch() with interp_uv=True
+        followed by the alignment in MIDIExtractionInference.preprocess().
+    """
+
+    def __init__(self, model_path, sample_rate, hop_size, hop_length=160, thred=0.03, device=None):
+        super().__init__()
+        rmvpe = modules.rmvpe.RMVPE(model_path, hop_length=hop_length, device=device)
+        self.model = rmvpe.model
+        self.mel_extractor = MelSpectrogram_ONNX(
+            N_MELS, SAMPLE_RATE, WINDOW_LENGTH, hop_length, None, MEL_FMIN, MEL_FMAX
+        ).to(rmvpe.device)
+        self.sample_rate = sample_rate
+        self.hop_size = hop_size
+        self.hop_length = hop_length
+        self.thred = thred
+        if sample_rate != SAMPLE_RATE:
+            resample = resampler(sample_rate, SAMPLE_RATE, lowpass_filter_width=128, device=rmvpe.device)
+            self.register_buffer('resample_kernel', resample.kernel.clone())
+            self.resample_width = resample.width
+            self.resample_orig_freq = resample.orig_freq // resample.gcd
+            self.resample_new_freq = resample.new_freq // resample.gcd
+        else:
+            self.resample_kernel = None
+
+    def resample(self, waveform: torch.Tensor) -> torch.Tensor:
+        # Same as torchaudio.functional.resample(), with the output length computed in integers.
+        if self.resample_kernel is None:
+            return waveform
+        length = waveform.shape[1]
+        waveform = F.pad(waveform, (self.resample_width, self.resample_width + self.resample_orig_freq))
+        resampled = F.conv1d(waveform[:, None], self.resample_kernel, stride=self.resample_orig_freq)
+        resampled = resampled.transpose(1, 2).reshape(waveform.shape[0], -1)
+        target_length = (self.resample_new_freq * length + self.resample_orig_freq - 1) // self.resample_orig_freq
+        return resampled[..., :target_length]
+
+    def forward(self, waveform: torch.Tensor, length) -> torch.Tensor:
+        """
+        :param waveform: [1, n_samples], at the sampling rate of the main model
+        :param length: number of frames of the main model
+        :return: pitch in MIDI, [1, length]
+        """
+        n_samples = waveform.shape[1]
+        audio = self.resample(waveform)
+        mel = self.mel_extractor(audio, center=True)
+        n_frames = mel.shape[-1]
+        mel = F.pad(mel, (0, 32 * ((n_frames - 1) // 32 + 1) - n_frames), mode='constant')
+        hidden = self.model(mel)[:, :n_frames]
+        f0 = modules.rmvpe.decode_local_average_f0(hidden, thred=self.thred)[0]
+        f0 = interp_uv_onnx(f0)
+        f0 = resample_align_curve_onnx(
+            f0, 0.01, self.hop_length / self.sample_rate,
+            (n_samples + self.hop_length - 1) // self.hop_length
+        )
+        f0 = resample_align_curve_onnx(
+            f0, self.hop_length / self.sample_rate, self.hop_size / self.sample_rate, length
+        )
+        return (12 * (torch.log2(f0) - torch.log2(torch.tensor(440., device=f0.device))) + 69)[None]
@@ -46,10 +46,35 @@ def onnx_override_io_shapes(
         _override_shapes(model.graph.output, output_shapes)
 
 
+def onnx_quantize_dynamic(model_path: pathlib.Path, scope: str = '/model/'):
+    """
+    Quantize the weights of the MatMul nodes under the given scope to int8 (in-place operation).
+    Activations are quantized on the fly by ONNX Runtime.
+    :param model_path: path to the ONNX model
+    :param scope: name prefix of the nodes to quantize; the default selects the nodes of the note model
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    onnx_model = onnx.load(model_path.as_posix())
+    nodes = [
+        node.name for node in onnx_model.graph.node
+        if node.op_type in ('MatMul', 'Gemm') and node.name.startswith(scope)
+    ]
+    print(f'Quantizing {len(nodes)} nodes to int8...')
+    quantize_dynamic(
+        model_path, model_path, op_types_to_quantize=['MatMul', 'Gemm'],
+        nodes_to_quantize=nodes, weight_type=QuantType.QInt8
+    )
+
+
 @click.command(help='Run inference with a trained model')
 @click.option('--model', required=True, metavar='CKPT_PATH', help='Path to the model checkpoint (*.ckpt)')
 @click.option('--out', required=False, metavar='ONNX_PATH', help='Path to the output model (*.onnx)')
-def export(model, out):
+@click.option(
+    '--precision', required=False, type=click.Choice(['fp32', 'int8']), default='fp32',
+    help='Precision of the exported model; int8 quantizes the weights of the MatMuls of the model dynamically '
+         '(the mel spectrogram and the pitch extractor are kept in fp32)'
+)
+def export(model, out, precision):
     model_path = pathlib.Path(model)
     with open(model_path.with_name('config.yaml'), 'r', encoding='utf8') as f:
         config = yaml.safe_load(f)
@@ -104,6 +129,8 @@ def export(model, out):
     )
     assert check, 'Simplified ONNX model could not be validated'
     onnx.save(onnx_model, out_path)
+    if precision == 'int8':
+        onnx_quantize_dynamic(out_path)
 
 
 if __name__ == '__main__':
@@ -1,17 +1,15 @@
 import importlib
 import pathlib
+import sys
 
 import click
-import librosa
 import yaml
 
 import inference
 from utils.config_utils import print_config
-from utils.infer_utils import build_midi_file
-from utils.slicer2 import Slicer
+from utils.midi_utils import build_midi_file
 import pitch_correction_utils
-from compressor import vocal_compressor
-from keyfinder import Tonal_Fragment
+from pipeline import AnalysisPipeline
 from functools import partial
 
 @click.command(help='Run inference with a trained model')
@@ -22,91 +20,98 @@ from functools import partial
 @click.option('--velocity', required=False, is_flag=True, type=bool, default=False, metavar='VELOCITY', help='Enable velocity calculation')
 @click.option('--autotune', required=False, is_flag=True, type=bool, default=False, metavar='AUTOTUNE', help='Enable autotune')
 @click.option('--autotune-scale', required=False, type=str, default=None, metavar='AUTOTUNE_SCALE', help='Specify autotune scale; Must be in the form TONIC:key. Tonic must be upper case (`CDEFGAB`), key must be lower-case (`maj`, `min`, `ionian`, `dorian`, `phrygian`, `lydian`, `mixolydian`, `aeolian`, `locrian`).')
+@click.option('--autotune-pitch', required=False, type=click.Choice(['rmvpe', 'pyin']), default='rmvpe', help='Pitch tracker of autotune; rmvpe reuses the pitch extractor of the model (pe_ckpt), and its pitch is also reused for note extraction when the model uses rmvpe')
 @click.option('--scale-detection', required=False, is_flag=True, type=bool, default=False, metavar='SCALE_DETECTION', help='Enable auto scale detection')
+@click.option('--scale-window', required=False, type=float, default=0, metavar='SECONDS', help='Window length of scale detection in seconds; if positive, the key is tracked over sliding windows and autotune follows the key of each section, otherwise one key is detected for the whole song')
 @click.option('--compress', required=False, is_flag=True, type=bool, default=False, metavar='COMPRESS', help='Enable compressor applied to the input wav')
-def infer(model, wav, midi, tempo, velocity, autotune, autotune_scale, scale_detection, compress):
+@click.option('--batch-frames', required=False, type=int, default=0, metavar='BATCH_FRAMES', help='Maximum number of frames in each inference batch; 0 disables batching')
+@click.option('--backend', required=False, type=click.Choice(['torch', 'onnx']), default='torch', help='Inference backend; onnx runs the model exported by export.py (*.onnx next to the checkpoint) with ONNX Runtime')
+@click.option('--precision', required=False, type=click.Choice(['fp32', 'bf16', 'int8']), default='fp32', help='Precision of the model (torch backend only); bf16 runs under bfloat16 autocast, int8 quantizes the weights of the linear layers dynamically (CPU only)')
+@click.option('--graph', required=False, type=click.Choice(['eager', 'script', 'compile']), default='eager', help='Execution of the model (torch backend only); script (TorchScript, frozen) or compile (torch.compile) pads the batches to a few bucket shapes and runs one compiled graph per shape')
+@click.option('--warmup', required=False, is_flag=True, type=bool, default=False, metavar='WARMUP', help='Build the compiled graphs of all bucket shapes when loading the model')
+@click.option('--attention-window', required=False, type=int, default=None, metavar='FRAMES', help='Block size of windowed attention for long slices (torch backend only); 0 for full attention; default to infer_attention_window in the configuration')
+@click.option('--attention-overlap', required=False, type=int, default=None, metavar='FRAMES', help='Frames on each side of a block of windowed attention; default to infer_attention_overlap in the configuration')
+@click.option('--threads', required=False, type=int, default=0, metavar='THREADS', help='Number of intra-op threads of the onnx backend; 0 uses the default')
+@click.option('--inter-threads', required=False, type=int, default=0, metavar='THREADS', help='Number of inter-op threads of the onnx backend; 0 uses the default')
+@click.option('--cache-dir', required=False, type=str, default=None, metavar='CACHE_DIR', help='Directory of the on-disk cache of mel spectrograms and f0 (torch backend only)')
+@click.option('--timings', required=False, is_flag=True, type=bool, default=False, metavar='TIMINGS', help='Print the time spent in each stage')
+def infer(model, wav, midi, tempo, velocity, autotune, autotune_scale, autotune_pitch, scale_detection, scale_window, compress, batch_frames, backend, precision, graph, warmup, attention_window, attention_overlap, threads, inter_threads, cache_dir, timings):
     model_path = pathlib.Path(model)
     with open(model_path.with_name('config.yaml'), 'r', encoding='utf8') as f:
         config = yaml.safe_load(f)
+    if cache_dir is not None:
+        config['feature_cache_dir'] = cache_dir
+    if attention_window is not None:
+        config['infer_attention_window'] = attention_window
+    if attention_overlap is not None:
+        config['infer_attention_overlap'] = attention_overlap
     print_config(config)
-    infer_cls = inference.task_inference_mapping[config['task_cls']]
+    if backend == 'onnx':
+        infer_ins = inference.ONNXInference(
+            config=config, model_path=model_path.with_suffix('.onnx'),
+            intra_op_threads=threads, inter_op_threads=inter_threads
+        )
+    else:
+        infer_cls = inference.task_inference_mapping[config['task_cls']]
 
-    pkg = ".".join(infer_cls.split(".")[:-1])
-    cls_name = infer_cls.split(".")[-1]
-    infer_cls = getattr(importlib.import_module(pkg), cls_name)
-    assert issubclass(infer_cls, inference.BaseInference), \
-        f'Inference class {infer_cls} is not a subclass of {inference.BaseInference}.'
-    infer_ins = infer_cls(config=config, model_path=model_path)
+        pkg = ".".join(infer_cls.split(".")[:-1])
+        cls_name = infer_cls.split(".")[-1]
+        infer_cls = getattr(importlib.import_module(pkg), cls_name)
+        assert issubclass(infer_cls, inference.BaseInference), \
+            f'Inference class {infer_cls} is not a subclass of {inference.BaseInference}.'
+        infer_ins = infer_cls(
+            config=config, model_path=model_path, precision=precision, graph_mode=graph, warmup=warmup
+        )
 
     wav_path = pathlib.Path(wav)
-    waveform, sr = librosa.load(wav_path, sr=config['audio_sample_rate'], mono=True)
+    pipeline = AnalysisPipeline(infer_ins, config)
+    pipeline.load(wav_path)
+    sr = pipeline.sr
 
     if compress:
-        waveform = vocal_compressor(
-                                    y=waveform,
-                                    sr=sr,
-                                    threshold=-28.0,  
-                                    ratio=2.0,       
-                                    attack=0.015,    
-                                    release=0.15,     
-                                    makeup_gain=4.0  
-                                )
+        pipeline.compress(
+            threshold=-28.0,
+            ratio=2.0,
+            attack=0.015,
+            release=0.15,
+            makeup_gain=4.0
+        )
 
     if autotune:
         if scale_detection:
-            wav_trimmed = detect_sound_start(waveform, sr)
-            wav_harmonic, wav_percussive = librosa.effects.hpss(wav_trimmed)
-            duration = wav_trimmed.shape[0] / sr
-            tonal_fragment = Tonal_Fragment(wav_harmonic, sr, tstart=0, tend=duration)
-            key = tonal_fragment.get_key()
+            key = pipeline.detect_key()
             print(f'Detected key: {key}')
-            correction_function = partial(pitch_correction_utils.aclosest_pitch_from_scale, scale=key)
+            if scale_window > 0:
+                section_starts, keys = pipeline.track_keys(scale_window)
+                print('Detected key sections: ' + ', '.join(
+                    f'{t:.1f}s {k}' for t, k in zip(section_starts, keys)
+                ))
+                correction_function = partial(
+                    pitch_correction_utils.aclosest_pitch_from_key_track,
+                    section_starts=section_starts, scales=keys,
+                    frame_time=pipeline.autotune_hop_length(autotune_pitch) / sr
+                )
+            else:
+                correction_function = partial(pitch_correction_utils.aclosest_pitch_from_scale, scale=key)
         elif autotune_scale is None:
             correction_function = pitch_correction_utils.closest_pitch
         else:
             correction_function = partial(pitch_correction_utils.aclosest_pitch_from_scale, scale=autotune_scale)
-        waveform = pitch_correction_utils.autotune(waveform, sr, correction_function)
-        waveform = waveform.astype('float32')
+        pipeline.autotune(correction_function, pitch=autotune_pitch)
 
-    slicer = Slicer(sr=config['audio_sample_rate'], max_sil_kept=1000)
-    chunks = slicer.slice(waveform)
-    
-    if velocity:
-        midis = infer_ins.infer([c['waveform'] for c in chunks], waveform=waveform) # waveform for velocity
-    else:
-        midis = infer_ins.infer([c['waveform'] for c in chunks])
+    midis = pipeline.infer(velocity=velocity, max_batch_frames=batch_frames)
+    chunks = pipeline.chunks()
 
     midi_file = build_midi_file([c['offset'] for c in chunks], midis, tempo=tempo)
 
     midi_path = pathlib.Path(midi) if midi is not None else wav_path.with_suffix('.mid')
     midi_file.save(midi_path)
     print(f'MIDI file saved at: \'{midi_path}\'')
-
-
-# Detect the start of actual sound by finding where amplitude exceeds a threshold
-def detect_sound_start(y, sr, threshold=0.01):
-  # Calculate amplitude envelope
-  frame_length = int(sr * 0.025)  # 25ms frames
-  hop_length = int(sr * 0.010)    # 10ms hop
-  
-  # Get RMS energy for each frame
-  rms = librosa.feature.rms(y=y, frame_length=frame_length, hop_length=hop_length)[0]
-  
-  # Find first frame that exceeds threshold
-  start_frame = 0
-  for i, energy in enumerate(rms):
-    if energy > threshold:
-      start_frame = i
-      break
-      
-  # Convert frame index to sample index
-  start_sample = start_frame * hop_length
-  
-  # Trim audio to start at detected point
-  y_trimmed = y[start_sample:]
-  
-  return y_trimmed
-
+    if timings:
+        pipeline.print_timings()
+    # The ONNX Runtime backend runs without PyTorch, except for the RMVPE pitch of autotune.
+    if backend == 'onnx' and not (autotune and autotune_pitch == 'rmvpe') and 'torch' in sys.modules:
+        print('WARNING: PyTorch was imported by the ONNX Runtime backend.')
 
 
 if __name__ == '__main__':
@@ -1,8 +1,25 @@
-from .base_infer import BaseInference
-from .me_infer import MIDIExtractionInference
-from .me_quant_infer import QuantizedMIDIExtractionInference
+import importlib
+
+from .onnx_infer import ONNXInference
+from .scheduler import MicroBatchScheduler, QueueFullError, RequestTooLargeError
+
+# The PyTorch backend is imported on first access, so that the ONNX Runtime backend starts without PyTorch.
+_torch_classes = {
+    'BaseInference': '.base_infer',
+    'BucketedGraphModel': '.graph',
+    'MIDIExtractionInference': '.me_infer',
+    'QuantizedMIDIExtractionInference': '.me_quant_infer',
+    'StreamingInference': '.stream_infer',
+}
 
 task_inference_mapping = {
     'training.MIDIExtractionTask': 'inference.MIDIExtractionInference',
     'training.QuantizedMIDIExtractionTask': 'inference.QuantizedMIDIExtractionInference',
+    'training.DistillationMIDIExtractionTask': 'inference.MIDIExtractionInference',
 }
+
+
+def __getattr__(name):
+    if name in _torch_classes:
+        return getattr(importlib.import_module(_torch_classes[name], __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,3 +1,4 @@
+import contextlib
 import pathlib
 from collections import OrderedDict
 from typing import Dict, List
@@ -7,18 +8,44 @@ import torch
 import tqdm
 from torch import nn
 
-from utils import build_object_from_class_name
+from modules.attention.base_attention import set_attention_window
+from modules.conform.Gconform import Gmidi_conform
+from utils import batch_by_size, build_object_from_class_name
+from utils.infer_utils import fuse_model
+from .graph import DEFAULT_BATCH_BUCKETS, DEFAULT_BUCKETS, DEFAULT_MAX_FRAMES, GRAPH_MODES, BucketedGraphModel
+from .postprocess import get_frame_rms, slice_chunk_volumes
+
+
+PRECISIONS = ('fp32', 'bf16', 'int8')
 
 
 class BaseInference:
-    def __init__(self, config: dict, model_path: pathlib.Path, device=None):
+    def __init__(
+            self, config: dict, model_path: pathlib.Path, device=None, precision: str = 'fp32',
+            graph_mode: str = 'eager', warmup: bool = False
+    ):
+        """
+        :param precision: fp32; bf16 to run the model under bfloat16 autocast; int8 to quantize the weights of
+            the linear layers dynamically (CPU only). The pitch extractor and the decoding always run in fp32.
+        :param graph_mode: eager; script or compile to run the model through compiled graphs, one per padded
+            shape (see BucketedGraphModel and infer_graph_* in the configuration)
+        :param warmup: build the graphs of all padded shapes at load time
+        """
+        assert precision in PRECISIONS, f'Invalid precision: {precision}'
+        assert graph_mode in GRAPH_MODES, f'Invalid graph mode: {graph_mode}'
         if device is None:
-            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            device = 'cuda' if torch.cuda.is_available() and precision != 'int8' else 'cpu'
+        assert precision != 'int8' or torch.device(device).type == 'cpu', \
+            'Dynamic int8 quantization is only supported on CPU.'
         self.config = config
         self.model_path = model_path
         self.device = device
+        self.precision = precision
+        self.graph_mode = graph_mode
         self.timestep = self.config['hop_size'] / self.config['audio_sample_rate']
         self.model: torch.nn.Module = self.build_model()
+        if warmup and graph_mode != 'eager':
+            self.warmup()
 
     def build_model(self) -> nn.Module:
         model: nn.Module = build_object_from_class_name(
@@ -32,26 +59,127 @@ class BaseInference:
         })
         model.load_state_dict(state_dict, strict=True)
         print(f'| load \'{prefix_in_ckpt}\' from \'{self.model_path}\'.')
+        for module in model.modules():
+            if isinstance(module, Gmidi_conform):
+                # Chunks of a batch are padded; the padding must not change the results of the valid frames.
+                module.mask_blocks = True
+        model = fuse_model(model, self.config['units_dim'])
+        attention_window = self.config.get('infer_attention_window', 0)
+        if attention_window > 0:
+            overlap = self.config.get('infer_attention_overlap', 64)
+            n_modules = set_attention_window(model, attention_window, overlap)
+            print(f'| windowed attention in {n_modules} modules: window {attention_window}, overlap {overlap}.')
+        if self.precision == 'int8':
+            # The conformer is dominated by linear layers; their weights are stored in int8 and the
+            # activations are quantized on the fly.
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        if self.graph_mode != 'eager':
+            model = BucketedGraphModel(
+                model, mode=self.graph_mode, buckets=self.config.get('infer_graph_buckets', DEFAULT_BUCKETS),
+                batch_buckets=self.config.get('infer_graph_batch_buckets', DEFAULT_BATCH_BUCKETS),
+                max_frames=self.config.get('infer_graph_max_frames', DEFAULT_MAX_FRAMES)
+            )
         return model
 
-    def preprocess(self, waveform: np.ndarray) -> Dict[str, torch.Tensor]:
+    def autocast(self):
+        """
+        Context of forward_model(); runs the model under bfloat16 autocast if precision is bf16.
+        """
+        if self.precision == 'bf16':
+            return torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def warmup(self):
+        """
+        Run the model once on each padded shape, so that all graphs are built before inference.
+        """
+        raise NotImplementedError()
+
+    def preprocess(self, waveform: np.ndarray, f0: np.ndarray = None) -> Dict[str, torch.Tensor]:
+        raise NotImplementedError()
+
+    def collate(self, samples: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
         raise NotImplementedError()
 
     def forward_model(self, sample: Dict[str, torch.Tensor]):
         raise NotImplementedError()
 
-    def postprocess(self, results: Dict[str, torch.Tensor]) -> List[Dict[str, np.ndarray]]:
+    def postprocess(
+            self, results: Dict[str, torch.Tensor], volumes: List[np.ndarray] = None
+    ) -> List[Dict[str, np.ndarray]]:
         raise NotImplementedError()
 
-    def infer(self, waveforms: List[np.ndarray], waveform: np.ndarray = None) -> List[Dict[str, np.ndarray]]:
+    def num_frames(self, waveform: np.ndarray) -> int:
+        return waveform.shape[0] // self.config['hop_size'] + 1
+
+    def get_frame_rms(self, waveform: np.ndarray) -> np.ndarray:
+        return get_frame_rms(waveform, self.config['win_size'], self.config['hop_size'])
+
+    def chunk_volumes(self, waveform: np.ndarray, waveforms: List[np.ndarray], offsets: List[float]) -> List[np.ndarray]:
+        """
+        Frame-level RMS of each chunk, sliced from the RMS of the whole song (calculated only once).
+        """
+        return slice_chunk_volumes(
+            self.get_frame_rms(waveform), waveforms, offsets, self.timestep, self.config['hop_size']
+        )
+
+    def infer_batch(
+            self, waveforms: List[np.ndarray], volumes: List[np.ndarray] = None, f0s: List[np.ndarray] = None
+    ) -> List[Dict[str, np.ndarray]]:
+        """
+        Run one batch of chunks through the model.
+        :param volumes: (optional) frame-level RMS of each chunk used for velocity
+        :param f0s: (optional) f0 of each chunk (None to extract it)
+        """
+        if f0s is None:
+            f0s = [None] * len(waveforms)
+        model_in = self.collate([self.preprocess(w, f0=f0) for w, f0 in zip(waveforms, f0s)])
+        model_out = self.forward_model(model_in)
+        return self.postprocess(model_out, volumes)
+
+    def infer(
+            self, waveforms: List[np.ndarray], waveform: np.ndarray = None, offsets: List[float] = None,
+            max_batch_frames: int = 0, max_batch_size: int = 32, f0: np.ndarray = None
+    ) -> List[Dict[str, np.ndarray]]:
         '''
         waveforms: List[np.ndarray]
         waveform: np.ndarray (optional) if provided, volume will be calculated for velocity
+        offsets: List[float] (optional) offsets of the chunks in seconds; required if waveform or f0 is provided
+        max_batch_frames: int (optional) maximum number of padded frames in each batch; 0 disables batching
+        max_batch_size: int (optional) maximum number of chunks in each batch
+        f0: np.ndarray (optional) f0 of the whole song in Hz on the frames of the model (e.g. from a previous
+            pitch pass); if provided, it is sliced for each chunk instead of extracting the pitch again
         '''
-        results = []
-        for w in tqdm.tqdm(waveforms):
-            model_in = self.preprocess(w)
-            model_out = self.forward_model(model_in)
-            res = self.postprocess(model_out, waveform)
-            results.append(res)
+        if max_batch_frames > 0:
+            # Sort chunks by length so that each batch contains chunks of similar sizes.
+            frames = [self.num_frames(w) for w in waveforms]
+            indices = sorted(range(len(waveforms)), key=lambda i: frames[i])
+            batches = batch_by_size(
+                indices, lambda i: min(frames[i], max_batch_frames),
+                max_batch_frames=max_batch_frames, max_batch_size=max_batch_size
+            )
+        else:
+            batches = [[i] for i in range(len(waveforms))]
+        volumes = None
+        if waveform is not None:
+            volumes = self.chunk_volumes(waveform, waveforms, offsets)
+        chunk_f0 = [None] * len(waveforms)
+        if f0 is not None:
+            assert offsets is not None and len(offsets) == len(waveforms), \
+                'Offsets of all chunks must be specified to reuse f0.'
+            for i, (offset, w) in enumerate(zip(offsets, waveforms)):
+                start = min(round(offset / self.timestep), f0.shape[0] - 1)
+                f0_i = f0[start: start + self.num_frames(w)]
+                # The last chunk may end slightly after the song frames; pad with the last value.
+                chunk_f0[i] = np.pad(f0_i, (0, self.num_frames(w) - f0_i.shape[0]), mode='edge')
+        results = [None] * len(waveforms)
+        with tqdm.tqdm(total=len(waveforms)) as progress:
+            for batch in batches:
+                model_res = self.infer_batch(
+                    [waveforms[i] for i in batch], volumes=None if volumes is None else [volumes[i] for i in batch],
+                    f0s=[chunk_f0[i] for i in batch]
+                )
+                for i, res in zip(batch, model_res):
+                    results[i] = res
+                progress.update(len(batch))
         return results
@@ -0,0 +1,65 @@
+import importlib
+import pathlib
+import time
+from typing import List, Tuple
+
+import librosa
+
+import inference
+from modules.metrics import songs_agreement
+from utils.slicer2 import Slicer
+
+
+def build_inference(model_path: pathlib.Path, config: dict, precision: str = 'fp32'):
+    infer_cls = inference.task_inference_mapping[config['task_cls']]
+    pkg = ".".join(infer_cls.split(".")[:-1])
+    cls_name = infer_cls.split(".")[-1]
+    infer_cls = getattr(importlib.import_module(pkg), cls_name)
+    assert issubclass(infer_cls, inference.BaseInference), \
+        f'Inference class {infer_cls} is not a subclass of {inference.BaseInference}.'
+    return infer_cls(config=config, model_path=model_path, precision=precision)
+
+
+def load_songs(infer_ins, wav: List[str], config: dict, slicing: bool = True) -> List[Tuple]:
+    """
+    Load and slice the songs of a benchmark. The pitch is extracted once here and shared by all the runs.
+    :param slicing: slice the songs at silences; otherwise each song is one chunk
+    :return: (waveforms of the chunks, offsets of the chunks, f0, number of frames) of each song
+    """
+    songs = []
+    for w in wav:
+        waveform, _ = librosa.load(w, sr=config['audio_sample_rate'], mono=True)
+        if slicing:
+            chunks = Slicer(sr=config['audio_sample_rate'], max_sil_kept=1000).slice(waveform)
+        else:
+            chunks = [{'waveform': waveform, 'offset': 0.}]
+        f0, _ = infer_ins.get_f0_uv(waveform, infer_ins.num_frames(waveform))
+        songs.append((
+            [c['waveform'] for c in chunks], [c['offset'] for c in chunks], f0, infer_ins.num_frames(waveform)
+        ))
+    return songs
+
+
+def run_songs(infer_ins, songs, batch_frames: int = 0, repeats: int = 1):
+    """
+    :param songs: songs from load_songs()
+    :return: notes of each song, and the mean time of the model per song
+    """
+    results = None
+    start_time = time.time()
+    for _ in range(repeats):
+        results = [
+            infer_ins.infer(chunks, offsets=offsets, max_batch_frames=batch_frames, f0=f0)
+            for chunks, offsets, f0, _ in songs
+        ]
+    return results, (time.time() - start_time) / repeats / len(songs)
+
+
+def songs_accuracy(songs, results, ref_results, timestep, tolerance: float = 0.5) -> float:
+    """
+    Frame-level agreement of the notes of the songs from load_songs() with reference notes.
+    """
+    return songs_agreement(
+        [(offsets, n_frames) for _, offsets, _, n_frames in songs], results, ref_results, timestep,
+        tolerance=tolerance
+    )
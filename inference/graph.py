@@ -0,0 +1,143 @@
+import threading
+from typing import Dict, List, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+GRAPH_MODES = ('eager', 'script', 'compile')
+DEFAULT_BUCKETS = (64, 128, 192, 256, 384, 512, 768, 1024, 1536, 2048, 3072, 4096)
+DEFAULT_BATCH_BUCKETS = (1, 2, 4, 8, 16, 32)
+DEFAULT_MAX_FRAMES = 16384
+
+
+class _ModelCall(nn.Module):
+    # Binds the flags of midi_conforms.forward() so that the traced graph only takes tensors.
+    def __init__(self, model: nn.Module, softmax: bool, sig: bool):
+        super().__init__()
+        self.model = model
+        self.softmax = softmax
+        self.sig = sig
+
+    def forward(self, x, f0, mask):
+        return self.model(x, f0, mask=mask, softmax=self.softmax, sig=self.sig)
+
+
+class BucketedGraphModel(nn.Module):
+    """
+        Runs the model through one compiled graph per input shape, with the number of frames padded up to the
+        smallest of a few bucket sizes and the batch size padded up to the smallest of a few batch buckets, so
+        that batches of arbitrary shapes share a bounded set of graphs: one for each shape in *shapes* and each
+        combination of the softmax and sig flags.
+
+        Padded frames and padded rows are masked out, which the model already does for the padding of batches,
+        so the outputs of the valid frames are the same as the eager model. Inputs longer than the largest
+        bucket, batches larger than the largest batch bucket and padded shapes of more than *max_frames* frames
+        run on the eager model.
+
+        mode:
+            script: torch.jit.trace + torch.jit.optimize_for_inference; freezes the weights, runs the
+                fusion passes of TorchScript and removes the Python dispatch.
+            compile: torch.compile with static shapes.
+    """
+
+    def __init__(
+            self, model: nn.Module, mode: str = 'script', buckets: List[int] = DEFAULT_BUCKETS,
+            batch_buckets: List[int] = DEFAULT_BATCH_BUCKETS, max_frames: int = DEFAULT_MAX_FRAMES
+    ):
+        super().__init__()
+        assert mode in GRAPH_MODES and mode != 'eager', f'Invalid graph mode: {mode}'
+        self.model = model
+        self.mode = mode
+        self.buckets = sorted(buckets)
+        self.batch_buckets = sorted(batch_buckets)
+        self.max_frames = max_frames
+        # Single inputs always have a graph, whatever max_frames is.
+        self.shapes: List[Tuple[int, int]] = [
+            (batch_size, length) for batch_size in self.batch_buckets for length in self.buckets
+            if batch_size == 1 or batch_size * length <= max_frames
+        ]
+        self._graphs: Dict[Tuple, nn.Module] = {}
+        self._lock = threading.Lock()
+        if mode == 'compile':
+            # Every shape and combination of flags is one more static graph of the same code.
+            import torch._dynamo
+            torch._dynamo.config.cache_size_limit = max(
+                torch._dynamo.config.cache_size_limit, 4 * len(self.shapes)
+            )
+            if hasattr(torch._dynamo.config, 'accumulated_cache_size_limit'):
+                torch._dynamo.config.accumulated_cache_size_limit = max(
+                    torch._dynamo.config.accumulated_cache_size_limit, 4 * len(self.shapes)
+                )
+
+    @staticmethod
+    def _round_up(size: int, buckets: List[int]) -> int:
+        for b in buckets:
+            if b >= size:
+                return b
+        return 0
+
+    def bucket(self, length: int) -> int:
+        """
+        Padded number of frames of an input, or 0 if it is longer than all buckets.
+        """
+        return self._round_up(length, self.buckets)
+
+    def shape(self, batch_size: int, length: int) -> Tuple[int, int]:
+        """
+        Padded (batch size, number of frames) of a batch, or None if it has no graph.
+        """
+        padded_batch_size = self._round_up(batch_size, self.batch_buckets)
+        padded_length = self.bucket(length)
+        if padded_batch_size == 0 or padded_length == 0:
+            return None
+        if padded_batch_size > 1 and padded_batch_size * padded_length > self.max_frames:
+            return None
+        return padded_batch_size, padded_length
+
+    def _build_graph(self, key, x, f0, mask) -> nn.Module:
+        _, _, softmax, sig = key
+        call = _ModelCall(self.model, softmax=softmax, sig=sig).eval()
+        if self.mode == 'compile':
+            return torch.compile(call, dynamic=False)
+        # Under bf16 autocast (see BaseInference.autocast()), the casts are recorded into the graph.
+        with torch.no_grad():
+            traced = torch.jit.trace(call, (x, f0, mask), check_trace=False)
+            return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+    def get_graph(self, key, x, f0, mask) -> nn.Module:
+        graph = self._graphs.get(key)
+        if graph is None:
+            # Workers of the server may meet a new shape at the same time; each graph is built only once.
+            with self._lock:
+                graph = self._graphs.get(key)
+                if graph is None:
+                    graph = self._build_graph(key, x, f0, mask)
+                    self._graphs[key] = graph
+        return graph
+
+    def forward(self, x, f0, mask=None, softmax=False, sig=False):
+        batch_size, n_frames = x.shape[:2]
+        shape = self.shape(batch_size, n_frames)
+        if shape is None:
+            return self.model(x, f0, mask=mask, softmax=softmax, sig=sig)
+        padded_batch_size, length = shape
+        if mask is None:
+            mask = torch.ones(x.shape[:2], dtype=torch.bool, device=x.device)
+        if length > n_frames:
+            x = F.pad(x, (0, 0, 0, length - n_frames))
+            f0 = F.pad(f0, (0, length - n_frames))
+            mask = F.pad(mask, (0, length - n_frames), value=False)
+        if padded_batch_size > batch_size:
+            n_rows = padded_batch_size - batch_size
+            x = F.pad(x, (0, 0, 0, 0, 0, n_rows))
+            f0 = F.pad(f0, (0, 0, 0, n_rows))
+            # Padded rows keep their first frame valid, so that the attention of these rows does not
+            # normalize over no frames at all; their outputs are dropped anyway.
+            row_mask = torch.zeros((n_rows, length), dtype=torch.bool, device=mask.device)
+            row_mask[:, 0] = True
+            mask = torch.cat([mask, row_mask], dim=0)
+        key = (padded_batch_size, length, softmax, sig)
+        midi, bound = self.get_graph(key, x, f0, mask)(x, f0, mask)
+        return midi[:batch_size, :n_frames], bound[:batch_size, :n_frames]
@@ -6,53 +6,144 @@ import numpy as np
 import torch
 
 import modules.rmvpe
-from utils.binarizer_utils import get_pitch_parselmouth
+from utils import collate_nd
+from utils.binarizer_utils import get_pitch_parselmouth, get_pitch_rmvpe, get_pitch_rmvpe_batch
+from utils.feature_cache import build_feature_cache, f0_cache_params, units_cache_params
 from utils.infer_utils import decode_bounds_to_alignment, decode_gaussian_blurred_probs, decode_note_sequence
-from utils.pitch_utils import resample_align_curve
 from .base_infer import BaseInference
+from .postprocess import normalize_volumes
 
 
 class MIDIExtractionInference(BaseInference):
-    def __init__(self, config: dict, model_path: pathlib.Path, device=None):
-        super().__init__(config, model_path, device=device)
+    def __init__(
+            self, config: dict, model_path: pathlib.Path, device=None, precision: str = 'fp32',
+            graph_mode: str = 'eager', warmup: bool = False
+    ):
+        super().__init__(
+            config, model_path, device=device, precision=precision, graph_mode=graph_mode, warmup=warmup
+        )
         self.mel_spec = modules.rmvpe.MelSpectrogram(
             n_mel_channels=self.config['units_dim'], sampling_rate=self.config['audio_sample_rate'],
             win_length=self.config['win_size'], hop_length=self.config['hop_size'],
             mel_fmin=self.config['fmin'], mel_fmax=self.config['fmax']
         ).to(self.device)
         self.rmvpe = None
+        self.feature_cache = build_feature_cache(self.config)
         self.midi_min = self.config['midi_min']
         self.midi_max = self.config['midi_max']
         self.midi_deviation = self.config['midi_prob_deviation']
         self.rest_threshold = self.config['rest_threshold']
 
-    def preprocess(self, waveform: np.ndarray) -> Dict[str, torch.Tensor]:
-        wav_tensor = torch.from_numpy(waveform).unsqueeze(0).to(self.device)
-        units = self.mel_spec(wav_tensor).transpose(1, 2)
-        length = units.shape[1]
-        f0_algo = self.config['pe']
+    def get_rmvpe(self) -> modules.rmvpe.RMVPE:
+        if self.rmvpe is None:
+            self.rmvpe = modules.rmvpe.RMVPE(
+                self.config['pe_ckpt'], device=self.device,
+                window_size=self.config.get('pe_window_size', 0),
+                window_overlap=self.config.get('pe_window_overlap', 64),
+                use_viterbi=self.config.get('pe_viterbi', False)
+            )
+        return self.rmvpe
+
+    def get_f0_uv(self, waveform: np.ndarray, length: int, f0_algo: str = None):
+        """
+        Extract f0 on the frames of the model.
+        :param waveform: at the sampling rate of the model
+        :param length: number of frames
+        :param f0_algo: pitch extractor, default to the one in the configuration
+        :return: f0 in Hz with unvoiced frames interpolated, and the unvoiced mask; both [length]
+        """
+        if f0_algo is None:
+            f0_algo = self.config['pe']
         if f0_algo == 'parselmouth':
-            f0, _ = get_pitch_parselmouth(
+            f0, uv = get_pitch_parselmouth(
                 waveform, sample_rate=self.config['audio_sample_rate'],
                 hop_size=self.config['hop_size'], length=length, interp_uv=True
             )
         elif f0_algo == 'rmvpe':
-            if self.rmvpe is None:
-                self.rmvpe = modules.rmvpe.RMVPE(self.config['pe_ckpt'], device=self.device)
-            f0, _ = self.rmvpe.get_pitch(
-                waveform, sample_rate=self.config['audio_sample_rate'],
-                hop_size=self.rmvpe.mel_extractor.hop_length,
-                length=(waveform.shape[0] + self.rmvpe.mel_extractor.hop_length - 1) // self.rmvpe.mel_extractor.hop_length,
-                interp_uv=True
-            )
-            f0 = resample_align_curve(
-                f0,
-                original_timestep=self.rmvpe.mel_extractor.hop_length / self.config['audio_sample_rate'],
-                target_timestep=self.config['hop_size'] / self.config['audio_sample_rate'],
-                align_length=length
+            f0, uv = get_pitch_rmvpe(
+                self.get_rmvpe(), waveform, sample_rate=self.config['audio_sample_rate'],
+                hop_size=self.config['hop_size'], length=length, interp_uv=True
             )
         else:
             raise NotImplementedError(f'Invalid pitch extractor: {f0_algo}')
+        return f0, uv
+
+    def get_f0(self, waveform: np.ndarray, length: int) -> np.ndarray:
+        return self.get_f0_uv(waveform, length)[0]
+
+    def get_f0_batch(self, waveforms: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        f0 of several chunks with RMVPE batched across them, reusing cached f0 if the feature cache is enabled.
+        None is returned for all chunks if the pitch extractor is not RMVPE; preprocess() extracts them.
+        """
+        if self.config['pe'] != 'rmvpe':
+            return [None] * len(waveforms)
+        lengths = [self.num_frames(w) for w in waveforms]
+        f0s = [None] * len(waveforms)
+        keys = [None] * len(waveforms)
+        if self.feature_cache is not None:
+            for i, (waveform, length) in enumerate(zip(waveforms, lengths)):
+                keys[i] = self.feature_cache.make_key(
+                    self.feature_cache.hash_audio(waveform), 'f0', **f0_cache_params(self.config), length=length
+                )
+                f0 = self.feature_cache.get(keys[i])
+                if f0 is not None:
+                    f0s[i] = np.array(f0)
+        missing = [i for i in range(len(waveforms)) if f0s[i] is None]
+        if len(missing) == 0:
+            return f0s
+        results = get_pitch_rmvpe_batch(
+            self.get_rmvpe(), [waveforms[i] for i in missing], sample_rate=self.config['audio_sample_rate'],
+            hop_size=self.config['hop_size'], lengths=[lengths[i] for i in missing], interp_uv=True
+        )
+        for i, (f0, _) in zip(missing, results):
+            if self.feature_cache is not None:
+                self.feature_cache.put(keys[i], f0)
+            f0s[i] = f0
+        return f0s
+
+    def infer_batch(
+            self, waveforms: List[np.ndarray], volumes: List[np.ndarray] = None, f0s: List[np.ndarray] = None
+    ) -> List[Dict[str, np.ndarray]]:
+        if f0s is None:
+            f0s = [None] * len(waveforms)
+        missing = [i for i in range(len(waveforms)) if f0s[i] is None]
+        if len(missing) > 1:
+            # The pitch of all chunks of the batch is extracted at once.
+            f0s = list(f0s)
+            for i, f0 in zip(missing, self.get_f0_batch([waveforms[i] for i in missing])):
+                f0s[i] = f0
+        return super().infer_batch(waveforms, volumes=volumes, f0s=f0s)
+
+    def preprocess(self, waveform: np.ndarray, f0: np.ndarray = None) -> Dict[str, torch.Tensor]:
+        """
+        :param waveform: waveform of the chunk
+        :param f0: (optional) f0 of the chunk in Hz on the frames of the model; extracted if not provided
+        """
+        wav_tensor = torch.from_numpy(waveform).unsqueeze(0).to(self.device)
+        if self.feature_cache is None:
+            units = self.mel_spec(wav_tensor).transpose(1, 2)
+            if f0 is None:
+                f0 = self.get_f0(waveform, units.shape[1])
+        else:
+            # The cache keys are shared with the binarizer, so features of binarized audio are reused.
+            audio_hash = self.feature_cache.hash_audio(waveform)
+            units_key = self.feature_cache.make_key(
+                audio_hash, 'units', **units_cache_params(self.config), key_shift=0
+            )
+            units = self.feature_cache.get_or_compute(
+                units_key, lambda: self.mel_spec(wav_tensor).transpose(1, 2).squeeze(0).cpu().numpy()
+            )
+            units = torch.from_numpy(np.array(units)).unsqueeze(0).to(self.device)
+            if f0 is None:
+                f0_key = self.feature_cache.make_key(
+                    audio_hash, 'f0', **f0_cache_params(self.config), length=units.shape[1]
+                )
+                f0 = np.array(self.feature_cache.get_or_compute(
+                    f0_key, lambda: self.get_f0(waveform, units.shape[1])
+                ))
+        assert f0.shape[0] == units.shape[1], \
+            f'Length of f0 ({f0.shape[0]}) does not match the number of frames ({units.shape[1]}).'
         pitch = librosa.hz_to_midi(f0)
         pitch = torch.from_numpy(pitch).unsqueeze(0).to(self.device)
         # pitch = torch.zeros(units.shape[:2], dtype=torch.float32, device=self.device)
@@ -62,23 +153,42 @@ class MIDIExtractionInference(BaseInference):
             'masks': torch.ones_like(pitch, dtype=torch.bool)
         }
 
-    @torch.no_grad()
-    def forward_model(self, sample: Dict[str, torch.Tensor]):
-
+    def collate(self, samples: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
+        return {
+            'units': collate_nd([s['units'].squeeze(0) for s in samples]),  # [B, T_s, C]
+            'pitch': collate_nd([s['pitch'].squeeze(0) for s in samples]),  # [B, T_s]
+            'masks': collate_nd([s['masks'].squeeze(0) for s in samples], pad_value=False)  # [B, T_s]
+        }
 
+    def warmup(self):
+        for batch_size, length in self.model.shapes:
+            pitch = torch.zeros((batch_size, length), dtype=torch.float32, device=self.device)
+            self.forward_model({
+                'units': torch.zeros(
+                    (batch_size, length, self.config['units_dim']), dtype=torch.float32, device=self.device
+                ),
+                'pitch': pitch,
+                'masks': torch.ones_like(pitch, dtype=torch.bool)
+            })
+        print(f'| warm up {len(self.model.shapes)} graphs ({self.graph_mode}).')
 
-        probs, bounds = self.model(x=sample['units'], f0=sample['pitch'], mask=sample['masks'],sig=True)
+    @torch.no_grad()
+    def forward_model(self, sample: Dict[str, torch.Tensor]):
+        with self.autocast():
+            probs, bounds = self.model(x=sample['units'], f0=sample['pitch'], mask=sample['masks'],sig=True)
 
         return {
-            'probs': probs,
-            'bounds': bounds,
+            'probs': probs.float(),
+            'bounds': bounds.float(),
             'masks': sample['masks'],
         }
 
-    def postprocess(self, results: Dict[str, torch.Tensor], waveform: np.ndarray = None) -> Dict[str, np.ndarray]:
+    def postprocess(
+            self, results: Dict[str, torch.Tensor], volumes: List[np.ndarray] = None
+    ) -> List[Dict[str, np.ndarray]]:
         '''
         results: Dict[str, torch.Tensor]
-        waveform: np.ndarray (optional) if provided, volume will be calculated for velocity
+        volumes: List[np.ndarray] (optional) if provided, frame-level RMS of each chunk used for velocity
         '''
         probs = results['probs']
         bounds = results['bounds']
@@ -96,68 +206,46 @@ class MIDIExtractionInference(BaseInference):
             unit2note_pred, midi_pred, ~rest_pred & masks
         )
         note_rest_pred = ~note_mask_pred
-
-        if waveform is None:
-            return {
-                'note_midi': note_midi_pred.squeeze(0).cpu().numpy(),
-                'note_dur': note_dur_pred.squeeze(0).cpu().numpy() * self.timestep,
-                'note_rest': note_rest_pred.squeeze(0).cpu().numpy(),
+        if volumes is not None:
+            note_volume_pred = self.decode_note_volumes(unit2note_pred, volumes).cpu().numpy()
+
+        # Split the batch back into chunks; padded frames have no notes.
+        n_notes = unit2note_pred.max(dim=1)[0].cpu().numpy()
+        note_midi_pred = note_midi_pred.cpu().numpy()
+        note_dur_pred = note_dur_pred.cpu().numpy()
+        note_rest_pred = note_rest_pred.cpu().numpy()
+        outputs = []
+        for i in range(len(n_notes)):
+            res = {
+                'note_midi': note_midi_pred[i, :n_notes[i]],
+                'note_dur': note_dur_pred[i, :n_notes[i]] * self.timestep,
+                'note_rest': note_rest_pred[i, :n_notes[i]],
             }
-        else:
-            # Get Volume
-            hop_length = self.config['hop_size']
-            n_frames = len(waveform) // hop_length + 1
-            
-            # RMS Energy
-            frame_rms = librosa.feature.rms(
-                y=waveform,
-                frame_length=self.config['win_size'],
-                hop_length=hop_length,
-                center=True
-            )[0]
-
-            # match note with frame
-            note_volumes = []
-            current_note = 0
-            frame_volume_sum = 0
-            frame_count = 0
-            
-            unit2note = unit2note_pred.squeeze(0).cpu().numpy()
-            
-            for frame_idx, note_idx in enumerate(unit2note):
-                if frame_idx >= len(frame_rms):
-                    break
-                    
-                if note_idx == current_note and not note_rest_pred.squeeze(0).cpu().numpy()[current_note-1]:
-                    frame_volume_sum += frame_rms[frame_idx]
-                    frame_count += 1
-                elif frame_count > 0:
-                    note_volumes.append(frame_volume_sum / frame_count)
-                    frame_volume_sum = frame_rms[frame_idx]
-                    frame_count = 1
-                    current_note = note_idx
-                else:
-                    current_note = note_idx
-            
-            if frame_count > 0:
-                note_volumes.append(frame_volume_sum / frame_count)
-
-            # Normalize Volume (0-1 range)
-            if note_volumes:
-                note_volumes = np.array(note_volumes)
-                min_vol = np.min(note_volumes)
-                max_vol = np.max(note_volumes)
-                if max_vol > min_vol:
-                    note_volumes = (note_volumes - min_vol) / (max_vol - min_vol)
-                else:
-                    note_volumes = np.ones_like(note_volumes) * 0.5
-            else:
-                note_volumes = np.array([])
-
-            return {
-                'note_midi': note_midi_pred.squeeze(0).cpu().numpy(),
-                'note_dur': note_dur_pred.squeeze(0).cpu().numpy() * self.timestep,
-                'note_rest': note_rest_pred.squeeze(0).cpu().numpy(),
-                'note_volume': note_volumes
-            }
-
+            if volumes is not None:
+                res['note_volume'] = normalize_volumes(note_volume_pred[i, :n_notes[i]], res['note_rest'])
+            outputs.append(res)
+        return outputs
+
+    @staticmethod
+    def decode_note_volumes(unit2note: torch.Tensor, volumes: List[np.ndarray]) -> torch.Tensor:
+        """
+        Average the frame-level volume over the frames of each note.
+        :param unit2note: [B, T]
+        :param volumes: B arrays of frame-level volume, each of at most T frames
+        :return: note-level volume, [B, N]
+        """
+        frame_volume = torch.zeros(unit2note.shape, dtype=torch.float32)
+        for i, v in enumerate(volumes):
+            frame_volume[i, :len(v)] = torch.from_numpy(v[:unit2note.shape[1]])
+        frame_volume = frame_volume.to(unit2note.device)
+        frame_valid = torch.arange(unit2note.shape[1], device=unit2note.device)[None, :] < torch.tensor(
+            [len(v) for v in volumes], device=unit2note.device
+        )[:, None]  # frames beyond the end of the song have no volume
+        space = unit2note.max() + 1
+        volume_sum = frame_volume.new_zeros(unit2note.shape[0], space).scatter_add(
+            1, unit2note, frame_volume
+        )[:, 1:]
+        volume_cnt = frame_volume.new_zeros(unit2note.shape[0], space).scatter_add(
+            1, unit2note, frame_valid.float()
+        )[:, 1:]
+        return volume_sum / (volume_cnt + (volume_cnt == 0))
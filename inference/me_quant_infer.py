@@ -10,15 +10,18 @@ from .me_infer import MIDIExtractionInference
 class QuantizedMIDIExtractionInference(MIDIExtractionInference):
     @torch.no_grad()
     def forward_model(self, sample: Dict[str, torch.Tensor]):
-        probs, bounds = self.model(x=sample['units'], f0=sample['pitch'], mask=sample['masks'], softmax=True)
+        with self.autocast():
+            probs, bounds = self.model(x=sample['units'], f0=sample['pitch'], mask=sample['masks'], softmax=True)
 
         return {
-            'probs': probs,
-            'bounds': bounds,
+            'probs': probs.float(),
+            'bounds': bounds.float(),
             'masks': sample['masks'],
         }
 
-    def postprocess(self, results: Dict[str, torch.Tensor]) -> List[Dict[str, np.ndarray]]:
+    def postprocess(
+            self, results: Dict[str, torch.Tensor], volumes: List[np.ndarray] = None
+    ) -> List[Dict[str, np.ndarray]]:
         probs = results['probs']
         bounds = results['bounds']
         masks = results['masks']
@@ -31,8 +34,15 @@ class QuantizedMIDIExtractionInference(MIDIExtractionInference):
             unit2note_pred, midi_pred.clip(min=0, max=127), ~rest_pred & masks
         )
         note_rest_pred = ~note_mask_pred
-        return {
-            'note_midi': note_midi_pred.squeeze(0).cpu().numpy(),
-            'note_dur': note_dur_pred.squeeze(0).cpu().numpy() * self.timestep,
-            'note_rest': note_rest_pred.squeeze(0).cpu().numpy()
-        }
+        n_notes = unit2note_pred.max(dim=1)[0].cpu().numpy()
+        note_midi_pred = note_midi_pred.cpu().numpy()
+        note_dur_pred = note_dur_pred.cpu().numpy()
+        note_rest_pred = note_rest_pred.cpu().numpy()
+        return [
+            {
+                'note_midi': note_midi_pred[i, :n_notes[i]],
+                'note_dur': note_dur_pred[i, :n_notes[i]] * self.timestep,
+                'note_rest': note_rest_pred[i, :n_notes[i]]
+            }
+            for i in range(len(n_notes))
+        ]
@@ -0,0 +1,93 @@
+import pathlib
+from typing import Dict, List
+
+import numpy as np
+import tqdm
+
+from .postprocess import decode_note_volumes_by_dur, get_frame_rms, normalize_volumes, slice_chunk_volumes
+
+
+class ONNXInference:
+    """
+        Run the graph exported by export.py with ONNX Runtime on CPU.
+
+        This class provides the same infer() interface as BaseInference, but the model runs without
+        PyTorch and benefits from the graph optimizations of ONNX Runtime. The exported graph processes
+        one chunk at a time, so the batching arguments of infer() are accepted for compatibility and ignored.
+    """
+
+    def __init__(
+            self, config: dict, model_path: pathlib.Path,
+            intra_op_threads: int = 0, inter_op_threads: int = 0
+    ):
+        import onnxruntime as ort
+        self.config = config
+        self.model_path = model_path
+        self.timestep = self.config['hop_size'] / self.config['audio_sample_rate']
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 0 lets ONNX Runtime decide the number of threads.
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        self.session = ort.InferenceSession(
+            str(model_path), sess_options=options, providers=['CPUExecutionProvider']
+        )
+        print(f'| load ONNX model from \'{self.model_path}\'.')
+
+    def num_frames(self, waveform: np.ndarray) -> int:
+        return waveform.shape[0] // self.config['hop_size'] + 1
+
+    def get_frame_rms(self, waveform: np.ndarray) -> np.ndarray:
+        return get_frame_rms(waveform, self.config['win_size'], self.config['hop_size'])
+
+    def forward_model(self, waveform: np.ndarray) -> Dict[str, np.ndarray]:
+        note_midi, note_rest, note_dur = self.session.run(
+            ['note_midi', 'note_rest', 'note_dur'], {'waveform': waveform[None].astype(np.float32)}
+        )
+        return {
+            'note_midi': note_midi[0],
+            'note_dur': note_dur[0],
+            'note_rest': note_rest[0],
+        }
+
+    def chunk_volumes(self, waveform: np.ndarray, waveforms: List[np.ndarray], offsets: List[float]) -> List[np.ndarray]:
+        return slice_chunk_volumes(
+            self.get_frame_rms(waveform), waveforms, offsets, self.timestep, self.config['hop_size']
+        )
+
+    def infer_batch(
+            self, waveforms: List[np.ndarray], volumes: List[np.ndarray] = None, f0s: List[np.ndarray] = None
+    ) -> List[Dict[str, np.ndarray]]:
+        """
+        Same interface as BaseInference.infer_batch(); the chunks run one by one and f0s is ignored.
+        """
+        results = []
+        for i, w in enumerate(waveforms):
+            res = self.forward_model(w)
+            if volumes is not None:
+                res['note_volume'] = normalize_volumes(
+                    decode_note_volumes_by_dur(res['note_dur'], volumes[i], self.timestep), res['note_rest']
+                )
+            results.append(res)
+        return results
+
+    def infer(
+            self, waveforms: List[np.ndarray], waveform: np.ndarray = None, offsets: List[float] = None,
+            max_batch_frames: int = 0, max_batch_size: int = 32, f0: np.ndarray = None
+    ) -> List[Dict[str, np.ndarray]]:
+        '''
+        waveforms: List[np.ndarray]
+        waveform: np.ndarray (optional) if provided, volume will be calculated for velocity
+        offsets: List[float] (optional) offsets of the chunks in seconds; required if waveform is provided
+        max_batch_frames, max_batch_size: ignored
+        f0: ignored; the exported graph extracts the pitch by itself
+        '''
+        volumes = None
+        if waveform is not None:
+            volumes = self.chunk_volumes(waveform, waveforms, offsets)
+        results = []
+        for i, w in enumerate(tqdm.tqdm(waveforms)):
+            results.extend(self.infer_batch([w], volumes=None if volumes is None else [volumes[i]]))
+        return results
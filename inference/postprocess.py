@@ -0,0 +1,64 @@
+from typing import List
+
+import librosa
+import numpy as np
+
+# Postprocessing shared by the PyTorch and the ONNX Runtime backends; numpy only, so that the
+# ONNX Runtime backend does not import PyTorch.
+
+
+def get_frame_rms(waveform: np.ndarray, win_size: int, hop_size: int) -> np.ndarray:
+    # Frames are centered in the same way as the mel spectrogram, so frame i of a chunk
+    # starting at frame j of the song is frame i + j of the song.
+    return librosa.feature.rms(
+        y=waveform,
+        frame_length=win_size,
+        hop_length=hop_size,
+        center=True
+    )[0]
+
+
+def slice_chunk_volumes(
+        frame_rms: np.ndarray, waveforms: List[np.ndarray], offsets: List[float], timestep: float, hop_size: int
+) -> List[np.ndarray]:
+    """
+    Frame-level RMS of each chunk, sliced from the RMS of the whole song.
+    """
+    assert offsets is not None and len(offsets) == len(waveforms), \
+        'Offsets of all chunks must be specified to calculate volume.'
+    volumes = []
+    for offset, w in zip(offsets, waveforms):
+        start = round(offset / timestep)
+        volumes.append(frame_rms[start: start + w.shape[0] // hop_size + 1])
+    return volumes
+
+
+def decode_note_volumes_by_dur(note_dur: np.ndarray, volume: np.ndarray, timestep: float) -> np.ndarray:
+    """
+    Average the frame-level volume over the frames of each note.
+    :param note_dur: [N], in seconds
+    :param volume: frame-level volume of the chunk
+    :return: note-level volume, [N]
+    """
+    note_end = np.round(np.cumsum(note_dur) / timestep).astype(np.int64)
+    note_start = np.concatenate(([0], note_end[:-1]))
+    csum = np.concatenate(([0.], np.cumsum(volume, dtype=np.float64)))
+    note_start = note_start.clip(max=volume.shape[0])
+    note_end = note_end.clip(max=volume.shape[0])
+    volume_cnt = note_end - note_start
+    volume_sum = csum[note_end] - csum[note_start]
+    return (volume_sum / (volume_cnt + (volume_cnt == 0))).astype(np.float32)
+
+
+def normalize_volumes(note_volume: np.ndarray, note_rest: np.ndarray) -> np.ndarray:
+    # Normalize Volume (0-1 range) over the non-rest notes
+    if note_rest.all():
+        return np.zeros_like(note_volume)
+    min_vol = note_volume[~note_rest].min()
+    max_vol = note_volume[~note_rest].max()
+    if max_vol > min_vol:
+        note_volume = np.clip((note_volume - min_vol) / (max_vol - min_vol), 0, 1)
+    else:
+        note_volume = np.full_like(note_volume, 0.5)
+    note_volume[note_rest] = 0
+    return note_volume
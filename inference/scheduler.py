@@ -0,0 +1,166 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class RequestTooLargeError(ValueError):
+    pass
+
+
+class _Chunk:
+    def __init__(self, waveform: np.ndarray, num_frames: int, volume: np.ndarray, future: asyncio.Future):
+        self.waveform = waveform
+        self.num_frames = num_frames
+        self.volume = volume
+        self.future = future
+
+
+class MicroBatchScheduler:
+    """
+        Dynamic micro-batching of the chunks of concurrent requests to one model.
+
+        Requests put their chunks into a bounded queue. The scheduler takes the first waiting chunk and keeps
+        collecting chunks for at most *max_wait* seconds, or until the batch is full (*max_batch_frames* padded
+        frames or *max_batch_size* chunks). The batch then runs through infer_batch() of the inference instance
+        on one of *num_workers* worker threads, so chunks of different requests share forward passes.
+        Requests whose chunks do not fit into the queue are rejected at once with QueueFullError, and the
+        scheduler stops collecting while all workers are busy, so a burst of requests cannot pile up
+        unbounded work. Requests with more chunks than the whole queue can never fit and are rejected with
+        RequestTooLargeError instead, so that clients do not retry them.
+    """
+
+    def __init__(
+            self, infer_ins, num_workers: int = 1, max_batch_frames: int = 4000, max_batch_size: int = 32,
+            max_wait: float = 0.01, max_queue_chunks: int = 256
+    ):
+        self.infer_ins = infer_ins
+        self.num_workers = num_workers
+        self.max_batch_frames = max_batch_frames
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_chunks = max_queue_chunks
+        self.stats = {'requests': 0, 'rejected': 0, 'chunks': 0, 'batches': 0}
+        self._queue: asyncio.Queue = None
+        self._batches: asyncio.Queue = None
+        self._carry: _Chunk = None
+        self._executor: ThreadPoolExecutor = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue_chunks)
+        # At most one batch waits for each worker; the scheduler blocks beyond that.
+        self._batches = asyncio.Queue(maxsize=self.num_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        self._tasks = [asyncio.create_task(self._schedule())] + [
+            asyncio.create_task(self._work()) for _ in range(self.num_workers)
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._executor.shutdown(wait=True)
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue.qsize() + (self._carry is not None)
+
+    async def infer(self, waveforms: List[np.ndarray], volumes: List[np.ndarray] = None) -> List[Dict[str, np.ndarray]]:
+        """
+        Same as infer_batch() of the inference instance, with the chunks batched together with those of
+        other requests.
+        :param volumes: (optional) frame-level RMS of each chunk used for velocity
+        """
+        if len(waveforms) > self._queue.maxsize:
+            self.stats['rejected'] += 1
+            raise RequestTooLargeError(
+                f'The request has {len(waveforms)} chunks, more than the queue can hold ({self._queue.maxsize}).'
+            )
+        if self._queue.maxsize - self._queue.qsize() < len(waveforms):
+            self.stats['rejected'] += 1
+            raise QueueFullError(f'The queue cannot take {len(waveforms)} more chunks.')
+        self.stats['requests'] += 1
+        loop = asyncio.get_running_loop()
+        futures = []
+        for i, w in enumerate(waveforms):
+            future = loop.create_future()
+            self._queue.put_nowait(_Chunk(
+                w, self.infer_ins.num_frames(w), None if volumes is None else volumes[i], future
+            ))
+            futures.append(future)
+        return list(await asyncio.gather(*futures))
+
+    def _fits(self, batch: List[_Chunk], chunk: _Chunk) -> bool:
+        if len(batch) >= self.max_batch_size:
+            return False
+        # Chunks longer than max_batch_frames still run, alone.
+        padded_frames = max(chunk.num_frames, max(c.num_frames for c in batch)) * (len(batch) + 1)
+        return padded_frames <= self.max_batch_frames
+
+    async def _get(self, timeout: float):
+        if timeout <= 0:
+            try:
+                return self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return None
+        get = asyncio.ensure_future(self._queue.get())
+        done, _ = await asyncio.wait({get}, timeout=timeout)
+        if not done:
+            get.cancel()
+            # The chunk may have arrived just before the cancellation.
+            await asyncio.wait({get})
+            if get.cancelled():
+                return None
+        return get.result()
+
+    async def _schedule(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._carry is not None:
+                batch, self._carry = [self._carry], None
+            else:
+                batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while True:
+                chunk = await self._get(deadline - loop.time())
+                if chunk is None:
+                    break
+                if not self._fits(batch, chunk):
+                    self._carry = chunk
+                    break
+                batch.append(chunk)
+            await self._batches.put(batch)
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._batches.get()
+            volumes = None
+            if any(c.volume is not None for c in batch):
+                # Chunks of requests without velocity get silent volumes, and their note volumes are dropped.
+                volumes = [
+                    np.zeros(c.num_frames, dtype=np.float32) if c.volume is None else c.volume for c in batch
+                ]
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self.infer_ins.infer_batch, [c.waveform for c in batch], volumes
+                )
+            except Exception as e:
+                for c in batch:
+                    if not c.future.done():
+                        c.future.set_exception(e)
+                continue
+            self.stats['chunks'] += len(batch)
+            self.stats['batches'] += 1
+            for c, res in zip(batch, results):
+                if c.volume is None:
+                    res.pop('note_volume', None)
+                if not c.future.done():
+                    c.future.set_result(res)
@@ -0,0 +1,88 @@
+from typing import Dict, List
+
+import numpy as np
+
+from .base_infer import BaseInference
+
+
+class StreamingInference:
+    """
+        Incremental MIDI extraction on top of an offline inference instance.
+
+        Audio blocks are appended to a buffer and the model is re-run over the buffer every *step*
+        seconds. Notes that end at least *lookahead* seconds before the end of the buffer are regarded
+        as stable: they are emitted and the buffer is cut at the end of the last emitted note, so the
+        next run starts right at a note boundary. If the buffer grows beyond *window* seconds without
+        any stable note, the first note is cut at the lookahead point to keep the buffer bounded.
+
+        The expected latency of a note is about lookahead + step + the time of one forward pass.
+        Larger lookahead and window give results closer to offline inference.
+    """
+
+    def __init__(self, infer_ins: BaseInference, window: float = 10., lookahead: float = 1., step: float = 0.5):
+        assert window > lookahead > 0., 'The following condition must be satisfied: window > lookahead > 0'
+        self.infer_ins = infer_ins
+        self.hop_size = infer_ins.config['hop_size']
+        self.timestep = infer_ins.timestep
+        self.window = round(window / self.timestep)
+        self.lookahead = round(lookahead / self.timestep)
+        self.step = round(step * infer_ins.config['audio_sample_rate'])
+        self.buffer = None
+        self.buffer_start = 0
+        self.pending = 0
+        self.reset()
+
+    def reset(self):
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.buffer_start = 0  # position of the buffer in frames
+        self.pending = 0  # number of samples received since the last run
+
+    def feed(self, block: np.ndarray) -> List[Dict[str, np.ndarray]]:
+        """
+        Append an audio block and return the notes that became stable.
+        :param block: float32[n_samples], at the sampling rate of the model
+        :return: list of segments, each containing 'offset' in seconds and the note arrays
+        """
+        self.buffer = np.concatenate((self.buffer, block.astype(np.float32)))
+        self.pending += block.shape[0]
+        if self.pending < self.step:
+            return []
+        self.pending = 0
+        return self._run(final=False)
+
+    def flush(self) -> List[Dict[str, np.ndarray]]:
+        """
+        Emit all remaining notes and reset the stream.
+        """
+        segments = self._run(final=True) if self.buffer.shape[0] > 0 else []
+        self.reset()
+        return segments
+
+    def _run(self, final: bool) -> List[Dict[str, np.ndarray]]:
+        model_in = self.infer_ins.collate([self.infer_ins.preprocess(self.buffer)])
+        res = self.infer_ins.postprocess(self.infer_ins.forward_model(model_in))[0]
+        note_end = np.round(np.cumsum(res['note_dur']) / self.timestep).astype(np.int64)
+        n_frames = self.buffer.shape[0] // self.hop_size
+        if final:
+            n_commit = note_end.shape[0]
+            commit_frames = n_frames + 1
+        else:
+            n_commit = int((note_end <= n_frames - self.lookahead).sum())
+            if n_commit > 0:
+                commit_frames = int(note_end[n_commit - 1])
+            elif n_frames > self.window:
+                # No boundary is stable within the window: cut the first note.
+                n_commit = 1
+                commit_frames = n_frames - self.lookahead
+                res['note_dur'][0] = commit_frames * self.timestep
+            else:
+                return []
+        segment = {
+            'offset': self.buffer_start * self.timestep,
+            'note_midi': res['note_midi'][:n_commit],
+            'note_dur': res['note_dur'][:n_commit],
+            'note_rest': res['note_rest'][:n_commit],
+        }
+        self.buffer = self.buffer[commit_frames * self.hop_size:]
+        self.buffer_start += commit_frames
+        return [segment]
@@ -1,13 +1,102 @@
 import numpy as np
 import librosa
 
+PITCHES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+# names of all major and minor keys
+KEYS = [p + ':maj' for p in PITCHES] + [p + ':min' for p in PITCHES]
+# Krumhansl-Schmuckler profiles of major and minor keys
+MAJ_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MIN_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+
+def key_profiles():
+    """
+    Profiles of all 24 keys in the order of KEYS, i.e. the major and minor profiles rotated to start on
+    each of the 12 pitches.
+    :return: [24, 12]
+    """
+    return np.stack([np.roll(MAJ_PROFILE, i) for i in range(12)] + [np.roll(MIN_PROFILE, i) for i in range(12)])
+
+
+_PROFILES = key_profiles()
+_PROFILES_NORMED = _PROFILES - _PROFILES.mean(axis=1, keepdims=True)
+_PROFILES_NORMED /= np.linalg.norm(_PROFILES_NORMED, axis=1, keepdims=True)
+
+
+def chroma(waveform, sr, hop_length=512):
+    """
+    Chromagram used for key detection; waveform should ideally be separated out from any percussive sources.
+    :return: [12, n_frames]
+    """
+    return librosa.feature.chroma_cqt(y=waveform, sr=sr, hop_length=hop_length, bins_per_octave=24)
+
+
+def key_correlations(chroma_vals):
+    """
+    Correlation coefficients between pitch class intensities and the profiles of all 24 keys,
+    computed for all inputs in a single matrix product.
+    :param chroma_vals: [..., 12]
+    :return: [..., 24] in the order of KEYS; 0 where the intensities are constant (e.g. silence)
+    """
+    x = np.asarray(chroma_vals, dtype=np.float64)
+    x = x - x.mean(axis=-1, keepdims=True)
+    norm = np.linalg.norm(x, axis=-1, keepdims=True)
+    return (x @ _PROFILES_NORMED.T) / np.where(norm > 0, norm, np.inf)
+
+
+def detect_key(chromagram):
+    """
+    Key of the whole chromagram.
+    :param chromagram: [12, n_frames]
+    """
+    return KEYS[int(np.argmax(key_correlations(chromagram.sum(axis=1))))]
+
+
+def track_keys(chromagram, sr, hop_length=512, window=10., step=2.):
+    """
+    Sliding-window key tracking from a single chromagram, for songs that modulate.
+    The chroma of each window is summed with a cumulative sum, and all windows are correlated with
+    all keys at the same time. Windows without any chroma keep the key of the previous window.
+    :param chromagram: [12, n_frames]
+    :param window: length of each window in seconds
+    :param step: distance between the centers of neighbouring windows in seconds
+    :return: start times of the sections in seconds and their keys; neighbouring windows of the same key
+        are merged into one section, and the first section starts at 0
+    """
+    n_frames = chromagram.shape[1]
+    if n_frames == 0:
+        return np.zeros(1), [KEYS[0]]
+    frame_time = hop_length / sr
+    half = max(int(round(window / frame_time / 2)), 1)
+    step = max(int(round(step / frame_time)), 1)
+    centers = np.arange(0, n_frames, step)
+    csum = np.concatenate((np.zeros((1, 12)), np.cumsum(chromagram.T, axis=0, dtype=np.float64)), axis=0)
+    starts = (centers - half).clip(min=0)
+    ends = (centers + half).clip(max=n_frames)
+    corrs = key_correlations(csum[ends] - csum[starts])  # [W, 24]
+    key_ids = corrs.argmax(axis=1)
+    valid = np.abs(corrs).max(axis=1) > 0
+    if not valid.any():
+        return np.zeros(1), [KEYS[0]]
+    # Windows without chroma take the key of the previous valid window (or the first valid one).
+    last_valid = np.maximum.accumulate(np.where(valid, np.arange(len(valid)), -1))
+    key_ids = key_ids[np.where(last_valid >= 0, last_valid, valid.argmax())]
+    # Each window covers the frames closest to its center.
+    boundaries = np.concatenate(([0], (centers[1:] + centers[:-1]) // 2))
+    changes = np.concatenate(([True], key_ids[1:] != key_ids[:-1]))
+    section_starts = boundaries[changes] * frame_time
+    section_starts[0] = 0.
+    return section_starts, [KEYS[k] for k in key_ids[changes]]
+
+
 # class that uses the librosa library to analyze the key that an mp3 is in
 # arguments:
 #     waveform: an mp3 file loaded by librosa, ideally separated out from any percussive sources
 #     sr: sampling rate of the mp3, which can be obtained when the file is read with librosa
 #     tstart and tend: the range in seconds of the file to be analyzed; default to the beginning and end of file if not specified
+#     chromograph: (optional) precomputed chroma() of the range, e.g. shared with track_keys()
 class Tonal_Fragment(object):
-    def __init__(self, waveform, sr, tstart=None, tend=None):
+    def __init__(self, waveform, sr, tstart=None, tend=None, chromograph=None):
         self.waveform = waveform
         self.sr = sr
         self.tstart = tstart
@@ -18,36 +107,25 @@ class Tonal_Fragment(object):
         if self.tend is not None:
             self.tend = librosa.time_to_samples(self.tend, sr=self.sr)
         self.y_segment = self.waveform[self.tstart:self.tend]
-        self.chromograph = librosa.feature.chroma_cqt(y=self.y_segment, sr=self.sr, bins_per_octave=24)
+        if chromograph is None:
+            chromograph = chroma(self.y_segment, self.sr)
+        self.chromograph = chromograph
         
         # chroma_vals is the amount of each pitch class present in this time interval
-        self.chroma_vals = []
-        for i in range(12):
-            self.chroma_vals.append(np.sum(self.chromograph[i]))
-        pitches = ['C','C#','D','D#','E','F','F#','G','G#','A','A#','B']
+        self.chroma_vals = self.chromograph.sum(axis=1)
         # dictionary relating pitch names to the associated intensity in the song
-        self.keyfreqs = {pitches[i]: self.chroma_vals[i] for i in range(12)} 
-        
-        keys = [pitches[i] + ':maj' for i in range(12)] + [pitches[i] + ':min' for i in range(12)]
+        self.keyfreqs = {PITCHES[i]: self.chroma_vals[i] for i in range(12)}
 
         # use of the Krumhansl-Schmuckler key-finding algorithm, which compares the chroma
         # data above to typical profiles of major and minor keys:
-        maj_profile = [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
-        min_profile = [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
-
-        # finds correlations between the amount of each pitch class in the time interval and the above profiles,
+        # finds correlations between the amount of each pitch class in the time interval and the profiles,
         # starting on each of the 12 pitches. then creates dict of the musical keys (major/minor) to the correlation
-        self.min_key_corrs = []
-        self.maj_key_corrs = []
-        for i in range(12):
-            key_test = [self.keyfreqs.get(pitches[(i + m)%12]) for m in range(12)]
-            # correlation coefficients (strengths of correlation for each key)
-            self.maj_key_corrs.append(round(np.corrcoef(maj_profile, key_test)[1,0], 3))
-            self.min_key_corrs.append(round(np.corrcoef(min_profile, key_test)[1,0], 3))
+        corrs = np.round(key_correlations(self.chroma_vals), 3)
+        self.maj_key_corrs = corrs[:12].tolist()
+        self.min_key_corrs = corrs[12:].tolist()
 
         # names of all major and minor keys
-        self.key_dict = {**{keys[i]: self.maj_key_corrs[i] for i in range(12)}, 
-                         **{keys[i+12]: self.min_key_corrs[i] for i in range(12)}}
+        self.key_dict = {KEYS[i]: corrs[i] for i in range(24)}
         
         # this attribute represents the key determined by the algorithm
         self.key = max(self.key_dict, key=self.key_dict.get)
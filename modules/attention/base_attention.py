@@ -1,4 +1,6 @@
 
+import contextlib
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -19,9 +21,14 @@ class Attention(nn.Module):
 
         self.to_out = nn.Sequential(nn.Linear(hidden_dim, dim, ),
                                     )
+        # Inference only: if window > 0, each block of `window` queries attends to the keys of the block
+        # and `window_overlap` frames on each side, so that memory is linear in the sequence length.
+        self.window = 0
+        self.window_overlap = 0
 
     def forward(self, q, kv=None, mask=None):
         # b, c, h, w = x.shape
+        self_attention = kv is None
         if kv is None:
             kv = q
         # q, kv = map(
@@ -35,12 +42,54 @@ class Attention(nn.Module):
             lambda t: rearrange(t, "b t (h c) -> b h t c", h=self.heads), (q, k, v)
         )
 
-        if mask is not None:
-            mask = mask.unsqueeze(1).unsqueeze(1)
-
-        with torch.backends.cuda.sdp_kernel(enable_math=False
-                                            ):
-            out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        if 0 < self.window < q.shape[2] and self_attention:
+            out = self.windowed_attention(q, k, v, mask=mask)
+        else:
+            if mask is not None:
+                mask = mask.unsqueeze(1).unsqueeze(1)
+            # The kernel selection only applies to CUDA; CPU always runs its own kernel.
+            # Flash attention does not take a mask, so the math kernel is allowed as a fallback with a mask.
+            with torch.backends.cuda.sdp_kernel(enable_math=mask is not None
+                                                ) if q.is_cuda else contextlib.nullcontext():
+                out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
 
         out = rearrange(out, "b h t c -> b t (h c) ", h=self.heads, )
         return self.to_out(out)
+
+    def windowed_attention(self, q, k, v, mask=None):
+        """
+        Block-local self-attention.
+        :param q, k, v: [B, H, T, C]
+        :param mask: [B, T] (optional) valid frames
+        :return: [B, H, T, C]
+        """
+        b, h, t, c = q.shape
+        window, overlap = self.window, self.window_overlap
+        n_blocks = (t + window - 1) // window
+        pad = n_blocks * window - t
+        span = window + 2 * overlap
+        if mask is None:
+            mask = torch.ones((b, t), dtype=torch.bool, device=q.device)
+        q = F.pad(q, (0, 0, 0, pad)).reshape(b, h, n_blocks, window, c)
+        k, v = map(
+            lambda x: F.pad(x, (0, 0, overlap, overlap + pad)).unfold(2, span, window).transpose(-1, -2), (k, v)
+        )  # [B, H, N, S, C]
+        mask = F.pad(mask, (overlap, overlap + pad), value=False).unfold(1, span, window)  # [B, N, S]
+        # Blocks inside the padding have no valid keys; let them attend to the padding instead of producing NaN.
+        mask = mask | ~mask.any(dim=-1, keepdim=True)
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask[:, None, :, None, :])
+        return out.reshape(b, h, n_blocks * window, c)[:, :, :t]
+
+
+def set_attention_window(model: nn.Module, window: int, overlap: int = 0) -> int:
+    """
+    Switch all Attention modules of a model to windowed attention (window > 0) or full attention (window = 0).
+    :return: number of modules changed
+    """
+    n_modules = 0
+    for module in model.modules():
+        if isinstance(module, Attention):
+            module.window = window
+            module.window_overlap = overlap
+            n_modules += 1
+    return n_modules
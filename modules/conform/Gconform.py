@@ -58,7 +58,7 @@ class conform_blocke(nn.Module):
 
 
         x = self.attdrop(self.att(self.norm2(x), mask=mask)) + x
-        x = self.conv(self.norm3(x)) + x
+        x = self.conv(self.norm3(x), mask=mask) + x
         x = self.ffn2(self.norm4(x)) * 0.5 + x
         return self.norm5(x)
 
@@ -79,9 +79,9 @@ class Gcf(nn.Module):
         self.glu1=nn.Sequential(nn.Linear(dim, dim*2),GLU(2) )
         self.glu2 = nn.Sequential(nn.Linear(dim, dim * 2), GLU(2))
 
-    def forward(self, midi,bound):
-        midi=self.att1(midi)
-        bound=self.att2(bound)
+    def forward(self, midi,bound, mask=None):
+        midi=self.att1(midi, mask=mask)
+        bound=self.att2(bound, mask=mask)
         midis=self.glu1(midi)
         bounds=self.glu2(bound)
         return midi+bounds,bound+midis
@@ -94,9 +94,13 @@ class Gmidi_conform(nn.Module):
                  conv_drop: float = 0.1,
                  ffn_latent_drop: float = 0.1,
                  ffn_out_drop: float = 0.1, attention_drop: float = 0.1, attention_heads: int = 4,
-                 attention_heads_dim: int = 64):
+                 attention_heads_dim: int = 64, mask_blocks: bool = False):
         super().__init__()
 
+        # If mask_blocks, the padding mask also reaches the attention and the depthwise convolution of every
+        # block, so that padded frames do not leak into valid ones. Off by default to keep the numerics of
+        # existing training configs; inference turns it on for padded batches (see BaseInference).
+        self.mask_blocks = mask_blocks
         self.inln = nn.Linear(indim, dim)
         self.inln1 = nn.Linear(indim, dim)
         self.outln = nn.Linear(dim, outdim)
@@ -125,12 +129,13 @@ class Gmidi_conform(nn.Module):
         x1=self.inln1(x1)
         if mask is not None:
             x = x.masked_fill(~mask.unsqueeze(-1), 0)
+        block_mask = mask if self.mask_blocks else None
         for idx, i in enumerate(self.cf_lay):
-            x,x1 = i(x,x1)
+            x,x1 = i(x,x1, mask=block_mask)
 
             if mask is not None:
                 x = x.masked_fill(~mask.unsqueeze(-1), 0)
-        x,x1=self.att1(x),self.att2(x1)
+        x,x1=self.att1(x, mask=block_mask),self.att2(x1, mask=block_mask)
 
         cutprp = self.cutheard(x1)
         midiout = self.outln(x)
@@ -60,12 +60,27 @@ class conform_conv(nn.Module):
                                          padding=0,
                                          bias=bias)
         self.drop=nn.Dropout(DropoutL) if DropoutL>0. else nn.Identity()
-    def forward(self,x):
+    def forward(self,x,mask=None):
         x=x.transpose(1,2)
         x=self.act1(self.pointwise_conv1(x))
+        if mask is not None:
+            # keep padded frames from leaking into valid ones through the depthwise kernel
+            x=x.masked_fill(~mask.unsqueeze(1),0)
         x=self.depthwise_conv (x)
         x=self.norm(x)
         x=self.act2(x)
         x=self.pointwise_conv2(x)
         return self.drop(x).transpose(1,2)
 
+    @torch.no_grad()
+    def fuse(self):
+        """
+        Inference only: fold the BatchNorm (a fixed affine transform in eval mode) into the depthwise
+        convolution, and run the GLU after pointwise_conv1 with the native kernel.
+        """
+        assert not self.training, 'conform_conv can only be fused in eval mode.'
+        if isinstance(self.norm, nn.BatchNorm1d):
+            self.depthwise_conv = torch.nn.utils.fusion.fuse_conv_bn_eval(self.depthwise_conv, self.norm)
+            self.norm = nn.Identity()
+        if isinstance(self.act1, GLU):
+            self.act1 = nn.GLU(dim=self.act1.dim)
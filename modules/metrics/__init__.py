@@ -1 +1,2 @@
+from .agreement import frame_agreement, notes_to_frames, songs_agreement
 from .midi_acc import MIDIAccuracy
@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def notes_to_frames(offsets, segments, timestep, n_frames) -> np.ndarray:
+    """
+    Render note segments to a frame-level MIDI curve; rest frames are set to -inf.
+    """
+    midi = np.full(n_frames, fill_value=-np.inf, dtype=np.float32)
+    for offset, segment in zip(offsets, segments):
+        note_end = offset / timestep + np.cumsum(segment['note_dur']) / timestep
+        note_start = note_end - segment['note_dur'] / timestep
+        for m, r, s, e in zip(segment['note_midi'], segment['note_rest'], note_start, note_end):
+            if not r:
+                midi[round(s): round(e)] = m
+    return midi
+
+
+def frame_agreement(midi_pred: np.ndarray, midi_ref: np.ndarray, tolerance: float = 0.5) -> int:
+    """
+    Number of frames on which two frame-level MIDI curves from notes_to_frames() agree: both are rest, or both
+    are notes within the tolerance. Unlike MIDIAccuracy, frames that are rest on both sides count as agreement,
+    so identical curves agree on all frames.
+    """
+    rest_pred = np.isinf(midi_pred)
+    rest_ref = np.isinf(midi_ref)
+    with np.errstate(invalid='ignore'):
+        close = np.abs(midi_pred - midi_ref) <= tolerance
+    return int(((rest_pred == rest_ref) & (rest_pred | close)).sum())
+
+
+def songs_agreement(songs, results, ref_results, timestep, tolerance: float = 0.5) -> float:
+    """
+    Frame-level agreement (see frame_agreement()) of the notes of several songs with reference notes.
+    :param songs: (offsets of the chunks, number of frames) of each song
+    :param results: note segments of the chunks of each song
+    :param ref_results: reference note segments of the chunks of each song
+    """
+    n_agree = n_total = 0
+    for (offsets, n_frames), segments, ref_segments in zip(songs, results, ref_results):
+        n_agree += frame_agreement(
+            notes_to_frames(offsets, segments, timestep, n_frames),
+            notes_to_frames(offsets, ref_segments, timestep, n_frames),
+            tolerance=tolerance
+        )
+        n_total += n_frames
+    return n_agree / n_total
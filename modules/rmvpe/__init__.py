@@ -1,5 +1,7 @@
 from .constants import *
 from .model import E2E0
-from .utils import to_local_average_f0, to_viterbi_f0
+from .utils import (
+    decode_local_average_f0, decode_viterbi_f0, to_local_average_f0, to_viterbi_f0, viterbi_decode
+)
 from .inference import RMVPE
 from .spec import MelSpectrogram
@@ -1,18 +1,29 @@
 import numpy as np
 import torch
 import torch.nn.functional as F
-from torchaudio.transforms import Resample
 
+from utils import batch_by_size
+from utils.dsp_kernels import resampler
 from utils.pitch_utils import interp_f0, resample_align_curve
 from .constants import *
 from .model import E2E0
 from .spec import MelSpectrogram
-from .utils import to_local_average_f0, to_viterbi_f0
+from .utils import decode_local_average_f0, decode_viterbi_f0, to_local_average_f0, to_viterbi_f0
 
 
 class RMVPE:
-    def __init__(self, model_path, hop_length=160, device=None):
-        self.resample_kernel = {}
+    def __init__(
+            self, model_path, hop_length=160, device=None, window_size=0, window_overlap=64, window_batch_size=4,
+            use_viterbi=False
+    ):
+        """
+        :param window_size: if positive, inputs longer than this number of frames are processed in overlapping
+            windows of this size, so that the peak memory of the model does not grow with the input length
+        :param window_overlap: number of frames shared by neighbouring windows, over which they are crossfaded
+        :param window_batch_size: number of windows in each forward pass
+        :param use_viterbi: decode the pitch of get_pitch() and get_pitch_batch() with Viterbi smoothing
+            instead of the local average
+        """
         if device is None:
             self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         else:
@@ -23,14 +34,68 @@ class RMVPE:
         self.mel_extractor = MelSpectrogram(
             N_MELS, SAMPLE_RATE, WINDOW_LENGTH, hop_length, None, MEL_FMIN, MEL_FMAX
         ).to(self.device)
+        # Windows are padded to a multiple of 32 frames anyway.
+        self.window_size = 32 * ((window_size - 1) // 32 + 1) if window_size > 0 else 0
+        self.window_overlap = min(window_overlap, self.window_size // 2)
+        self.window_batch_size = window_batch_size
+        self.use_viterbi = use_viterbi
 
     @torch.no_grad()
-    def mel2hidden(self, mel):
+    def mel2hidden(self, mel, lengths=None):
+        """
+        :param mel: [B, N_MELS, T]
+        :param lengths: (optional) numbers of valid frames of the items in a padded batch; the GRU runs over
+            each item padded to a multiple of 32 frames, the same as the item alone
+        """
         n_frames = mel.shape[-1]
         mel = F.pad(mel, (0, 32 * ((n_frames - 1) // 32 + 1) - n_frames), mode='constant')
-        hidden = self.model(mel)
+        if lengths is not None:
+            lengths = 32 * ((lengths - 1) // 32 + 1)
+        hidden = self.model(mel, lengths=lengths)
         return hidden[:, :n_frames]
 
+    @torch.no_grad()
+    def audio2hidden_windowed(self, audio):
+        """
+        Run the model over overlapping windows of fixed size, batched across windows, and stitch the hidden
+        states with linear crossfades over the overlaps. The mel spectrogram of each window is computed from
+        its own part of the audio, which gives the same frames as the mel spectrogram of the whole audio.
+        :param audio: [1, n_samples] at 16 kHz
+        :return: [1, n_frames, N_CLASS]
+        """
+        hop_length = self.mel_extractor.hop_length
+        n_frames = audio.shape[-1] // hop_length + 1
+        size, overlap = self.window_size, self.window_overlap
+        stride = size - overlap
+        # The last window starts before the last overlap, so every frame is covered.
+        starts = list(range(0, max(n_frames - overlap, 1), stride))
+        audio = F.pad(audio, (WINDOW_LENGTH // 2, (WINDOW_LENGTH + 1) // 2))
+        # Without overlap, the windows are simply concatenated.
+        fade_in = (torch.arange(overlap, device=self.device) + 0.5) / overlap if overlap > 0 else None
+        hidden = torch.zeros(1, n_frames, N_CLASS, device=self.device)
+        for i in range(0, len(starts), self.window_batch_size):
+            batch_starts = starts[i: i + self.window_batch_size]
+            mels = []
+            for start in batch_starts:
+                end = min(start + size, n_frames)
+                mel = self.mel_extractor(
+                    audio[:, start * hop_length: (end - 1) * hop_length + WINDOW_LENGTH], center=False
+                )
+                mels.append(F.pad(mel, (0, size - (end - start)), mode='constant'))
+            # The GRU of the last, partial window must not start its reverse pass from the padding.
+            lengths = torch.tensor([min(start + size, n_frames) - start for start in batch_starts], device=self.device)
+            batch_hidden = self.mel2hidden(torch.cat(mels, dim=0), lengths=lengths)  # [B, size, N_CLASS]
+            for start, h in zip(batch_starts, batch_hidden):
+                end = min(start + size, n_frames)
+                h = h[:end - start]
+                weight = torch.ones(end - start, device=self.device)
+                if overlap > 0 and start > 0:
+                    weight[:overlap] = fade_in
+                if overlap > 0 and end < n_frames:
+                    weight[-overlap:] = 1 - fade_in
+                hidden[0, start: end] += h * weight[:, None]
+        return hidden
+
     def decode(self, hidden, thred=0.03, use_viterbi=False):
         if use_viterbi:
             f0 = to_viterbi_f0(hidden, thred=thred)
@@ -38,23 +103,81 @@ class RMVPE:
             f0 = to_local_average_f0(hidden, thred=thred)
         return f0
 
+    def resample(self, audio, sample_rate):
+        """
+        :param audio: [B, n_samples] at sample_rate
+        :return: [B, n_samples'] at 16 kHz
+        """
+        if sample_rate == 16000:
+            return audio
+        return resampler(sample_rate, 16000, lowpass_filter_width=128, device=self.device)(audio)
+
     def infer_from_audio(self, audio, sample_rate=16000, thred=0.03, use_viterbi=False):
         audio = torch.from_numpy(audio).float().unsqueeze(0).to(self.device)
-        if sample_rate == 16000:
-            audio_res = audio
+        audio_res = self.resample(audio, sample_rate)
+        n_frames = audio_res.shape[-1] // self.mel_extractor.hop_length + 1
+        if 0 < self.window_size < n_frames:
+            hidden = self.audio2hidden_windowed(audio_res)
         else:
-            key_str = str(sample_rate)
-            if key_str not in self.resample_kernel:
-                self.resample_kernel[key_str] = Resample(sample_rate, 16000, lowpass_filter_width=128)
-            self.resample_kernel[key_str] = self.resample_kernel[key_str].to(self.device)
-            audio_res = self.resample_kernel[key_str](audio)
-        mel = self.mel_extractor(audio_res, center=True)
-        hidden = self.mel2hidden(mel)
+            mel = self.mel_extractor(audio_res, center=True)
+            hidden = self.mel2hidden(mel)
         f0 = self.decode(hidden, thred=thred, use_viterbi=use_viterbi)
         return f0
 
-    def get_pitch(self, waveform, sample_rate, hop_size, length, interp_uv=False):
-        f0 = self.infer_from_audio(waveform, sample_rate=sample_rate)
+    @torch.no_grad()
+    def infer_from_audio_batch(
+            self, audios, sample_rate=16000, thred=0.03, use_viterbi=False,
+            max_batch_frames=2000, max_batch_size=32
+    ):
+        """
+        Resample, mel-encode and run the model on a list of waveforms in batches.
+        The waveforms are sorted by length and zero-padded to a common length in each batch. Resampling, the
+        mel spectrogram and the GRU of each item are the same as those of the item alone, and the mel frames
+        after the end of each item are set to 0, the same padding as mel2hidden(). Only the convolutions near
+        the end of shorter items see a little more padding than they would alone.
+        Items longer than the window size of the windowed mode are processed one by one in that mode.
+        :param audios: list of 1-D waveforms at sample_rate
+        :param max_batch_frames: maximum number of padded frames (10 ms) in each batch
+        :param max_batch_size: maximum number of items in each batch
+        :return: list of f0 arrays at a hop of 10 ms
+        """
+        hop_length = self.mel_extractor.hop_length
+        # Number of frames of each item after resampling to 16 kHz.
+        n_frames = [-(-audio.shape[0] * 16000 // sample_rate) // hop_length + 1 for audio in audios]
+        results = [None] * len(audios)
+        indices = []
+        for i, audio in enumerate(audios):
+            if 0 < self.window_size < n_frames[i]:
+                results[i] = self.infer_from_audio(audio, sample_rate=sample_rate, thred=thred, use_viterbi=use_viterbi)
+            else:
+                indices.append(i)
+        indices.sort(key=lambda i: n_frames[i])
+        batches = batch_by_size(
+            indices, lambda i: min(n_frames[i], max_batch_frames),
+            max_batch_frames=max_batch_frames, max_batch_size=max_batch_size
+        )
+        for batch in batches:
+            max_length = max(audios[i].shape[0] for i in batch)
+            audio = torch.zeros(len(batch), max_length, dtype=torch.float32)
+            for j, i in enumerate(batch):
+                audio[j, :audios[i].shape[0]] = torch.from_numpy(audios[i]).float()
+            audio_res = self.resample(audio.to(self.device), sample_rate)
+            mel = self.mel_extractor(audio_res, center=True)  # [B, N_MELS, T]
+            lengths = torch.tensor([n_frames[i] for i in batch], device=self.device)
+            mel = mel.masked_fill(
+                torch.arange(mel.shape[-1], device=self.device)[None, None, :] >= lengths[:, None, None], 0
+            )
+            hidden = self.mel2hidden(mel, lengths=lengths)  # [B, T, N_CLASS]
+            if use_viterbi:
+                f0 = decode_viterbi_f0(hidden, lengths=lengths, thred=thred)
+            else:
+                f0 = decode_local_average_f0(hidden, thred=thred)
+            f0 = f0.cpu().numpy()
+            for j, i in enumerate(batch):
+                results[i] = f0[j, :n_frames[i]]
+        return results
+
+    def align_pitch(self, f0, sample_rate, hop_size, length, interp_uv=False):
         uv = f0 == 0
         f0, uv = interp_f0(f0, uv)
 
@@ -64,3 +187,21 @@ class RMVPE:
         if not interp_uv:
             f0_res[uv_res] = 0
         return f0_res, uv_res
+
+    def get_pitch(self, waveform, sample_rate, hop_size, length, interp_uv=False):
+        f0 = self.infer_from_audio(waveform, sample_rate=sample_rate, use_viterbi=self.use_viterbi)
+        return self.align_pitch(f0, sample_rate, hop_size, length, interp_uv=interp_uv)
+
+    def get_pitch_batch(self, waveforms, sample_rate, hop_size, lengths, interp_uv=False):
+        """
+        Batched version of get_pitch(); see infer_from_audio_batch().
+        :param waveforms: list of 1-D waveforms at sample_rate
+        :param hop_size: hop size of the returned curves in samples at sample_rate
+        :param lengths: number of frames of each returned curve
+        :return: list of (f0, uv)
+        """
+        f0s = self.infer_from_audio_batch(waveforms, sample_rate=sample_rate, use_viterbi=self.use_viterbi)
+        return [
+            self.align_pitch(f0, sample_rate, hop_size, length, interp_uv=interp_uv)
+            for f0, length in zip(f0s, lengths)
+        ]
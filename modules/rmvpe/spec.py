@@ -1,7 +1,8 @@
 import torch
 import numpy as np
 import torch.nn.functional as F
-from librosa.filters import mel
+
+from utils.dsp_kernels import hann_window, mel_basis
 
 
 class MelSpectrogram(torch.nn.Module):
@@ -17,18 +18,10 @@ class MelSpectrogram(torch.nn.Module):
             clamp=1e-5
     ):
         super().__init__()
-        n_fft = win_length if n_fft is None else n_fft
-        self.hann_window = {}
-        mel_basis = mel(
-            sr=sampling_rate,
-            n_fft=n_fft,
-            n_mels=n_mel_channels,
-            fmin=mel_fmin,
-            fmax=mel_fmax,
-            htk=True)
-        mel_basis = torch.from_numpy(mel_basis).float()
-        self.register_buffer("mel_basis", mel_basis)
+        # The mel basis and the windows are shared through utils.dsp_kernels instead of being module buffers.
         self.n_fft = win_length if n_fft is None else n_fft
+        self.mel_fmin = mel_fmin
+        self.mel_fmax = mel_fmax
         self.hop_length = hop_length
         self.win_length = win_length
         self.sampling_rate = sampling_rate
@@ -41,9 +34,6 @@ class MelSpectrogram(torch.nn.Module):
         win_length_new = int(np.round(self.win_length * factor))
         hop_length_new = int(np.round(self.hop_length * speed))
 
-        keyshift_key = str(keyshift) + '_' + str(audio.device)
-        if keyshift_key not in self.hann_window:
-            self.hann_window[keyshift_key] = torch.hann_window(win_length_new).to(audio.device)
         if center:
             pad_left = win_length_new // 2
             pad_right = (win_length_new + 1) // 2
@@ -54,7 +44,7 @@ class MelSpectrogram(torch.nn.Module):
             n_fft=n_fft_new,
             hop_length=hop_length_new,
             win_length=win_length_new,
-            window=self.hann_window[keyshift_key],
+            window=hann_window(win_length_new, device=audio.device),
             center=False,
             return_complex=True
         )
@@ -67,6 +57,10 @@ class MelSpectrogram(torch.nn.Module):
                 magnitude = F.pad(magnitude, (0, 0, 0, size - resize))
             magnitude = magnitude[:, :size, :] * self.win_length / win_length_new
 
-        mel_output = torch.matmul(self.mel_basis, magnitude)
+        basis = mel_basis(
+            self.sampling_rate, self.n_fft, self.n_mel_channels, fmin=self.mel_fmin, fmax=self.mel_fmax,
+            device=audio.device
+        )
+        mel_output = torch.matmul(basis, magnitude)
         log_mel_spec = torch.log(torch.clamp(mel_output, min=self.clamp))
         return log_mel_spec
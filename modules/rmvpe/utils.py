@@ -1,11 +1,16 @@
-import librosa
 import numpy as np
 import torch
+import torch.nn.functional as F
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 from .constants import *
 
 
-def to_local_average_f0(hidden, center=None, thred=0.03):
+def decode_local_average_f0(hidden, center=None, thred=0.03):
     idx = torch.arange(N_CLASS, device=hidden.device)[None, None, :]  # [B=1, T=1, N]
     idx_cents = idx * 20 + CONST  # [B=1, N]
     if center is None:
@@ -20,24 +25,139 @@ def to_local_average_f0(hidden, center=None, thred=0.03):
     f0 = 10 * 2 ** (cents / 1200)
     uv = hidden.max(dim=2)[0] < thred  # [B, T]
     f0 = f0 * ~uv
-    return f0.squeeze(0).cpu().numpy()
+    return f0
+
+
+def to_local_average_f0(hidden, center=None, thred=0.03):
+    return decode_local_average_f0(hidden, center=center, thred=thred).squeeze(0).cpu().numpy()
+
+
+def viterbi_transition_band(band=30, device='cpu'):
+    """
+    Log transition weights of the Viterbi decoding, max(band - |i - j|, 0) normalized over each row i.
+    :return: [N_CLASS, 2 * band - 1], the weight of the transition from state j + k - (band - 1) to state j
+        at [j, k], -inf for states out of range
+    """
+    key = (band, str(device))
+    if key not in viterbi_transition_band.cache:
+        offsets = torch.arange(-(band - 1), band, device=device)  # [K]
+        weights = (band - offsets.abs()).double()  # [K]
+        states = torch.arange(N_CLASS, device=device)
+        src = states[:, None] + offsets[None, :]  # [N, K], source state of each transition
+        valid = (src >= 0) & (src < N_CLASS)
+        # The row of source state i sums over its targets i - offset inside the range.
+        dst = states[:, None] - offsets[None, :]
+        row_sum = (weights[None, :] * ((dst >= 0) & (dst < N_CLASS))).sum(dim=1)  # [N]
+        log_trans = torch.log(weights[None, :] / row_sum[src.clamp(0, N_CLASS - 1)])
+        viterbi_transition_band.cache[key] = log_trans.masked_fill(~valid, -float('inf')).float()
+    return viterbi_transition_band.cache[key]
+
+
+viterbi_transition_band.cache = {}
+
+
+def _viterbi_banded_loop(log_prob, lengths, log_trans):
+    batch_size, n_frames, n_states = log_prob.shape
+    n_offsets = log_trans.shape[1]
+    half = n_offsets // 2
+    path = np.zeros((batch_size, n_frames), dtype=np.int64)
+    value = np.empty(n_states, dtype=np.float64)
+    new_value = np.empty(n_states, dtype=np.float64)
+    ptr = np.empty((n_frames, n_states), dtype=np.int64)
+    for b in range(batch_size):
+        length = lengths[b]
+        if length == 0:
+            continue
+        for j in range(n_states):
+            value[j] = log_prob[b, 0, j]
+        for t in range(1, length):
+            for j in range(n_states):
+                # Source states i = j + k - half inside the range.
+                k_start = max(half - j, 0)
+                k_end = min(n_states + half - j, n_offsets)
+                best_k = k_start
+                best = value[j + k_start - half] + log_trans[j, k_start]
+                for k in range(k_start + 1, k_end):
+                    v = value[j + k - half] + log_trans[j, k]
+                    if v > best:
+                        best = v
+                        best_k = k
+                ptr[t, j] = j + best_k - half
+                new_value[j] = best + log_prob[b, t, j]
+            value[:] = new_value
+        state = np.argmax(value)
+        for t in range(length - 1, -1, -1):
+            path[b, t] = state
+            state = ptr[t, state]
+    return path
+
+
+if numba is not None:
+    _viterbi_banded_loop = numba.njit(cache=True)(_viterbi_banded_loop)
+
+
+def _viterbi_banded_torch(log_prob, lengths, log_trans):
+    batch_size, n_frames, n_states = log_prob.shape
+    half = log_trans.shape[1] // 2
+    value = log_prob[:, 0]  # [B, N]
+    ptr = torch.zeros(n_frames, batch_size, n_states, dtype=torch.uint8, device=log_prob.device)
+    # padded[:, j + k] holds the value of source state j + k - half.
+    padded = torch.full((batch_size, n_states + 2 * half), -float('inf'), device=log_prob.device)
+    sources = padded.unfold(1, 2 * half + 1, 1)  # [B, N, K], a view of padded
+    for t in range(1, n_frames):
+        padded[:, half: half + n_states] = value
+        best, ptr[t] = (sources + log_trans).max(dim=2)
+        best = best + log_prob[:, t]
+        # Keep the values bounded in single precision; items that have ended keep their last values.
+        value = torch.where((t < lengths)[:, None], best - best.max(dim=1, keepdim=True)[0], value)
+
+    # Roll backward from the most likely last state of each item.
+    ptr = ptr.cpu().numpy()
+    lengths = lengths.cpu().numpy()
+    batch_idx = np.arange(batch_size)
+    state = value.argmax(dim=1).cpu().numpy()
+    path = np.zeros((batch_size, n_frames), dtype=np.int64)
+    for t in range(n_frames - 1, -1, -1):
+        active = t < lengths
+        path[active, t] = state[active]
+        if t > 0:
+            state = np.where(active, state + ptr[t, batch_idx, state].astype(np.int64) - half, state)
+    return path
+
+
+@torch.no_grad()
+def viterbi_decode(hidden, lengths=None, band=30):
+    """
+    Viterbi decoding of the most likely class path with the banded transition max(band - |i - j|, 0),
+    batched over items. The transitions outside the band are impossible, so each step only compares
+    2 * band - 1 source states instead of all N_CLASS. The path is the same as librosa.sequence.viterbi()
+    with the dense transition matrix, except where that prefers one of the zero transitions outside the band.
+    A compiled loop is used on CPU if numba is available; otherwise the decoding runs in torch on the
+    device of hidden.
+    :param hidden: [B, T, N_CLASS]
+    :param lengths: (optional) [B], numbers of valid frames of the items in a padded batch
+    :return: [B, T] class indices; frames after the end of each item are 0
+    """
+    batch_size, n_frames, _ = hidden.shape
+    log_trans = viterbi_transition_band(band, device=hidden.device)  # [N, K]
+    prob = hidden.float()
+    prob = prob / prob.sum(dim=2, keepdim=True)
+    log_prob = torch.log(prob + torch.finfo(prob.dtype).tiny)  # [B, T, N]
+    if lengths is None:
+        lengths = torch.full((batch_size,), n_frames, dtype=torch.long, device=hidden.device)
+    else:
+        lengths = torch.as_tensor(lengths, dtype=torch.long, device=hidden.device)
+    if numba is not None and log_prob.device.type == 'cpu':
+        path = _viterbi_banded_loop(log_prob.numpy(), lengths.numpy(), log_trans.double().numpy())
+    else:
+        path = _viterbi_banded_torch(log_prob, lengths, log_trans)
+    return torch.from_numpy(path).to(hidden.device)
+
+
+def decode_viterbi_f0(hidden, lengths=None, thred=0.03):
+    center = viterbi_decode(hidden, lengths=lengths).unsqueeze(-1)  # [B, T, 1]
+    return decode_local_average_f0(hidden, center=center, thred=thred)
 
 
 def to_viterbi_f0(hidden, thred=0.03):
-    # Create viterbi transition matrix
-    if not hasattr(to_viterbi_f0, 'transition'):
-        xx, yy = np.meshgrid(range(N_CLASS), range(N_CLASS))
-        transition = np.maximum(30 - abs(xx - yy), 0)
-        transition = transition / transition.sum(axis=1, keepdims=True)
-        to_viterbi_f0.transition = transition
-
-    # Convert to probability
-    prob = hidden.squeeze(0).cpu().numpy()
-    prob = prob.T
-    prob = prob / prob.sum(axis=0)
-
-    # Perform viterbi decoding
-    path = librosa.sequence.viterbi(prob, to_viterbi_f0.transition).astype(np.int64)
-    center = torch.from_numpy(path).unsqueeze(0).unsqueeze(-1).to(hidden.device)
-
-    return to_local_average_f0(hidden, center=center, thred=thred)
+    return decode_viterbi_f0(hidden, thred=thred).squeeze(0).cpu().numpy()
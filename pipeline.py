@@ -0,0 +1,188 @@
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+import librosa
+import numpy as np
+
+import keyfinder
+import pitch_correction_utils
+from compressor import vocal_compressor
+from utils.slicer2 import Slicer
+
+
+def sound_start(y, sr, threshold=0.01):
+    """
+    Index of the first sample of the first 25 ms frame whose RMS exceeds the threshold, 0 if there is none.
+    """
+    frame_length = int(sr * 0.025)  # 25ms frames
+    hop_length = int(sr * 0.010)  # 10ms hop
+    rms = librosa.feature.rms(y=y, frame_length=frame_length, hop_length=hop_length)[0]
+    # argmax gives the first frame that exceeds the threshold, or 0 if no frame does.
+    start_frame = int(np.argmax(rms > threshold))
+    return start_frame * hop_length
+
+
+def is_midi_extraction(infer_ins) -> bool:
+    # An instance of MIDIExtractionInference implies that its module is loaded. Checking the loaded modules
+    # first keeps the pipeline of the ONNX Runtime backend free of PyTorch.
+    me_infer = sys.modules.get('inference.me_infer')
+    return me_infer is not None and isinstance(infer_ins, me_infer.MIDIExtractionInference)
+
+
+# Detect the start of actual sound by finding where amplitude exceeds a threshold
+def detect_sound_start(y, sr, threshold=0.01):
+    return y[sound_start(y, sr, threshold=threshold):]
+
+
+class AnalysisPipeline:
+    """
+        Analysis of a single song shared by all stages of infer.py.
+
+        The audio is decoded once. Products that more than one stage needs are computed once for the
+        current waveform and cached. These are the sound start, the harmonic part, the chromagram and the
+        f0 curve. The cache is cleared whenever a stage replaces the waveform (compressor, autotune).
+        Autotune hands its corrected pitch to note extraction, so the pitch is extracted only once.
+        The time spent in each stage is recorded in `timings`.
+    """
+
+    def __init__(self, infer_ins, config: dict, waveform: np.ndarray = None):
+        self.infer_ins = infer_ins
+        self.config = config
+        self.sr = config['audio_sample_rate']
+        self.timings = OrderedDict()
+        self._products = {}
+        self._waveform = waveform
+        self._rmvpe = None
+
+    @property
+    def waveform(self) -> np.ndarray:
+        return self._waveform
+
+    @waveform.setter
+    def waveform(self, waveform: np.ndarray):
+        self._waveform = waveform
+        self._products.clear()
+
+    @contextmanager
+    def stage(self, name: str):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.) + time.time() - start_time
+
+    def _product(self, name: str, compute_fn: Callable):
+        if name not in self._products:
+            with self.stage(name):
+                self._products[name] = compute_fn()
+        return self._products[name]
+
+    def load(self, path):
+        with self.stage('load'):
+            self.waveform, _ = librosa.load(path, sr=self.sr, mono=True)
+        return self.waveform
+
+    def compress(self, **kwargs):
+        with self.stage('compress'):
+            self.waveform = vocal_compressor(y=self.waveform, sr=self.sr, **kwargs)
+
+    def sound_start(self) -> int:
+        return self._product('sound_start', lambda: sound_start(self.waveform, self.sr))
+
+    def harmonic(self) -> np.ndarray:
+        """
+        Harmonic part of the song from its sound start; the percussive part is not needed and not synthesized.
+        """
+        return self._product('hpss', lambda: librosa.effects.harmonic(self.waveform[self.sound_start():]))
+
+    def chroma(self) -> np.ndarray:
+        return self._product('chroma', lambda: keyfinder.chroma(self.harmonic(), self.sr))
+
+    def detect_key(self) -> str:
+        harmonic = self.harmonic()
+        chromagram = self.chroma()
+        with self.stage('key'):
+            return keyfinder.Tonal_Fragment(
+                harmonic, self.sr, tstart=0, tend=harmonic.shape[0] / self.sr, chromograph=chromagram
+            ).get_key()
+
+    def track_keys(self, window: float):
+        """
+        :return: start times of the key sections in seconds from the beginning of the song, and their keys
+        """
+        chromagram = self.chroma()
+        with self.stage('key'):
+            section_starts, keys = keyfinder.track_keys(chromagram, self.sr, window=window, step=window / 4)
+        # The key track starts at the detected start of sound.
+        section_starts = section_starts + self.sound_start() / self.sr
+        section_starts[0] = 0.
+        return section_starts, keys
+
+    def get_rmvpe(self):
+        if is_midi_extraction(self.infer_ins):
+            return self.infer_ins.get_rmvpe()
+        if self._rmvpe is None:
+            import modules.rmvpe
+            self._rmvpe = modules.rmvpe.RMVPE(
+                self.config['pe_ckpt'], window_size=self.config.get('pe_window_size', 0),
+                window_overlap=self.config.get('pe_window_overlap', 64),
+                use_viterbi=self.config.get('pe_viterbi', False)
+            )
+        return self._rmvpe
+
+    def f0_uv(self):
+        """
+        RMVPE pitch of the whole song on the frames of the model; unvoiced frames are interpolated.
+        """
+        from utils.binarizer_utils import get_pitch_rmvpe
+
+        return self._product('f0', lambda: get_pitch_rmvpe(
+            self.get_rmvpe(), self.waveform, sample_rate=self.sr, hop_size=self.config['hop_size'],
+            length=self.waveform.shape[0] // self.config['hop_size'] + 1, interp_uv=True
+        ))
+
+    def autotune(self, correction_function, pitch: str = 'rmvpe'):
+        """
+        :param correction_function: maps the pitch in Hz (NaN for unvoiced frames) to the target pitch
+        :param pitch: rmvpe or pyin; see autotune_hop_length() for the hop size of the pitch
+        """
+        if pitch == 'rmvpe':
+            f0, uv = self.f0_uv()
+            with self.stage('autotune'):
+                waveform, corrected_f0 = pitch_correction_utils.autotune(
+                    self.waveform, self.sr, correction_function,
+                    f0=np.where(uv, np.nan, f0), hop_length=self.config['hop_size'], return_f0=True
+                )
+            self.waveform = waveform.astype(np.float32)
+            if is_midi_extraction(self.infer_ins) and self.config['pe'] == 'rmvpe':
+                # The corrected audio follows the corrected pitch, so the model reuses it instead of extracting
+                # the pitch again. Unvoiced frames keep the interpolated pitch, the same as the extractor.
+                self._products['model_f0'] = np.where(np.isnan(corrected_f0), f0, corrected_f0).astype(np.float32)
+        else:
+            with self.stage('autotune'):
+                waveform = pitch_correction_utils.autotune(self.waveform, self.sr, correction_function)
+            self.waveform = waveform.astype(np.float32)
+
+    def autotune_hop_length(self, pitch: str = 'rmvpe') -> int:
+        return self.config['hop_size'] if pitch == 'rmvpe' else pitch_correction_utils.HOP_LENGTH
+
+    def chunks(self) -> List[dict]:
+        return self._product('slice', lambda: Slicer(sr=self.sr, max_sil_kept=1000).slice(self.waveform))
+
+    def infer(self, velocity: bool = False, max_batch_frames: int = 0) -> List[Dict[str, np.ndarray]]:
+        chunks = self.chunks()
+        with self.stage('infer'):
+            return self.infer_ins.infer(
+                [c['waveform'] for c in chunks], waveform=self.waveform if velocity else None,
+                offsets=[c['offset'] for c in chunks], max_batch_frames=max_batch_frames,
+                f0=self._products.get('model_f0')
+            )
+
+    def print_timings(self):
+        total = sum(self.timings.values())
+        for name, elapsed in self.timings.items():
+            print(f'| {name}: {elapsed:.3f} s ({elapsed / total * 100:.1f}%)')
+        print(f'| total: {total:.3f} s')
@@ -1,7 +1,7 @@
 # Taken from this AMAZING blogpost by https://github.com/JanWilczek:
 # https://thewolfsound.com/how-to-auto-tune-your-voice-with-python/
 
-from functools import partial
+from functools import lru_cache, partial
 from pathlib import Path
 import argparse
 import librosa
@@ -14,6 +14,9 @@ import psola
 
 
 SEMITONES_IN_OCTAVE = 12
+# Frame and hop sizes of PYIN in autotune().
+FRAME_LENGTH = 2048
+HOP_LENGTH = FRAME_LENGTH // 4
 
 
 def degrees_from(scale: str):
@@ -56,33 +59,113 @@ def closest_pitch_from_scale(f0, scale):
     return librosa.midi_to_hz(midi_note)
 
 
-def aclosest_pitch_from_scale(f0, scale):
-    """Map each pitch in the f0 array to the closest pitch belonging to the given scale."""
-    sanitized_pitch = np.zeros_like(f0)
-    for i in np.arange(f0.shape[0]):
-        sanitized_pitch[i] = closest_pitch_from_scale(f0[i], scale)
-    # Perform median filtering to additionally smooth the corrected pitch.
-    smoothed_sanitized_pitch = sig.medfilt(sanitized_pitch, kernel_size=11)
+class ScaleQuantizer:
+    """Snap pitch curves to the closest pitches of a scale.
+
+    The degree table of the scale is computed once, and all frames of a curve are snapped at the
+    same time by broadcasting them against the table. NaN values (unvoiced frames) are preserved.
+    """
+
+    def __init__(self, scale: str):
+        self.scale = scale
+        self.degrees = degrees_from(scale)
+
+    def snap_midi(self, midi_note):
+        """Return the MIDI notes closest to the given (real-valued) MIDI notes that belong to the scale"""
+        midi_note = np.asarray(midi_note, dtype=np.float64)
+        nan_indices = np.isnan(midi_note)
+        # Real-valued pitch classes of the input pitches.
+        degree = midi_note % SEMITONES_IN_OCTAVE
+        # Find the closest pitch class from the scale for every frame. The first one wins on ties,
+        # the same as np.argmin in closest_pitch_from_scale.
+        degree_id = np.argmin(np.abs(self.degrees - degree[..., None]), axis=-1)
+        snapped = midi_note - (degree - self.degrees[degree_id])
+        snapped[nan_indices] = np.nan
+        return snapped
+
+    def snap(self, f0):
+        """Map each pitch in the f0 array (in Hz) to the closest pitch belonging to the scale"""
+        f0 = np.asarray(f0)
+        with np.errstate(invalid='ignore'):
+            midi_note = librosa.hz_to_midi(f0)
+        return librosa.midi_to_hz(self.snap_midi(midi_note))
+
+    def __call__(self, f0, kernel_size=11):
+        """Snap the f0 array to the scale and smooth the result with a median filter"""
+        return median_smooth(self.snap(f0), kernel_size=kernel_size)
+
+
+@lru_cache(maxsize=64)
+def get_scale_quantizer(scale: str) -> ScaleQuantizer:
+    """Return a cached ScaleQuantizer of the given scale, shared across calls and files"""
+    return ScaleQuantizer(scale)
+
+
+def median_smooth(pitch, kernel_size=11):
+    """Perform median filtering to additionally smooth the corrected pitch."""
+    smoothed_pitch = sig.medfilt(pitch, kernel_size=kernel_size)
     # Remove the additional NaN values after median filtering.
-    smoothed_sanitized_pitch[np.isnan(smoothed_sanitized_pitch)] = \
-        sanitized_pitch[np.isnan(smoothed_sanitized_pitch)]
-    return smoothed_sanitized_pitch
+    smoothed_pitch[np.isnan(smoothed_pitch)] = pitch[np.isnan(smoothed_pitch)]
+    return smoothed_pitch
 
 
-def autotune(audio, sr, correction_function, plot=False):
-    # Set some basis parameters.
-    frame_length = 2048
-    hop_length = frame_length // 4
-    fmin = librosa.note_to_hz('C2')
-    fmax = librosa.note_to_hz('C7')
+def aclosest_pitch_from_scale(f0, scale):
+    """Map each pitch in the f0 array to the closest pitch belonging to the given scale."""
+    return get_scale_quantizer(scale)(f0)
 
-    # Pitch tracking using the PYIN algorithm.
+
+def pyin_f0(audio, sr, frame_length=2048, hop_length=512, fmin=None, fmax=None):
+    """Track the pitch with the PYIN algorithm; unvoiced frames are NaN"""
     f0, voiced_flag, voiced_probabilities = librosa.pyin(audio,
                                                          frame_length=frame_length,
                                                          hop_length=hop_length,
                                                          sr=sr,
                                                          fmin=fmin,
                                                          fmax=fmax)
+    return f0
+
+
+def aclosest_pitch_from_key_track(f0, section_starts, scales, frame_time):
+    """Map each pitch in the f0 array to the closest pitch belonging to the scale of its section.
+
+    Args:
+        section_starts (np.ndarray): Start times of the sections in seconds, in ascending order, e.g. from
+            keyfinder.track_keys().
+        scales (list): Scale of each section.
+        frame_time (float): Hop size of `f0` in seconds.
+    """
+    f0 = np.asarray(f0)
+    times = np.arange(f0.shape[0]) * frame_time
+    section = (np.searchsorted(section_starts, times, side='right') - 1).clip(min=0)
+    scales = np.asarray(scales)
+    frame_scales = scales[section]
+    sanitized_pitch = np.empty(f0.shape, dtype=np.float64)
+    for scale in np.unique(scales):
+        frames = frame_scales == scale
+        sanitized_pitch[frames] = get_scale_quantizer(str(scale)).snap(f0[frames])
+    return median_smooth(sanitized_pitch)
+
+
+def autotune(audio, sr, correction_function, plot=False, f0=None, hop_length=None, return_f0=False):
+    """Pitch-correct the audio with PSOLA.
+
+    Args:
+        f0 (np.ndarray, optional): Pitch of the audio in Hz with NaN for unvoiced frames, e.g. from the pitch
+            extractor of the inference model. Tracked with PYIN if not given.
+        hop_length (int, optional): Hop size of `f0` in samples. Required if `f0` is given.
+        return_f0 (bool, optional): Also return the corrected pitch.
+    """
+    # Set some basis parameters.
+    frame_length = FRAME_LENGTH
+    fmin = librosa.note_to_hz('C2')
+    fmax = librosa.note_to_hz('C7')
+
+    if f0 is None:
+        # Pitch tracking using the PYIN algorithm.
+        hop_length = HOP_LENGTH
+        f0 = pyin_f0(audio, sr, frame_length=frame_length, hop_length=hop_length, fmin=fmin, fmax=fmax)
+    else:
+        assert hop_length is not None, 'The hop size of the given f0 must be specified.'
 
     # Apply the chosen adjustment strategy to the pitch.
     corrected_f0 = correction_function(f0)
@@ -90,11 +173,11 @@ def autotune(audio, sr, correction_function, plot=False):
     if plot:
         # Plot the spectrogram, overlaid with the original pitch trajectory and the adjusted
         # pitch trajectory.
-        stft = librosa.stft(audio, n_fft=frame_length, hop_length=hop_length)
-        time_points = librosa.times_like(stft, sr=sr, hop_length=hop_length)
+        stft = librosa.stft(audio, n_fft=frame_length, hop_length=HOP_LENGTH)
+        time_points = librosa.times_like(f0, sr=sr, hop_length=hop_length)
         log_stft = librosa.amplitude_to_db(np.abs(stft), ref=np.max)
         fig, ax = plt.subplots()
-        img = librosa.display.specshow(log_stft, x_axis='time', y_axis='log', ax=ax, sr=sr, hop_length=hop_length, fmin=fmin, fmax=fmax)
+        img = librosa.display.specshow(log_stft, x_axis='time', y_axis='log', ax=ax, sr=sr, hop_length=HOP_LENGTH, fmin=fmin, fmax=fmax)
         fig.colorbar(img, ax=ax, format="%+2.f dB")
         ax.plot(time_points, f0, label='original pitch', color='cyan', linewidth=2)
         ax.plot(time_points, corrected_f0, label='corrected pitch', color='orange', linewidth=1)
@@ -104,7 +187,11 @@ def autotune(audio, sr, correction_function, plot=False):
         plt.savefig('pitch_correction.png', dpi=300, bbox_inches='tight')
 
     # Pitch-shifting using the PSOLA algorithm.
-    return psola.vocode(audio, sample_rate=int(sr), target_pitch=corrected_f0, fmin=fmin, fmax=fmax)
+    # The target pitch is spread evenly over the duration of the audio, so any hop size works.
+    corrected_audio = psola.vocode(audio, sample_rate=int(sr), target_pitch=corrected_f0, fmin=fmin, fmax=fmax)
+    if return_f0:
+        return corrected_audio, corrected_f0
+    return corrected_audio
 
 
 def main(
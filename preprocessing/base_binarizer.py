@@ -7,7 +7,7 @@ import numpy as np
 import torch
 from tqdm import tqdm
 
-from utils.indexed_datasets import IndexedDatasetBuilder
+from utils.indexed_datasets import MMapIndexedDatasetBuilder
 from utils.multiprocess_utils import chunked_multiprocess_run
 
 
@@ -22,6 +22,8 @@ class BaseBinarizer:
             process entire data, generate the train-test split (support parallel processing);
         2. *process_item*:
             process singe piece of data;
+           *process_items*:
+            process a group of data at once (binarization_args.batch_size), e.g. to batch the model inference;
         3. *get_pitch*:
             infer the pitch using some algorithm;
         4. *get_align*:
@@ -156,7 +158,7 @@ class BaseBinarizer:
 
     def process_dataset(self, prefix, num_workers=0, apply_augmentation=False):
         args = []
-        builder = IndexedDatasetBuilder(self.binary_data_dir, prefix=prefix, allowed_attr=self.data_attrs)
+        builder = MMapIndexedDatasetBuilder(self.binary_data_dir, prefix=prefix, allowed_attr=self.data_attrs)
         lengths = []
         total_sec = 0
         total_raw_sec = 0
@@ -174,21 +176,23 @@ class BaseBinarizer:
             if _is_raw:
                 total_raw_sec += _item['seconds']
 
+        # Items are processed in groups of batch_size by process_items().
+        batch_size = int(self.binarization_args.get('batch_size', 1))
+        groups = [args[i: i + batch_size] for i in range(0, len(args), batch_size)]
         try:
-            if num_workers > 0:
-                # code for parallel processing
-                for items in tqdm(
-                        chunked_multiprocess_run(self.process_item, args, num_workers=num_workers),
-                        total=len(list(self.meta_data_iterator(prefix)))
-                ):
-                    for i, item in enumerate(items):
-                        postprocess(item, i == 0)
-            else:
-                # code for single cpu processing
-                for a in tqdm(args):
-                    items = self.process_item(*a)
-                    for i, item in enumerate(items):
-                        postprocess(item, i == 0)
+            with tqdm(total=len(args)) as progress:
+                if num_workers > 0:
+                    # code for parallel processing
+                    results = chunked_multiprocess_run(self.process_items, [[g] for g in groups], num_workers=num_workers)
+                else:
+                    # code for single cpu processing
+                    results = (self.process_items(g) for g in groups)
+                for group, group_items in zip(groups, results):
+                    if group_items is not None:
+                        for items in group_items:
+                            for i, item in enumerate(items):
+                                postprocess(item, i == 0)
+                    progress.update(len(group))
         except KeyboardInterrupt:
             builder.finalize()
             raise
@@ -205,5 +209,8 @@ class BaseBinarizer:
         else:
             print(f'| {prefix} total duration: {total_raw_sec:.2f}s')
 
+    def process_items(self, args):
+        return [self.process_item(*a) for a in args]
+
     def process_item(self, item_name, meta_data, allow_aug=False):
         raise NotImplementedError()
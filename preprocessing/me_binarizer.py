@@ -13,8 +13,10 @@ from scipy import interpolate
 import modules.contentvec
 import modules.rmvpe
 from modules.commons import LengthRegulator
-from utils.binarizer_utils import merge_slurs, merge_rests, get_mel2ph_torch, get_pitch_parselmouth
-from utils.pitch_utils import resample_align_curve
+from utils.binarizer_utils import (
+    merge_slurs, merge_rests, get_mel2ph_torch, get_pitch_parselmouth, get_pitch_rmvpe, get_pitch_rmvpe_batch
+)
+from utils.feature_cache import build_feature_cache, f0_cache_params, units_cache_params
 from utils.plot import distribution_to_figure
 from .base_binarizer import BaseBinarizer
 
@@ -45,6 +47,7 @@ class MIDIExtractionBinarizer(BaseBinarizer):
         self.slur_tolerance = self.binarization_args.get('slur_tolerance')
         self.round_midi = self.binarization_args.get('round_midi', False)
         self.key_shift_min, self.key_shift_max = self.config['key_shift_range']
+        self.feature_cache = build_feature_cache(self.config)
 
     def load_meta_data(self, raw_data_dir: pathlib.Path, ds_id):
         meta_data_dict = {}
@@ -143,14 +146,15 @@ class MIDIExtractionBinarizer(BaseBinarizer):
                     pad_inches=0.25)
         print(f'| save summary to \'{filename}\'')
 
-    def _process_item(self, waveform, meta_data, int_midi=False):
-        wav_tensor = torch.from_numpy(waveform).to(self.device)
+    def get_units(self, waveform, key_shift=0):
         units_encoder = self.config['units_encoder']
+        wav_tensor = torch.from_numpy(waveform).to(self.device)
         if units_encoder == 'contentvec768l12':
+            assert key_shift == 0, 'Key shift is only supported by the mel units encoder.'
             global contentvec
             if contentvec is None:
                 contentvec = modules.contentvec.ContentVec768L12(self.config['units_encoder_ckpt'], device=self.device)
-            units = contentvec(wav_tensor).squeeze(0).cpu().numpy()
+            return contentvec(wav_tensor).squeeze(0).cpu().numpy()
         elif units_encoder == 'mel':
             global mel_spec
             if mel_spec is None:
@@ -159,19 +163,22 @@ class MIDIExtractionBinarizer(BaseBinarizer):
                     win_length=self.config['win_size'], hop_length=self.config['hop_size'],
                     mel_fmin=self.config['fmin'], mel_fmax=self.config['fmax']
                 ).to(self.device)
-            units = mel_spec(wav_tensor.unsqueeze(0)).transpose(1, 2).squeeze(0).cpu().numpy()
+            return mel_spec(wav_tensor.unsqueeze(0), keyshift=key_shift).transpose(1, 2).squeeze(0).cpu().numpy()
         else:
             raise NotImplementedError(f'Invalid units encoder: {units_encoder}')
-        assert len(units.shape) == 2 and units.shape[1] == self.config['units_dim'], \
-            f'Shape of units must be [T, units_dim], but is {units.shape}.'
-        length = units.shape[0]
-        seconds = length * self.config['hop_size'] / self.config['audio_sample_rate']
-        processed_input = {
-            'seconds': seconds,
-            'length': length,
-            'units': units
-        }
 
+    def get_rmvpe(self):
+        global rmvpe
+        if rmvpe is None:
+            rmvpe = modules.rmvpe.RMVPE(
+                self.config['pe_ckpt'], device=self.device,
+                window_size=self.config.get('pe_window_size', 0),
+                window_overlap=self.config.get('pe_window_overlap', 64),
+                use_viterbi=self.config.get('pe_viterbi', False)
+            )
+        return rmvpe
+
+    def get_f0(self, waveform, length):
         f0_algo = self.config['pe']
         if f0_algo == 'parselmouth':
             f0, _ = get_pitch_parselmouth(
@@ -179,23 +186,84 @@ class MIDIExtractionBinarizer(BaseBinarizer):
                 hop_size=self.config['hop_size'], length=length, interp_uv=True
             )
         elif f0_algo == 'rmvpe':
-            global rmvpe
-            if rmvpe is None:
-                rmvpe = modules.rmvpe.RMVPE(self.config['pe_ckpt'], device=self.device)
-            f0, _ = rmvpe.get_pitch(
-                waveform, sample_rate=self.config['audio_sample_rate'],
-                hop_size=rmvpe.mel_extractor.hop_length,
-                length=(waveform.shape[0] + rmvpe.mel_extractor.hop_length - 1) // rmvpe.mel_extractor.hop_length,
-                interp_uv=True
-            )
-            f0 = resample_align_curve(
-                f0,
-                original_timestep=rmvpe.mel_extractor.hop_length / self.config['audio_sample_rate'],
-                target_timestep=self.config['hop_size'] / self.config['audio_sample_rate'],
-                align_length=length
+            f0, _ = get_pitch_rmvpe(
+                self.get_rmvpe(), waveform, sample_rate=self.config['audio_sample_rate'],
+                hop_size=self.config['hop_size'], length=length, interp_uv=True
             )
         else:
             raise NotImplementedError(f'Invalid pitch extractor: {f0_algo}')
+        return f0
+
+    def get_f0_batch(self, waveforms):
+        """
+        f0 of a group of waveforms, with RMVPE batched across the group.
+        The number of frames must be known before the units are computed, so this is only available with the
+        mel units encoder; None is returned for the items that are not extracted here.
+        """
+        if self.config['pe'] != 'rmvpe' or self.config['units_encoder'] != 'mel':
+            return [None] * len(waveforms)
+        lengths = [w.shape[0] // self.config['hop_size'] + 1 for w in waveforms]
+        f0s = [None] * len(waveforms)
+        keys = [None] * len(waveforms)
+        if self.feature_cache is not None:
+            for i, (waveform, length) in enumerate(zip(waveforms, lengths)):
+                keys[i] = self.feature_cache.make_key(
+                    self.feature_cache.hash_audio(waveform), 'f0', **f0_cache_params(self.config), length=length
+                )
+                f0 = self.feature_cache.get(keys[i])
+                if f0 is not None:
+                    f0s[i] = np.array(f0)
+        missing = [i for i in range(len(waveforms)) if f0s[i] is None]
+        if len(missing) == 0:
+            return f0s
+        results = get_pitch_rmvpe_batch(
+            self.get_rmvpe(), [waveforms[i] for i in missing], sample_rate=self.config['audio_sample_rate'],
+            hop_size=self.config['hop_size'], lengths=[lengths[i] for i in missing], interp_uv=True
+        )
+        for i, (f0, _) in zip(missing, results):
+            if self.feature_cache is not None:
+                self.feature_cache.put(keys[i], f0)
+            f0s[i] = f0
+        return f0s
+
+    def get_cached_units(self, waveform, audio_hash=None, key_shift=0):
+        if self.feature_cache is None:
+            return self.get_units(waveform, key_shift=key_shift)
+        if audio_hash is None:
+            audio_hash = self.feature_cache.hash_audio(waveform)
+        key = self.feature_cache.make_key(
+            audio_hash, 'units', **units_cache_params(self.config), key_shift=key_shift
+        )
+        return np.array(self.feature_cache.get_or_compute(key, lambda: self.get_units(waveform, key_shift=key_shift)))
+
+    def get_cached_f0(self, waveform, length, audio_hash=None):
+        if self.feature_cache is None:
+            return self.get_f0(waveform, length)
+        if audio_hash is None:
+            audio_hash = self.feature_cache.hash_audio(waveform)
+        key = self.feature_cache.make_key(audio_hash, 'f0', **f0_cache_params(self.config), length=length)
+        return np.array(self.feature_cache.get_or_compute(key, lambda: self.get_f0(waveform, length)))
+
+    def hash_waveform(self, waveform):
+        return self.feature_cache.hash_audio(waveform) if self.feature_cache is not None else None
+
+    def _process_item(self, waveform, meta_data, int_midi=False, f0=None, audio_hash=None):
+        if audio_hash is None:
+            audio_hash = self.hash_waveform(waveform)
+        units = self.get_cached_units(waveform, audio_hash=audio_hash)
+        assert len(units.shape) == 2 and units.shape[1] == self.config['units_dim'], \
+            f'Shape of units must be [T, units_dim], but is {units.shape}.'
+        length = units.shape[0]
+        seconds = length * self.config['hop_size'] / self.config['audio_sample_rate']
+        processed_input = {
+            'seconds': seconds,
+            'length': length,
+            'units': units
+        }
+
+        if f0 is None:
+            f0 = self.get_cached_f0(waveform, length, audio_hash=audio_hash)
+        assert f0.shape[0] == length, f'Length of f0 ({f0.shape[0]}) does not match the units ({length}).'
         pitch = librosa.hz_to_midi(f0)
         processed_input['pitch'] = pitch
 
@@ -222,26 +290,44 @@ class MIDIExtractionBinarizer(BaseBinarizer):
         processed_input['unit2note'] = unit2note.cpu().numpy()
         return processed_input
 
-    @torch.no_grad()
-    def process_item(self, item_name, meta_data, allow_aug=False):
+    def load_waveform(self, meta_data):
         waveform, _ = librosa.load(meta_data['wav_fn'], sr=self.config['audio_sample_rate'], mono=True)
+        return waveform
+
+    @torch.no_grad()
+    def process_items(self, args):
+        # The pitch of the whole group is extracted in batches before the items are processed one by one.
+        waveforms = [self.load_waveform(meta_data) for _, meta_data, _ in args]
+        f0s = self.get_f0_batch(waveforms)
+        return [
+            self.process_item(item_name, meta_data, allow_aug=allow_aug, waveform=waveform, f0=f0)
+            for (item_name, meta_data, allow_aug), waveform, f0 in zip(args, waveforms, f0s)
+        ]
 
-        processed_input = self._process_item(waveform, meta_data, int_midi=False)
+    @torch.no_grad()
+    def process_item(self, item_name, meta_data, allow_aug=False, waveform=None, f0=None):
+        if waveform is None:
+            waveform = self.load_waveform(meta_data)
+
+        audio_hash = self.hash_waveform(waveform)
+        processed_input = self._process_item(waveform, meta_data, int_midi=False, f0=f0, audio_hash=audio_hash)
         items = [processed_input]
         if not allow_aug:
             return items
 
-        wav_tensor = torch.from_numpy(waveform).to(self.device)
         for _ in range(self.config['key_shift_factor']):
-            assert mel_spec is not None, 'Units encoder must be mel if augmentation is applied!'
+            assert self.config['units_encoder'] == 'mel', 'Units encoder must be mel if augmentation is applied!'
             key_shift = random.random() * (self.key_shift_max - self.key_shift_min) + self.key_shift_min
             if self.round_midi:
                 key_shift = round(key_shift)
             processed_input_aug = copy.deepcopy(processed_input)
-            assert isinstance(mel_spec, modules.rmvpe.MelSpectrogram)
-            processed_input_aug['units'] = mel_spec(
-                wav_tensor.unsqueeze(0), keyshift=key_shift
-            ).transpose(1, 2).squeeze(0).cpu().numpy()
+            if self.round_midi:
+                processed_input_aug['units'] = self.get_cached_units(
+                    waveform, audio_hash=audio_hash, key_shift=key_shift
+                )
+            else:
+                # Random float shifts are never drawn again; caching them would only evict useful entries.
+                processed_input_aug['units'] = self.get_units(waveform, key_shift=key_shift)
             processed_input_aug['pitch'] += key_shift
             processed_input_aug['note_midi'] += key_shift
             items.append(processed_input_aug)
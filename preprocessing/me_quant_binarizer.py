@@ -2,11 +2,7 @@ import copy
 import os
 import random
 
-import librosa
-import torch
-
 import modules.contentvec
-import modules.rmvpe
 from .me_binarizer import MIDIExtractionBinarizer
 
 os.environ["OMP_NUM_THREADS"] = "1"
@@ -25,25 +21,22 @@ class QuantizedMIDIExtractionBinarizer(MIDIExtractionBinarizer):
         self.round_midi = True
         self.data_attrs = QUANTIZED_MIDI_EXTRACTION_ITEM_ATTRIBUTES
 
-    def process_item(self, item_name, meta_data, allow_aug=False):
-        waveform, _ = librosa.load(meta_data['wav_fn'], sr=self.config['audio_sample_rate'], mono=True)
+    def process_item(self, item_name, meta_data, allow_aug=False, waveform=None, f0=None):
+        if waveform is None:
+            waveform = self.load_waveform(meta_data)
 
-        processed_input = self._process_item(waveform, meta_data, int_midi=True)
+        audio_hash = self.hash_waveform(waveform)
+        processed_input = self._process_item(waveform, meta_data, int_midi=True, f0=f0, audio_hash=audio_hash)
         processed_input['note_midi'][processed_input['note_rest']] = 128
         items = [processed_input]
         if not allow_aug:
             return items
 
-        from .me_binarizer import mel_spec
-        wav_tensor = torch.from_numpy(waveform).to(self.device)
         for _ in range(self.config['key_shift_factor']):
-            assert mel_spec is not None, 'Units encoder must be mel if augmentation is applied!'
+            assert self.config['units_encoder'] == 'mel', 'Units encoder must be mel if augmentation is applied!'
             key_shift = random.randint(int(self.key_shift_min), int(self.key_shift_max))
             processed_input_aug = copy.deepcopy(processed_input)
-            assert isinstance(mel_spec, modules.rmvpe.MelSpectrogram)
-            processed_input_aug['units'] = mel_spec(
-                wav_tensor.unsqueeze(0), keyshift=key_shift
-            ).transpose(1, 2).squeeze(0).cpu().numpy()
+            processed_input_aug['units'] = self.get_cached_units(waveform, audio_hash=audio_hash, key_shift=key_shift)
             processed_input_aug['pitch'] += key_shift
             processed_input_aug['note_midi'][~processed_input_aug['note_rest']] += key_shift
             items.append(processed_input_aug)
@@ -0,0 +1,215 @@
+import asyncio
+import importlib
+import io
+import pathlib
+import time
+from typing import Dict
+
+import click
+import librosa
+import yaml
+from aiohttp import web
+
+import inference
+from inference import MicroBatchScheduler, QueueFullError, RequestTooLargeError
+from utils.midi_utils import build_midi_file
+from utils.slicer2 import Slicer
+
+# Same range as the tempo input of the web UI.
+MIN_TEMPO = 20
+MAX_TEMPO = 200
+
+
+def load_model(model_path: pathlib.Path, backend: str = 'torch'):
+    with open(model_path.with_name('config.yaml'), 'r', encoding='utf8') as f:
+        config = yaml.safe_load(f)
+    if backend == 'onnx':
+        return inference.ONNXInference(config=config, model_path=model_path), config
+    infer_cls = inference.task_inference_mapping[config['task_cls']]
+
+    pkg = ".".join(infer_cls.split(".")[:-1])
+    cls_name = infer_cls.split(".")[-1]
+    infer_cls = getattr(importlib.import_module(pkg), cls_name)
+    assert issubclass(infer_cls, inference.BaseInference), \
+        f'Inference class {infer_cls} is not a subclass of {inference.BaseInference}.'
+    return infer_cls(config=config, model_path=model_path), config
+
+
+class InferenceServer:
+    """
+        HTTP inference service for the models under a work directory.
+
+        Each model is loaded on its first request and gets its own MicroBatchScheduler with its own pool of
+        worker threads, which merges the chunks of concurrent requests into shared forward passes.
+        Decoding and slicing of the uploaded audio run on a separate thread pool. When the queue of a model
+        is full, requests are rejected with 503 and a Retry-After header instead of waiting without bound;
+        requests with more chunks than the whole queue are rejected with 413.
+
+        Endpoints:
+            GET /models: relative paths of the available models
+            GET /stats: queue sizes and batching statistics of the loaded models
+            POST /infer?model=REL_PATH&tempo=120&velocity=0: audio file in the body, MIDI file in the response;
+                tempo is between 20 and 200
+    """
+
+    def __init__(
+            self, work_dir: pathlib.Path, backend: str = 'torch', num_workers: int = 1,
+            max_batch_frames: int = 4000, max_batch_size: int = 32, max_wait: float = 0.01,
+            max_queue_chunks: int = 256, max_duration: float = 20 * 60
+    ):
+        self.work_dir = work_dir
+        self.backend = backend
+        self.scheduler_kwargs = dict(
+            num_workers=num_workers, max_batch_frames=max_batch_frames, max_batch_size=max_batch_size,
+            max_wait=max_wait, max_queue_chunks=max_queue_chunks
+        )
+        self.max_duration = max_duration
+        model_suffix = '.onnx' if backend == 'onnx' else '.ckpt'
+        self.models = sorted(p.relative_to(work_dir).as_posix() for p in work_dir.rglob(f'*{model_suffix}'))
+        self._instances: Dict[str, tuple] = {}  # model_rel_path to (infer_ins, config, scheduler)
+        self._load_locks: Dict[str, asyncio.Lock] = {}
+
+    async def get_model(self, model_rel_path: str):
+        if model_rel_path not in self._instances:
+            lock = self._load_locks.setdefault(model_rel_path, asyncio.Lock())
+            async with lock:
+                if model_rel_path not in self._instances:
+                    infer_ins, config = await asyncio.get_running_loop().run_in_executor(
+                        None, load_model, self.work_dir / model_rel_path, self.backend
+                    )
+                    scheduler = MicroBatchScheduler(infer_ins, **self.scheduler_kwargs)
+                    await scheduler.start()
+                    self._instances[model_rel_path] = (infer_ins, config, scheduler)
+                    print(f'| initialized: {model_rel_path}')
+        return self._instances[model_rel_path]
+
+    def load_chunks(self, data: bytes, infer_ins, config: dict, velocity: bool):
+        waveform, _ = librosa.load(io.BytesIO(data), sr=config['audio_sample_rate'], mono=True)
+        if waveform.shape[0] > self.max_duration * config['audio_sample_rate']:
+            raise ValueError(f'The input audio is too long (>= {self.max_duration} seconds).')
+        chunks = Slicer(sr=config['audio_sample_rate'], max_sil_kept=1000).slice(waveform)
+        waveforms = [c['waveform'] for c in chunks]
+        offsets = [c['offset'] for c in chunks]
+        volumes = infer_ins.chunk_volumes(waveform, waveforms, offsets) if velocity else None
+        return waveforms, offsets, volumes, waveform.shape[0] / config['audio_sample_rate']
+
+    async def handle_models(self, request: web.Request) -> web.Response:
+        return web.json_response(self.models)
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            name: {**scheduler.stats, 'queue_size': scheduler.queue_size}
+            for name, (_, _, scheduler) in self._instances.items()
+        })
+
+    async def handle_infer(self, request: web.Request) -> web.Response:
+        model_rel_path = request.query.get('model', self.models[0] if len(self.models) == 1 else None)
+        if model_rel_path not in self.models:
+            raise web.HTTPNotFound(text=f'Model not found: {model_rel_path}')
+        try:
+            tempo = float(request.query.get('tempo', 120))
+        except ValueError:
+            raise web.HTTPBadRequest(text='Invalid tempo.')
+        if not MIN_TEMPO <= tempo <= MAX_TEMPO:
+            raise web.HTTPBadRequest(text=f'The tempo must be between {MIN_TEMPO} and {MAX_TEMPO}.')
+        velocity = request.query.get('velocity', '0').lower() in ('1', 'true')
+        data = await request.read()
+        if len(data) == 0:
+            raise web.HTTPBadRequest(text='No audio in the request body.')
+
+        start_time = time.time()
+        infer_ins, config, scheduler = await self.get_model(model_rel_path)
+        try:
+            waveforms, offsets, volumes, duration = await asyncio.get_running_loop().run_in_executor(
+                None, self.load_chunks, data, infer_ins, config, velocity
+            )
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        except Exception:
+            raise web.HTTPBadRequest(text='Unsupported or corrupt audio file.')
+        try:
+            midis = await scheduler.infer(waveforms, volumes=volumes)
+        except RequestTooLargeError as e:
+            raise web.HTTPRequestEntityTooLarge(
+                max_size=scheduler.max_queue_chunks, actual_size=len(waveforms), text=str(e)
+            )
+        except QueueFullError as e:
+            raise web.HTTPServiceUnavailable(text=str(e), headers={'Retry-After': '1'})
+        infer_time = time.time() - start_time
+
+        midi_file = build_midi_file(offsets, midis, tempo=tempo)
+        buffer = io.BytesIO()
+        midi_file.save(file=buffer)
+        return web.Response(
+            body=buffer.getvalue(), content_type='audio/midi', headers={
+                'X-Infer-Time': f'{infer_time:.3f}',
+                'X-RTF': f'{infer_time / max(duration, 1e-6):.3f}',
+                'X-Num-Chunks': str(len(waveforms)),
+            }
+        )
+
+    async def on_cleanup(self, app: web.Application):
+        for _, _, scheduler in self._instances.values():
+            await scheduler.stop()
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=256 * 1024 ** 2)
+        app.add_routes([
+            web.get('/models', self.handle_models),
+            web.get('/stats', self.handle_stats),
+            web.post('/infer', self.handle_infer),
+        ])
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+
+@click.command(help='Launch the HTTP inference server with dynamic micro-batching')
+@click.option('--port', type=int, default=7861, help='Server port')
+@click.option('--addr', type=str, default='127.0.0.1', help='Server address')
+@click.option('--work_dir', type=str, required=False, help='Directory to read the experiments')
+@click.option(
+    '--backend', type=click.Choice(['torch', 'onnx']), default='torch',
+    help='Inference backend; onnx serves exported models (*.onnx) with ONNX Runtime'
+)
+@click.option('--workers', type=int, default=1, metavar='WORKERS', help='Number of worker threads of each model')
+@click.option(
+    '--max_batch_frames', type=int, default=4000, metavar='FRAMES',
+    help='Maximum number of padded frames in each batch'
+)
+@click.option('--max_batch_size', type=int, default=32, metavar='SIZE', help='Maximum number of chunks in each batch')
+@click.option(
+    '--max_wait_ms', type=float, default=10, metavar='MS',
+    help='Maximum time to wait for more chunks before a batch runs'
+)
+@click.option(
+    '--max_queue', type=int, default=256, metavar='CHUNKS',
+    help='Maximum number of queued chunks of each model; further requests are rejected with 503, '
+         'and requests with more chunks are rejected with 413'
+)
+@click.option('--preload', multiple=True, metavar='MODEL', help='Models to load at startup (relative paths)')
+def serve(port, addr, work_dir, backend, workers, max_batch_frames, max_batch_size, max_wait_ms, max_queue, preload):
+    if work_dir is None:
+        work_dir = pathlib.Path(__file__).with_name('experiments')
+    else:
+        work_dir = pathlib.Path(work_dir)
+    assert work_dir.is_dir(), f'{work_dir} is not a directory.'
+    server = InferenceServer(
+        work_dir, backend=backend, num_workers=workers, max_batch_frames=max_batch_frames,
+        max_batch_size=max_batch_size, max_wait=max_wait_ms / 1000, max_queue_chunks=max_queue
+    )
+    if len(server.models) == 0:
+        raise FileNotFoundError(f'No models found in {work_dir}.')
+    for model_rel_path in preload:
+        assert model_rel_path in server.models, f'Model not found: {model_rel_path}'
+    app = server.build_app()
+
+    async def on_startup(_):
+        for p in preload:
+            await server.get_model(p)
+
+    app.on_startup.append(on_startup)
+    web.run_app(app, host=addr, port=port)
+
+
+if __name__ == '__main__':
+    serve()
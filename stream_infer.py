@@ -0,0 +1,76 @@
+import pathlib
+import time
+
+import click
+import librosa
+import numpy as np
+import yaml
+
+import inference
+from inference.benchmark import build_inference
+from modules.metrics import frame_agreement, notes_to_frames
+from utils.config_utils import print_config
+from utils.midi_utils import build_midi_file
+from utils.slicer2 import Slicer
+
+
+@click.command(help='Replay a wav file through the streaming inference engine and compare with offline inference')
+@click.option('--model', required=True, metavar='CKPT_PATH', help='Path to the model checkpoint (*.ckpt)')
+@click.option('--wav', required=True, metavar='WAV_PATH', help='Path to the input wav file (*.wav)')
+@click.option('--midi', required=False, metavar='MIDI_PATH', help='Path to the output MIDI file of streaming inference (*.mid)')
+@click.option('--tempo', required=False, type=float, default=120, metavar='TEMPO', help='Specify tempo in the output MIDI')
+@click.option('--block', required=False, type=float, default=0.1, metavar='SECONDS', help='Length of each audio block')
+@click.option('--window', required=False, type=float, default=10., metavar='SECONDS', help='Maximum length of the sliding window')
+@click.option('--lookahead', required=False, type=float, default=1., metavar='SECONDS', help='Lookahead before notes are finalized')
+@click.option('--step', required=False, type=float, default=0.5, metavar='SECONDS', help='Minimum amount of new audio between two model runs')
+def stream_infer(model, wav, midi, tempo, block, window, lookahead, step):
+    model_path = pathlib.Path(model)
+    with open(model_path.with_name('config.yaml'), 'r', encoding='utf8') as f:
+        config = yaml.safe_load(f)
+    print_config(config)
+    infer_ins = build_inference(model_path, config)
+
+    wav_path = pathlib.Path(wav)
+    waveform, sr = librosa.load(wav_path, sr=config['audio_sample_rate'], mono=True)
+    duration = waveform.shape[0] / sr
+
+    # Offline reference
+    slicer = Slicer(sr=config['audio_sample_rate'], max_sil_kept=1000)
+    chunks = slicer.slice(waveform)
+    offline_midis = infer_ins.infer([c['waveform'] for c in chunks])
+    offline_offsets = [c['offset'] for c in chunks]
+
+    # Streaming replay
+    stream = inference.StreamingInference(infer_ins, window=window, lookahead=lookahead, step=step)
+    block_size = round(block * sr)
+    segments = []
+    latencies = []
+    for i in range(0, waveform.shape[0], block_size):
+        start_time = time.time()
+        segments.extend(stream.feed(waveform[i: i + block_size]))
+        latencies.append(time.time() - start_time)
+    segments.extend(stream.flush())
+    stream_offsets = [s['offset'] for s in segments]
+
+    latencies = np.array(latencies) * 1000
+    print(f'| blocks: {len(latencies)}, block length: {block * 1000:.0f} ms')
+    print(
+        f'| per-block latency: mean {latencies.mean():.2f} ms, p50 {np.percentile(latencies, 50):.2f} ms, '
+        f'p99 {np.percentile(latencies, 99):.2f} ms, max {latencies.max():.2f} ms'
+    )
+    print(f'| RTF: {latencies.sum() / 1000 / duration:.3f}')
+
+    n_frames = waveform.shape[0] // config['hop_size'] + 1
+    midi_offline = notes_to_frames(offline_offsets, offline_midis, infer_ins.timestep, n_frames)
+    midi_stream = notes_to_frames(stream_offsets, segments, infer_ins.timestep, n_frames)
+    agreement = frame_agreement(midi_stream, midi_offline) / n_frames
+    print(f'| frame-level agreement with offline inference: {agreement:.4f}')
+
+    if midi is not None:
+        midi_file = build_midi_file(stream_offsets, segments, tempo=tempo)
+        midi_file.save(midi)
+        print(f'MIDI file saved at: \'{midi}\'')
+
+
+if __name__ == '__main__':
+    stream_infer()
@@ -1,3 +1,4 @@
 from .base_task import BaseTask
 from .me_task import MIDIExtractionTask
 from .me_quant_task import QuantizedMIDIExtractionTask
+from .me_distill_task import DistillationMIDIExtractionTask
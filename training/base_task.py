@@ -13,7 +13,7 @@ from torch.utils.data import Dataset
 from torchmetrics import Metric, MeanMetric
 
 import utils
-from utils.indexed_datasets import IndexedDataset
+from utils.indexed_datasets import build_indexed_dataset
 from utils.training_utils import (
     DsBatchSampler, DsEvalBatchSampler,
     get_latest_checkpoint_path
@@ -49,7 +49,7 @@ class BaseDataset(Dataset):
         self.prefix = prefix
         self.data_dir = data_dir if isinstance(data_dir, pathlib.Path) else pathlib.Path(data_dir)
         self.sizes = np.load(self.data_dir / f'{self.prefix}.lengths')
-        self.indexed_ds = IndexedDataset(self.data_dir, self.prefix)
+        self.indexed_ds = build_indexed_dataset(self.data_dir, self.prefix)
         self.allow_aug = allow_aug
 
     @property
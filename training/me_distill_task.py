@@ -0,0 +1,85 @@
+import pathlib
+from collections import OrderedDict
+
+import torch
+import yaml
+from torch import nn
+
+from utils import build_object_from_class_name
+from .me_task import MIDIExtractionTask
+
+
+class DistillationMIDIExtractionTask(MIDIExtractionTask):
+    """
+        Knowledge distillation of a (smaller) student model from a frozen teacher checkpoint.
+
+        The student is the model of this configuration (*model_cls* and *midi_extractor_args*); the teacher is
+        built from the configuration next to *distill_teacher_ckpt*. Both run on the same batches of
+        MIDIExtractionDataset. The losses are:
+        1. *midi_loss*, *bound_loss*:
+            the losses of MIDIExtractionTask against the ground truth, weighted by *distill_gt_weight*;
+        2. *distill_midi_loss*:
+            BCE between the student logits and the teacher probs, both softened by *distill_temperature*;
+        3. *distill_bound_loss*:
+            EMD loss between the student bounds and the teacher bounds.
+        The teacher is not a submodule of the task, so it is neither trained nor saved in the checkpoints.
+    """
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.gt_weight = self.config['distill_gt_weight']
+        self.temperature = self.config['distill_temperature']
+        self._teacher = None
+
+    def build_teacher(self) -> nn.Module:
+        ckpt_path = pathlib.Path(self.config['distill_teacher_ckpt'])
+        with open(ckpt_path.with_name('config.yaml'), 'r', encoding='utf8') as f:
+            teacher_config = yaml.safe_load(f)
+        assert teacher_config['units_dim'] == self.config['units_dim'] \
+               and teacher_config['midi_num_bins'] == self.config['midi_num_bins'], \
+            'The teacher and the student must share the input units and the output bins.'
+        teacher: nn.Module = build_object_from_class_name(
+            teacher_config['model_cls'], nn.Module, config=teacher_config
+        )
+        state_dict = torch.load(ckpt_path, map_location='cpu')['state_dict']
+        prefix_in_ckpt = 'model'
+        state_dict = OrderedDict({
+            k[len(prefix_in_ckpt) + 1:]: v
+            for k, v in state_dict.items() if k.startswith(f'{prefix_in_ckpt}.')
+        })
+        teacher.load_state_dict(state_dict, strict=True)
+        print(f'| load teacher \'{prefix_in_ckpt}\' from \'{ckpt_path}\'.')
+        for param in teacher.parameters():
+            param.requires_grad = False
+        return teacher.eval()
+
+    def get_teacher(self, device) -> nn.Module:
+        if self._teacher is None:
+            self._teacher = self.build_teacher()
+        return self._teacher.to(device)
+
+    @torch.no_grad()
+    def run_teacher(self, spec, f0, mask):
+        logits, bounds = self.get_teacher(spec.device)(x=spec, f0=f0, mask=mask, sig=False)
+        probs = torch.sigmoid(logits.float() / self.temperature) * mask[..., None]
+        return probs, bounds.float() * mask
+
+    def run_model(self, sample, infer=False):
+        if infer:
+            return super().run_model(sample, infer=True)
+        spec = sample['units']
+        mask = sample['unit2note'] > 0
+        f0 = sample['pitch']
+        teacher_probs, teacher_bounds = self.run_teacher(spec, f0, mask)
+
+        losses = {}
+        probs, bounds = self.model(x=spec, f0=f0, mask=mask, sig=False)
+        if self.gt_weight > 0:
+            if self.cfg['use_bound_loss']:
+                losses['bound_loss'] = self.gt_weight * self.bound_loss(bounds, sample['bounds'])
+            if self.cfg['use_midi_loss']:
+                losses['midi_loss'] = self.gt_weight * self.midi_loss(probs, sample['probs'])
+        # Soft targets are scaled by T^2 so that their gradients keep the same magnitude for any temperature.
+        losses['distill_midi_loss'] = self.midi_loss(probs / self.temperature, teacher_probs) * self.temperature ** 2
+        losses['distill_bound_loss'] = self.bound_loss(bounds * mask, teacher_bounds)
+        return losses
@@ -6,12 +6,21 @@ import types
 from collections import OrderedDict
 
 import numpy as np
-import torch
 
-from utils.training_utils import get_latest_checkpoint_path
+# PyTorch is imported inside the functions that use it, so that the helpers of the ONNX Runtime backend
+# (batch_by_size, Slicer, ...) can be imported without PyTorch.
+
+
+def __getattr__(name):
+    if name == 'get_latest_checkpoint_path':
+        from utils.training_utils import get_latest_checkpoint_path
+        return get_latest_checkpoint_path
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def tensors_to_scalars(metrics):
+    import torch
+
     new_metrics = {}
     for k, v in metrics.items():
         if isinstance(v, torch.Tensor):
@@ -26,6 +35,8 @@ def collate_nd(values, pad_value=0, max_len=None):
     """
     Pad a list of Nd tensors on their first dimension and stack them into a (N+1)d tensor.
     """
+    import torch
+
     size = ((max(v.size(0) for v in values) if max_len is None else max_len), *values[0].shape[1:])
     res = torch.full((len(values), *size), fill_value=pad_value, dtype=values[0].dtype, device=values[0].device)
 
@@ -35,6 +46,8 @@ def collate_nd(values, pad_value=0, max_len=None):
 
 
 def random_continuous_masks(*shape: int, dim: int, device: str | torch.device = 'cpu'):
+    import torch
+
     start, end = torch.sort(
         torch.randint(
             low=0, high=shape[dim] + 1, size=(*shape[:dim], 2, *((1,) * (len(shape) - dim - 1))), device=device
@@ -147,6 +160,8 @@ def load_ckpt(
         prefix_in_ckpt='model', key_in_ckpt='state_dict',
         strict=True, device='cpu'
 ):
+    import torch
+
     if not isinstance(ckpt_base_dir, pathlib.Path):
         ckpt_base_dir = pathlib.Path(ckpt_base_dir)
     if ckpt_base_dir.is_file():
@@ -270,6 +285,8 @@ def build_lr_scheduler_from_config(optimizer, scheduler_args):
 
 
 def simulate_lr_scheduler(optimizer_args, scheduler_args, step_count, num_param_groups=1):
+    import torch
+
     optimizer = build_object_from_class_name(
         optimizer_args['optimizer_cls'],
         torch.optim.Optimizer,
@@ -5,7 +5,7 @@ import numpy as np
 import parselmouth
 import torch
 
-from utils.pitch_utils import interp_f0
+from utils.pitch_utils import interp_f0, resample_align_curve
 
 
 def merge_slurs(note_seq: list, note_dur: list, note_slur: list, tolerance=None) -> Tuple[list, list]:
@@ -123,6 +123,54 @@ def get_pitch_parselmouth(waveform, sample_rate, hop_size, length, interp_uv=Fal
     return f0, uv
 
 
+def _align_rmvpe_pitch(rmvpe, f0, uv, sample_rate, hop_size, length, interp_uv):
+    original_timestep = rmvpe.mel_extractor.hop_length / sample_rate
+    target_timestep = hop_size / sample_rate
+    f0 = resample_align_curve(f0, original_timestep, target_timestep, length)
+    uv = resample_align_curve(uv.astype(np.float32), original_timestep, target_timestep, length) > 0.5
+    if not interp_uv:
+        f0[uv] = 0
+    return f0, uv
+
+
+def get_pitch_rmvpe(rmvpe, waveform, sample_rate, hop_size, length, interp_uv=False):
+    """
+
+    :param rmvpe: modules.rmvpe.RMVPE instance
+    :param waveform: [T]
+    :param hop_size: size of each frame
+    :param sample_rate: sampling rate of waveform
+    :param length: Expected number of frames
+    :param interp_uv: Interpolate unvoiced parts
+    :return: f0, uv
+    """
+    # Extract on the hop of RMVPE first, then align to the requested frames.
+    hop_length = rmvpe.mel_extractor.hop_length
+    f0, uv = rmvpe.get_pitch(
+        waveform, sample_rate=sample_rate, hop_size=hop_length,
+        length=(waveform.shape[0] + hop_length - 1) // hop_length, interp_uv=True
+    )
+    return _align_rmvpe_pitch(rmvpe, f0, uv, sample_rate, hop_size, length, interp_uv)
+
+
+def get_pitch_rmvpe_batch(rmvpe, waveforms, sample_rate, hop_size, lengths, interp_uv=False):
+    """
+    Batched version of get_pitch_rmvpe().
+    :param waveforms: list of [T]
+    :param lengths: Expected number of frames of each waveform
+    :return: list of (f0, uv)
+    """
+    hop_length = rmvpe.mel_extractor.hop_length
+    results = rmvpe.get_pitch_batch(
+        waveforms, sample_rate=sample_rate, hop_size=hop_length,
+        lengths=[(w.shape[0] + hop_length - 1) // hop_length for w in waveforms], interp_uv=True
+    )
+    return [
+        _align_rmvpe_pitch(rmvpe, f0, uv, sample_rate, hop_size, length, interp_uv)
+        for (f0, uv), length in zip(results, lengths)
+    ]
+
+
 class SinusoidalSmoothingConv1d(torch.nn.Conv1d):
     def __init__(self, kernel_size):
         super().__init__(
@@ -1,8 +1,8 @@
 from __future__ import annotations
 
 import pathlib
+import sys
 
-import lightning.pytorch.utilities
 import yaml
 
 loaded_config_files = {}
@@ -41,8 +41,12 @@ def read_full_config(config_path: pathlib.Path) -> dict:
     return squashed_config
 
 
-@lightning.pytorch.utilities.rank_zero.rank_zero_only
 def print_config(config: dict):
+    # Only rank zero prints during distributed training. Lightning is not imported here, so that inference with
+    # the ONNX Runtime backend does not import PyTorch.
+    rank_zero = sys.modules.get('lightning.pytorch.utilities.rank_zero')
+    if rank_zero is not None and getattr(rank_zero.rank_zero_only, 'rank', 0) != 0:
+        return
     for i, (k, v) in enumerate(sorted(config.items())):
         print(f"\033[0;33m{k}\033[0m: {v}", end='')
         if i < len(config) - 1:
@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+import torch
+from librosa.filters import mel
+from torchaudio.transforms import Resample
+
+
+class KernelRegistry:
+    """
+        Process-wide cache of DSP kernels (resamplers, windows, mel bases) keyed by their parameters and device.
+
+        All models, feature extractors and workers of a process share the same kernels instead of building
+        their own copies, which saves memory and cold start time. At most *max_size* kernels are kept;
+        the least recently used ones are dropped first. The kernels are shared, so they must never be
+        modified in place.
+    """
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self._kernels = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name: str, params: tuple, device, build_fn: Callable):
+        """
+        :param build_fn: builds the kernel on the CPU; it is moved to the device afterwards
+        """
+        key = (name, params, str(torch.device(device)))
+        with self._lock:
+            if key in self._kernels:
+                self._kernels.move_to_end(key)
+                return self._kernels[key]
+        kernel = build_fn().to(device)
+        with self._lock:
+            # Another thread may have built the same kernel meanwhile; keep the first one.
+            kernel = self._kernels.setdefault(key, kernel)
+            self._kernels.move_to_end(key)
+            while len(self._kernels) > self.max_size:
+                self._kernels.popitem(last=False)
+        return kernel
+
+    def clear(self):
+        with self._lock:
+            self._kernels.clear()
+
+    def __len__(self):
+        return len(self._kernels)
+
+
+kernel_registry = KernelRegistry()
+
+
+def hann_window(win_length: int, device='cpu') -> torch.Tensor:
+    return kernel_registry.get(
+        'hann_window', (win_length,), device, lambda: torch.hann_window(win_length)
+    )
+
+
+def mel_basis(sample_rate, n_fft, n_mels, fmin=0, fmax=None, htk=True, device='cpu') -> torch.Tensor:
+    """
+    :return: [n_mels, n_fft // 2 + 1], the same as librosa.filters.mel()
+    """
+    return kernel_registry.get(
+        'mel_basis', (sample_rate, n_fft, n_mels, fmin, fmax, htk), device,
+        lambda: torch.from_numpy(
+            mel(sr=sample_rate, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax, htk=htk)
+        ).float()
+    )
+
+
+def resampler(orig_freq: int, new_freq: int, lowpass_filter_width: int = 128, device='cpu') -> Resample:
+    return kernel_registry.get(
+        'resampler', (orig_freq, new_freq, lowpass_filter_width), device,
+        lambda: Resample(orig_freq, new_freq, lowpass_filter_width=lowpass_filter_width)
+    )
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import pathlib
+import uuid
+from typing import Callable
+
+import numpy as np
+
+
+class FeatureCache:
+    """
+        Content-addressed on-disk cache of frame-level features (mel spectrograms, f0, etc.).
+
+        Each entry is a single .npy file named by the hash of the audio content and the parameters the
+        feature depends on, so the same audio processed with the same settings is never computed twice,
+        across runs and across processes. Entries are loaded as read-only memory maps.
+        Files are written atomically, and the least recently used entries are evicted when the total size
+        of the cache exceeds *max_size* bytes.
+    """
+
+    def __init__(self, cache_dir, max_size: int = 10 * 1024 ** 3):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_size = max_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._size = None  # estimated total size, scanned on first write
+
+    @staticmethod
+    def hash_audio(waveform: np.ndarray) -> str:
+        return hashlib.sha1(np.ascontiguousarray(waveform, dtype=np.float32).tobytes()).hexdigest()
+
+    @staticmethod
+    def file_signature(path) -> str:
+        """
+        Identify a model checkpoint by its path, size and modification time, which is much cheaper than hashing it.
+        """
+        path = pathlib.Path(path)
+        if not path.exists():
+            return path.as_posix()
+        stat = path.stat()
+        return f'{path.resolve().as_posix()}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    @staticmethod
+    def make_key(audio_hash: str, name: str, **params) -> str:
+        params = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha1(f'{audio_hash}|{name}|{params}'.encode('utf8')).hexdigest()
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.cache_dir / key[:2] / f'{key}.npy'
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            value = np.load(path, mmap_mode='r')
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return value
+
+    def put(self, key: str, value: np.ndarray):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.stem}.{uuid.uuid4().hex}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(value))
+        os.replace(tmp_path, path)
+        if self._size is None:
+            self._size = self._scan_size()
+        else:
+            self._size += path.stat().st_size
+        if self._size > self.max_size:
+            self.evict()
+
+    def get_or_compute(self, key: str, compute_fn: Callable[[], np.ndarray]) -> np.ndarray:
+        value = self.get(key)
+        if value is None:
+            value = compute_fn()
+            self.put(key, value)
+        return value
+
+    def _entries(self):
+        entries = []
+        for path in self.cache_dir.glob('*/*.npy'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(e[1] for e in self._entries())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache takes no more than 90% of max_size.
+        """
+        entries = sorted(self._entries(), key=lambda e: e[0])
+        size = sum(e[1] for e in entries)
+        for _, file_size, path in entries:
+            if size <= self.max_size * 0.9:
+                break
+            try:
+                path.unlink()
+            except OSError:  # removed by another process, or still in use on Windows
+                continue
+            size -= file_size
+        self._size = size
+
+
+def build_feature_cache(config: dict):
+    """
+    Build the feature cache from the configuration, or return None if it is not enabled.
+    """
+    cache_dir = config.get('feature_cache_dir')
+    if cache_dir is None:
+        return None
+    return FeatureCache(cache_dir, max_size=int(config.get('feature_cache_max_size_gb', 10) * 1024 ** 3))
+
+
+def units_cache_params(config: dict) -> dict:
+    """
+    Parameters that the units (mel spectrogram or contentvec) depend on.
+    """
+    params = {
+        'units_encoder': config['units_encoder'],
+        'units_dim': config['units_dim'],
+        'audio_sample_rate': config['audio_sample_rate'],
+        'hop_size': config['hop_size'],
+    }
+    if config['units_encoder'] == 'mel':
+        params.update(win_size=config['win_size'], fmin=config['fmin'], fmax=config['fmax'])
+    else:
+        params.update(units_encoder_ckpt=FeatureCache.file_signature(config['units_encoder_ckpt']))
+    return params
+
+
+def f0_cache_params(config: dict) -> dict:
+    """
+    Parameters that the f0 curve depends on.
+    """
+    params = {
+        'pe': config['pe'],
+        'audio_sample_rate': config['audio_sample_rate'],
+        'hop_size': config['hop_size'],
+    }
+    if config['pe'] == 'rmvpe':
+        params.update(pe_ckpt=FeatureCache.file_signature(config['pe_ckpt']))
+        if config.get('pe_window_size', 0) > 0:
+            params.update(pe_window_size=config['pe_window_size'], pe_window_overlap=config.get('pe_window_overlap', 64))
+        if config.get('pe_viterbi', False):
+            params.update(pe_viterbi=True)
+    return params
@@ -1,6 +1,8 @@
+import json
 import pathlib
 import multiprocessing
-from collections import deque
+from collections import OrderedDict
+from collections.abc import Mapping
 
 import h5py
 import torch
@@ -14,7 +16,7 @@ class IndexedDataset:
         if not self.path.exists():
             raise FileNotFoundError(f'IndexedDataset not found: {self.path}')
         self.dset = None
-        self.cache = deque(maxlen=num_cache)
+        self.cache = OrderedDict()
         self.num_cache = num_cache
 
     def check_index(self, i):
@@ -29,13 +31,14 @@ class IndexedDataset:
         if self.dset is None:
             self.dset = h5py.File(self.path, 'r')
         self.check_index(i)
-        if self.num_cache > 0:
-            for c in self.cache:
-                if c[0] == i:
-                    return c[1]
+        if i in self.cache:
+            self.cache.move_to_end(i)
+            return self.cache[i]
         item = {k: v[()].item() if v.shape == () else torch.from_numpy(v[()]) for k, v in self.dset[str(i)].items()}
         if self.num_cache > 0:
-            self.cache.appendleft((i, item))
+            self.cache[i] = item
+            if len(self.cache) > self.num_cache:
+                self.cache.popitem(last=False)
         return item
 
     def __len__(self):
@@ -77,6 +80,171 @@ class IndexedDatasetBuilder:
             self.dset.close()
 
 
+class MMapIndexedDataset:
+    """
+        Dataset stored as one flat binary file per attribute, read through np.memmap.
+
+        Layout of the {prefix}.mmap directory:
+            index.json: number of items, and dtype and number of dimensions of each attribute;
+            {attr}.bin: the data of all items, flattened and concatenated;
+            {attr}.offsets.npy: int64[N + 1], offsets of the items in {attr}.bin, in elements;
+            {attr}.shapes.npy: int64[N, ndim], shapes of the items.
+
+        Attributes are opened lazily on first access, and items are returned as lazy mappings,
+        so attributes that are never read are never loaded from the disk.
+    """
+
+    def __init__(self, path, prefix):
+        super().__init__()
+        self.path = pathlib.Path(path) / f'{prefix}.mmap'
+        if not self.path.exists():
+            raise FileNotFoundError(f'MMapIndexedDataset not found: {self.path}')
+        with open(self.path / 'index.json', 'r', encoding='utf8') as f:
+            index = json.load(f)
+        self.num_items = index['num_items']
+        self.attrs = index['attrs']
+        self.data = {}
+        self.offsets = {}
+        self.shapes = {}
+
+    def __getstate__(self):
+        # Memory maps are re-opened in each DataLoader worker instead of being pickled.
+        state = self.__dict__.copy()
+        state.update(data={}, offsets={}, shapes={})
+        return state
+
+    def check_index(self, i):
+        if i < 0 or i >= self.num_items:
+            raise IndexError('index out of range')
+
+    def _open(self, attr):
+        dtype = np.dtype(self.attrs[attr]['dtype'])
+        self.offsets[attr] = np.load(self.path / f'{attr}.offsets.npy')
+        self.shapes[attr] = np.load(self.path / f'{attr}.shapes.npy')
+        if self.offsets[attr][-1] == 0:
+            self.data[attr] = np.zeros(0, dtype=dtype)  # np.memmap cannot map empty files
+        else:
+            # Copy-on-write mapping: arrays can be wrapped by torch.from_numpy() without copying.
+            self.data[attr] = np.memmap(self.path / f'{attr}.bin', dtype=dtype, mode='c')
+
+    def get_attr(self, i, attr):
+        if attr not in self.data:
+            self._open(attr)
+        start, end = self.offsets[attr][i], self.offsets[attr][i + 1]
+        value = self.data[attr][start: end].reshape(self.shapes[attr][i])
+        if value.ndim == 0:
+            return value.item()
+        return torch.from_numpy(value)
+
+    def __getitem__(self, i):
+        self.check_index(i)
+        return LazyItem(self, i)
+
+    def __len__(self):
+        return self.num_items
+
+
+class LazyItem(Mapping):
+    """
+        An item of MMapIndexedDataset. Each attribute is read when it is accessed.
+    """
+
+    def __init__(self, dataset: MMapIndexedDataset, index: int):
+        self.dataset = dataset
+        self.index = index
+
+    def __getitem__(self, key):
+        if key not in self.dataset.attrs:
+            raise KeyError(key)
+        return self.dataset.get_attr(self.index, key)
+
+    def __iter__(self):
+        return iter(self.dataset.attrs)
+
+    def __len__(self):
+        return len(self.dataset.attrs)
+
+
+class MMapIndexedDatasetBuilder:
+    def __init__(self, path, prefix, allowed_attr=None):
+        self.path = pathlib.Path(path) / f'{prefix}.mmap'
+        self.prefix = prefix
+        self.files = None
+        self.counter = 0
+        self.attrs = {}
+        self.offsets = {}
+        self.shapes = {}
+        if allowed_attr is not None:
+            self.allowed_attr = set(allowed_attr)
+        else:
+            self.allowed_attr = None
+
+    def add_item(self, item):
+        if self.files is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.files = {}
+        if self.allowed_attr is not None:
+            item = {
+                k: item[k]
+                for k in self.allowed_attr
+                if k in item
+            }
+        item = {k: np.asarray(v) for k, v in item.items() if v is not None}
+        if self.counter == 0:
+            for k, v in sorted(item.items()):
+                self.attrs[k] = {'dtype': v.dtype.str, 'ndim': v.ndim}
+                self.offsets[k] = [0]
+                self.shapes[k] = []
+                self.files[k] = open(self.path / f'{k}.bin', 'wb')
+        assert set(item.keys()) == set(self.attrs.keys()), \
+            f'Attributes of item {self.counter} mismatch: {sorted(item.keys())} vs {sorted(self.attrs.keys())}'
+        for k, v in item.items():
+            assert v.dtype.str == self.attrs[k]['dtype'] and v.ndim == self.attrs[k]['ndim'], \
+                f'Attribute \'{k}\' of item {self.counter} has dtype {v.dtype} and {v.ndim} dimensions, ' \
+                f'but the previous items have dtype {np.dtype(self.attrs[k]["dtype"])} ' \
+                f'and {self.attrs[k]["ndim"]} dimensions.'
+            self.files[k].write(np.ascontiguousarray(v).tobytes())
+            self.offsets[k].append(self.offsets[k][-1] + v.size)
+            self.shapes[k].append(v.shape)
+        self.counter += 1
+
+    def finalize(self):
+        if self.files is None:
+            return
+        for k, f in self.files.items():
+            f.close()
+            np.save(self.path / f'{k}.offsets.npy', np.array(self.offsets[k], dtype=np.int64))
+            np.save(
+                self.path / f'{k}.shapes.npy',
+                np.array(self.shapes[k], dtype=np.int64).reshape(self.counter, self.attrs[k]['ndim'])
+            )
+        with open(self.path / 'index.json', 'w', encoding='utf8') as f:
+            json.dump({'num_items': self.counter, 'attrs': self.attrs}, f, indent=2)
+        self.files = None
+
+
+def build_indexed_dataset(path, prefix):
+    """
+    Open a binary dataset, preferring the memory-mapped format over HDF5.
+    """
+    if (pathlib.Path(path) / f'{prefix}.mmap').exists():
+        return MMapIndexedDataset(path, prefix)
+    return IndexedDataset(path, prefix)
+
+
+def convert_hdf5_to_mmap(path, prefix):
+    """
+    Convert {prefix}.data (HDF5) into {prefix}.mmap in the same directory.
+    """
+    dset = IndexedDataset(path, prefix)
+    builder = MMapIndexedDatasetBuilder(path, prefix)
+    for i in range(len(dset)):
+        item = dset[i]
+        builder.add_item({k: v.numpy() if isinstance(v, torch.Tensor) else v for k, v in item.items()})
+    builder.finalize()
+    return builder.counter
+
+
 if __name__ == "__main__":
     import random
     from tqdm import tqdm
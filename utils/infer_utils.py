@@ -1,9 +1,48 @@
-from typing import List, Dict
+import copy
 
-import mido
-import numpy as np
 import torch
 import torch.nn.functional as F
+from torch import nn
+
+from modules.conv.base_conv import conform_conv
+
+
+
+@torch.no_grad()
+def fuse_model(model: nn.Module, units_dim: int, check: bool = False, atol: float = 1e-4, seed: int = 0) -> nn.Module:
+    """
+    Fuse the conform_conv modules of a note model in eval mode (in-place operation).
+    :param model: model called as model(x, f0, mask=mask) -> (probs, bounds)
+    :param units_dim: number of channels of x
+    :param check: compare the outputs with the unfused model on random inputs (costs a copy of the model)
+    :param atol: maximum absolute deviation allowed by the check
+    :param seed: seed of the random inputs of the check, so that a failure can be reproduced
+    """
+    reference = copy.deepcopy(model) if check else None
+    n_fused = 0
+    for module in model.modules():
+        if isinstance(module, conform_conv):
+            module.fuse()
+            n_fused += 1
+    if n_fused == 0 or not check:
+        return model
+    device = next(model.parameters()).device
+    n_frames = 200
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.randn((2, n_frames, units_dim), generator=generator).to(device)
+    f0 = (torch.rand((2, n_frames), generator=generator) * 40 + 40).to(device)
+    mask = torch.ones((2, n_frames), dtype=torch.bool, device=device)
+    mask[1, n_frames // 2:] = False  # the masked padding goes through the fused path as well
+    deviation = max(
+        ((out - ref) * (mask[..., None] if out.dim() == 3 else mask)).abs().max().item()
+        for out, ref in zip(model(x, f0, mask=mask), reference(x, f0, mask=mask))
+    )
+    if deviation > atol:
+        raise RuntimeError(
+            f'Fused model deviates from the original model by {deviation:.2e} (atol {atol:.0e}, seed {seed}).'
+        )
+    print(f'| fuse {n_fused} conv modules, max deviation {deviation:.2e}.')
+    return model
 
 
 def decode_gaussian_blurred_probs(probs, vmin, vmax, deviation, threshold):
@@ -76,41 +115,6 @@ def decode_note_sequence(frame2item, values, masks, threshold=0.5):
     return item_values, item_dur, item_masks
 
 
-def build_midi_file(offsets: List[float], segments: List[Dict[str, np.ndarray]], tempo=120) -> mido.MidiFile:
-    midi_file = mido.MidiFile(charset='utf8')
-    midi_track = mido.MidiTrack()
-    midi_track.append(mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(tempo), time=0))
-    last_time = 0
-    offsets = [round(o * tempo * 8) for o in offsets]
-
-    for i, (offset, segment) in enumerate(zip(offsets, segments)):
-        note_midi = np.round(segment['note_midi']).astype(np.int64).tolist()
-        note_tick = np.diff(np.round(np.cumsum(segment['note_dur']) * tempo * 8).astype(np.int64), prepend=0).tolist()
-        note_rest = segment['note_rest'].tolist()
-
-        # Get velocity from volume data
-        if 'note_volume' in segment:
-            # Normalize volume data to MIDI velocity range (1-127)
-            note_velocity = np.clip(np.round(segment['note_volume'] * 127), 1, 127).astype(np.int64).tolist()
-        else:
-            # Default velocity value (mezzo-forte)
-            note_velocity = [64] * len(note_midi)
-
-        start = offset
-        for j in range(len(note_midi)):
-            end = start + note_tick[j]
-            if i < len(offsets) - 1 and end > offsets[i + 1]:
-                end = offsets[i + 1]
-            if start < end and not note_rest[j]:
-                velocity = adjust_velocity_to_center(note_velocity[j], center=64, strength=0.35)
-                midi_track.append(mido.Message('note_on', note=note_midi[j], velocity=velocity, time=start - last_time))
-                midi_track.append(mido.Message('note_off', note=note_midi[j], velocity=0, time=end - start))
-                last_time = end
-            start = end
-    midi_file.tracks.append(midi_track)
-    return midi_file
-
-
 # if __name__ == '__main__':
 #     frame2item = torch.LongTensor([
 #         [1, 1, 1, 1, 2, 2, 3, 3, 3, 0, 0, 0, 0, 0],
@@ -122,20 +126,3 @@ def build_midi_file(offsets: List[float], segments: List[Dict[str, np.ndarray]],
 #     ])
 #     masks = frame2item > 0
 #     decode_note_sequence(frame2item, values, masks)
-
-def adjust_velocity_to_center(velocity: int, center: int = 64, strength: float = 0.5) -> int:
-    """
-    Pull MIDI velocity values toward a center value.
-    
-    Args:
-        velocity: Original velocity (1-127)
-        center: Center value to pull toward (default: 64)
-        strength: How strongly to pull toward center (0-1)
-    
-    Returns:
-        Adjusted velocity (1-127)
-    """
-    # Linear interpolation toward center
-    adjusted = velocity * (1 - strength) + center * strength
-    
-    return int(np.clip(round(adjusted), 1, 127))
\ No newline at end of file
@@ -2,7 +2,9 @@ import platform
 import re
 import traceback
 
-from torch.multiprocessing import Manager, Process, current_process, get_context
+# torch.multiprocessing re-exports these names of the standard library; importing PyTorch registers the reductions
+# that share tensors between processes, so the workers of the ONNX Runtime backend can run without PyTorch.
+from multiprocessing import Manager, Process, current_process, get_context
 
 is_main_process = not bool(re.match(r'((.*Process)|(SyncManager)|(.*PoolWorker))-\d+', current_process().name))
 
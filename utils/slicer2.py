@@ -1,17 +1,10 @@
-import numpy as np
+from typing import Dict, List
 
+import numpy as np
 
-# This function is obtained from librosa.
-def get_rms(
-        y,
-        *,
-        frame_length=2048,
-        hop_length=512,
-        pad_mode="constant",
-):
-    padding = (int(frame_length // 2), int(frame_length // 2))
-    y = np.pad(y, padding, mode=pad_mode)
 
+def _frame_power(y, frame_length, hop_length):
+    # Frame an already padded signal and calculate the power of each frame.
     axis = -1
     # put our new within-frame axis at the end for now
     out_strides = y.strides + tuple([y.strides[axis]])
@@ -33,9 +26,35 @@ def get_rms(
     x = xw[tuple(slices)]
 
     # Calculate power
-    power = np.mean(np.abs(x) ** 2, axis=-2, keepdims=True)
+    return np.mean(np.abs(x) ** 2, axis=-2, keepdims=True)
+
+
+# This function is obtained from librosa.
+def get_rms(
+        y,
+        *,
+        frame_length=2048,
+        hop_length=512,
+        pad_mode="constant",
+        block_frames=1024,
+):
+    # Frames are processed in blocks and only the edges are padded, so that neither a padded copy
+    # of the whole signal nor the whole framed signal is held in memory.
+    half = int(frame_length // 2)
+    n_samples = y.shape[-1]
+    n_frames = (n_samples + 2 * half - frame_length) // hop_length + 1
+    power = []
+    for begin in range(0, n_frames, block_frames):
+        end = min(begin + block_frames, n_frames)
+        start = begin * hop_length - half
+        stop = (end - 1) * hop_length + frame_length - half
+        segment = y[..., max(start, 0): min(stop, n_samples)]
+        if start < 0 or stop > n_samples:
+            padding = [(0, 0)] * (y.ndim - 1) + [(max(-start, 0), max(stop - n_samples, 0))]
+            segment = np.pad(segment, padding, mode=pad_mode)
+        power.append(_frame_power(segment, frame_length, hop_length))
 
-    return np.sqrt(power)
+    return np.sqrt(np.concatenate(power, axis=-1))
 
 
 class Slicer:
@@ -69,6 +88,58 @@ class Slicer:
             chunk['waveform'] = waveform[begin * self.hop_size: min(waveform.shape[0], end * self.hop_size)]
         return chunk
 
+    def _slice_silence(self, rms, silence_start, i, clip_start):
+        """
+        Decide how to slice at the silent frames [silence_start, i) followed by the non-silent frame i.
+        :param rms: RMS of frames [silence_start, i]
+        :return: the range of silent frames to be removed (or None), and the new clip start
+        """
+        # Clear recorded silence start if interval is not enough or clip is too short
+        is_leading_silence = silence_start == 0 and i > self.max_sil_kept
+        need_slice_middle = i - silence_start >= self.min_interval and i - clip_start >= self.min_length
+        if not is_leading_silence and not need_slice_middle:
+            return None, clip_start
+        # Need slicing. Record the range of silent frames to be removed.
+        n = i - silence_start
+        if n <= self.max_sil_kept:
+            pos = rms.argmin() + silence_start
+            if silence_start == 0:
+                sil_tag = (0, pos)
+            else:
+                sil_tag = (pos, pos)
+            clip_start = pos
+        elif n <= self.max_sil_kept * 2:
+            pos = rms[n - self.max_sil_kept: self.max_sil_kept + 1].argmin()
+            pos += i - self.max_sil_kept
+            pos_l = rms[: self.max_sil_kept + 1].argmin() + silence_start
+            pos_r = rms[n - self.max_sil_kept:].argmin() + i - self.max_sil_kept
+            if silence_start == 0:
+                sil_tag = (0, pos_r)
+                clip_start = pos_r
+            else:
+                sil_tag = (min(pos_l, pos), max(pos_r, pos))
+                clip_start = max(pos_r, pos)
+        else:
+            pos_l = rms[: self.max_sil_kept + 1].argmin() + silence_start
+            pos_r = rms[n - self.max_sil_kept:].argmin() + i - self.max_sil_kept
+            if silence_start == 0:
+                sil_tag = (0, pos_r)
+            else:
+                sil_tag = (pos_l, pos_r)
+            clip_start = pos_r
+        return sil_tag, clip_start
+
+    def _slice_trailing_silence(self, rms, silence_start, total_frames):
+        """
+        :param rms: RMS of frames [silence_start, total_frames)
+        :return: the range of trailing silent frames to be removed (or None)
+        """
+        if total_frames - silence_start < self.min_interval:
+            return None
+        silence_end = min(total_frames, silence_start + self.max_sil_kept)
+        pos = rms[: silence_end - silence_start + 1].argmin() + silence_start
+        return pos, total_frames + 1
+
     # @timeit
     def slice(self, waveform):
         if len(waveform.shape) > 1:
@@ -78,59 +149,23 @@ class Slicer:
         if (samples.shape[0] + self.hop_size - 1) // self.hop_size <= self.min_length:
             return [{'offset': 0, 'waveform': waveform}]
         rms_list = get_rms(y=samples, frame_length=self.win_size, hop_length=self.hop_size).squeeze(0)
+        total_frames = rms_list.shape[0]
+        # Run-length encoding of silent frames: each run is [start, end) and frame `end` is not silent.
+        edges = np.diff((rms_list < self.threshold).astype(np.int8), prepend=0, append=0)
+        run_starts = np.flatnonzero(edges == 1)
+        run_ends = np.flatnonzero(edges == -1)
         sil_tags = []
-        silence_start = None
         clip_start = 0
-        for i, rms in enumerate(rms_list):
-            # Keep looping while frame is silent.
-            if rms < self.threshold:
-                # Record start of silent frames.
-                if silence_start is None:
-                    silence_start = i
-                continue
-            # Keep looping while frame is not silent and silence start has not been recorded.
-            if silence_start is None:
-                continue
-            # Clear recorded silence start if interval is not enough or clip is too short
-            is_leading_silence = silence_start == 0 and i > self.max_sil_kept
-            need_slice_middle = i - silence_start >= self.min_interval and i - clip_start >= self.min_length
-            if not is_leading_silence and not need_slice_middle:
-                silence_start = None
-                continue
-            # Need slicing. Record the range of silent frames to be removed.
-            if i - silence_start <= self.max_sil_kept:
-                pos = rms_list[silence_start: i + 1].argmin() + silence_start
-                if silence_start == 0:
-                    sil_tags.append((0, pos))
-                else:
-                    sil_tags.append((pos, pos))
-                clip_start = pos
-            elif i - silence_start <= self.max_sil_kept * 2:
-                pos = rms_list[i - self.max_sil_kept: silence_start + self.max_sil_kept + 1].argmin()
-                pos += i - self.max_sil_kept
-                pos_l = rms_list[silence_start: silence_start + self.max_sil_kept + 1].argmin() + silence_start
-                pos_r = rms_list[i - self.max_sil_kept: i + 1].argmin() + i - self.max_sil_kept
-                if silence_start == 0:
-                    sil_tags.append((0, pos_r))
-                    clip_start = pos_r
-                else:
-                    sil_tags.append((min(pos_l, pos), max(pos_r, pos)))
-                    clip_start = max(pos_r, pos)
+        for silence_start, i in zip(run_starts, run_ends):
+            if i == total_frames:
+                # Deal with trailing silence.
+                sil_tag = self._slice_trailing_silence(rms_list[silence_start:], silence_start, total_frames)
             else:
-                pos_l = rms_list[silence_start: silence_start + self.max_sil_kept + 1].argmin() + silence_start
-                pos_r = rms_list[i - self.max_sil_kept: i + 1].argmin() + i - self.max_sil_kept
-                if silence_start == 0:
-                    sil_tags.append((0, pos_r))
-                else:
-                    sil_tags.append((pos_l, pos_r))
-                clip_start = pos_r
-            silence_start = None
-        # Deal with trailing silence.
-        total_frames = rms_list.shape[0]
-        if silence_start is not None and total_frames - silence_start >= self.min_interval:
-            silence_end = min(total_frames, silence_start + self.max_sil_kept)
-            pos = rms_list[silence_start: silence_end + 1].argmin() + silence_start
-            sil_tags.append((pos, total_frames + 1))
+                sil_tag, clip_start = self._slice_silence(
+                    rms_list[silence_start: i + 1], silence_start, i, clip_start
+                )
+            if sil_tag is not None:
+                sil_tags.append(sil_tag)
         # Apply and return slices.
         if len(sil_tags) == 0:
             return [{'offset': 0, 'waveform': waveform}]
@@ -143,3 +178,177 @@ class Slicer:
             if sil_tags[-1][1] < total_frames:
                 chunks.append(self._apply_slice(waveform, sil_tags[-1][1], total_frames))
             return chunks
+
+
+class StreamingSlicer(Slicer):
+    """
+        Incremental version of Slicer producing the same chunks.
+
+        Audio blocks are passed to *feed*, which returns chunks as soon as the silence after them is
+        decided. Call *finish* at the end of the stream to get the remaining chunks. Only the audio
+        of the current chunk is kept; silences longer than twice max_sil_kept close the chunk before
+        they end, and their middle part is dropped.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset()
+
+    # noinspection PyAttributeOutsideInit
+    def reset(self):
+        self._frame_tail = np.zeros(self.win_size // 2, dtype=np.float32)  # signal padded on the left
+        self._n_samples = 0
+        self._n_frames = 0
+        self._audio_blocks = []
+        self._audio_start = 0  # position of the first audio block in samples
+        self._silence_start = None
+        self._silence_rms = []
+        self._clip_start = 0
+        self._chunk_begin = 0  # the end of the last removed silence in frames
+        self._n_tags = 0
+        self._closed_at = None  # the end of the current chunk if it has been emitted early
+        self._pending = []
+
+    @property
+    def _released(self):
+        # Slicer.slice() returns the whole waveform if it is not longer than min_length.
+        return (self._n_samples + self.hop_size - 1) // self.hop_size > self.min_length
+
+    def _get_audio(self, begin, end):
+        # Audio in [begin, end) in samples
+        pieces = []
+        start = self._audio_start
+        for block in self._audio_blocks:
+            stop = start + block.shape[-1]
+            if stop > begin and start < end:
+                pieces.append(block[..., max(begin - start, 0): min(end, stop) - start])
+            start = stop
+        if len(pieces) == 0:
+            return self._audio_blocks[0][..., :0]
+        return np.concatenate(pieces, axis=-1)
+
+    def _drop_audio(self, begin):
+        # Drop audio before the given sample unless it might still be returned as a whole.
+        if not self._released:
+            return
+        while len(self._audio_blocks) > 0 and self._audio_start + self._audio_blocks[0].shape[-1] <= begin:
+            self._audio_start += self._audio_blocks.pop(0).shape[-1]
+
+    def _emit(self, begin, end):
+        self._pending.append({
+            'offset': begin * self.hop_size / self.sr,
+            'waveform': self._get_audio(begin * self.hop_size, min(self._n_samples, end * self.hop_size))
+        })
+
+    def _add_tag(self, sil_tag):
+        if self._closed_at is not None:
+            assert sil_tag[0] == self._closed_at
+        elif self._n_tags > 0 or sil_tag[0] > 0:
+            self._emit(self._chunk_begin, sil_tag[0])
+        self._chunk_begin = sil_tag[1]
+        self._n_tags += 1
+        self._closed_at = None
+        self._drop_audio(self._chunk_begin * self.hop_size)
+
+    def _process_frames(self, rms):
+        f0 = self._n_frames
+        self._n_frames += rms.shape[0]
+        silent = rms < self.threshold
+        edges = np.diff(silent.astype(np.int8), prepend=np.int8(self._silence_start is not None))
+        pos = 0
+        for k in np.flatnonzero(edges):
+            if silent[k]:
+                self._silence_start = f0 + k
+                self._silence_rms = []
+                pos = k
+            else:
+                self._silence_rms.append(rms[pos: k + 1])
+                sil_tag, self._clip_start = self._slice_silence(
+                    np.concatenate(self._silence_rms), self._silence_start, f0 + k, self._clip_start
+                )
+                if sil_tag is not None:
+                    self._add_tag(sil_tag)
+                self._silence_start = None
+                self._silence_rms = []
+        if self._silence_start is not None:
+            self._silence_rms.append(rms[pos:])
+
+    def _close_long_silence(self):
+        # A silence longer than max_sil_kept * 2 that needs slicing always starts to be removed at
+        # the same position, so the current chunk can be emitted before the silence ends.
+        silence_start = self._silence_start
+        if silence_start is None or silence_start == 0:
+            return
+        if self._closed_at is None:
+            n = self._n_frames - silence_start
+            if n <= self.max_sil_kept * 2 or n < self.min_interval \
+                    or self._n_frames - self._clip_start < self.min_length:
+                return
+            self._silence_rms = [np.concatenate(self._silence_rms)]
+            self._closed_at = self._silence_rms[0][: self.max_sil_kept + 1].argmin() + silence_start
+            self._emit(self._chunk_begin, self._closed_at)
+        # The next chunk begins within the last max_sil_kept frames of the silence.
+        self._drop_audio((self._n_frames - self.max_sil_kept) * self.hop_size)
+
+    def _take_pending(self) -> List[Dict[str, np.ndarray]]:
+        if not self._released:
+            return []
+        chunks = self._pending
+        self._pending = []
+        return chunks
+
+    def feed(self, block) -> List[Dict[str, np.ndarray]]:
+        """
+        :param block: audio block, [n_samples] or [n_channels, n_samples]
+        :return: chunks that are complete so far
+        """
+        if len(block.shape) > 1:
+            samples = block.mean(axis=0)
+        else:
+            samples = block
+        self._audio_blocks.append(block)
+        self._n_samples += block.shape[-1]
+        self._frame_tail = np.concatenate((self._frame_tail, samples))
+        n_frames = (self._frame_tail.shape[0] - self.win_size) // self.hop_size + 1
+        if n_frames > 0:
+            rms = np.sqrt(_frame_power(
+                self._frame_tail[: (n_frames - 1) * self.hop_size + self.win_size], self.win_size, self.hop_size
+            )).squeeze(0)
+            self._frame_tail = self._frame_tail[n_frames * self.hop_size:]
+            self._process_frames(rms)
+            self._close_long_silence()
+        return self._take_pending()
+
+    def finish(self) -> List[Dict[str, np.ndarray]]:
+        """
+        End the stream and return the remaining chunks.
+        """
+        if self._n_samples == 0:
+            self.reset()
+            return []
+        if not self._released:
+            chunks = [{'offset': 0, 'waveform': self._get_audio(0, self._n_samples)}]
+            self.reset()
+            return chunks
+        self._frame_tail = np.concatenate((
+            self._frame_tail, np.zeros(self.win_size // 2, dtype=self._frame_tail.dtype)
+        ))
+        n_frames = (self._frame_tail.shape[0] - self.win_size) // self.hop_size + 1
+        if n_frames > 0:
+            self._process_frames(np.sqrt(_frame_power(
+                self._frame_tail[: (n_frames - 1) * self.hop_size + self.win_size], self.win_size, self.hop_size
+            )).squeeze(0))
+        total_frames = self._n_frames
+        if self._silence_start is not None:
+            sil_tag = self._slice_trailing_silence(
+                np.concatenate(self._silence_rms), self._silence_start, total_frames
+            )
+            if sil_tag is not None:
+                self._add_tag(sil_tag)
+        if self._n_tags == 0:
+            self._pending.append({'offset': 0, 'waveform': self._get_audio(0, self._n_samples)})
+        elif self._chunk_begin < total_frames:
+            self._emit(self._chunk_begin, total_frames)
+        chunks = self._take_pending()
+        self.reset()
+        return chunks
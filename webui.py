@@ -1,8 +1,12 @@
 import importlib
+import json
 import os
 import pathlib
 import time
-from typing import Dict, Tuple
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import TYPE_CHECKING, Dict, Tuple, Union
 
 import click
 import gradio as gr
@@ -10,29 +14,62 @@ import librosa
 import yaml
 
 import inference
-from inference import BaseInference
-from utils.infer_utils import build_midi_file
+from inference import ONNXInference
+from utils.midi_utils import build_midi_file
 from utils.slicer2 import Slicer
 
+if TYPE_CHECKING:
+    # The PyTorch backend is only imported when it is used.
+    from inference import BaseInference
+
 _work_dir: pathlib.Path = None
-_infer_instances: Dict[str, Tuple[BaseInference, dict]] = {}  # dict mapping model_rel_path to (infer_ins, config)
+_backend: str = 'torch'
+_server_url: str = None
+_infer_instances: Dict[str, Tuple[Union['BaseInference', ONNXInference], dict]] = {}  # dict mapping model_rel_path to (infer_ins, config)
+
+
+def infer_remote(model_rel_path, input_audio_path, tempo_value):
+    """
+    Send the audio to the inference server (serve.py), which batches it together with other requests.
+    """
+    input_audio_path = pathlib.Path(input_audio_path)
+    query = urllib.parse.urlencode({'model': model_rel_path, 'tempo': tempo_value})
+    request = urllib.request.Request(
+        f'{_server_url}/infer?{query}', data=input_audio_path.read_bytes(), method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            midi_bytes = response.read()
+            infer_time = float(response.headers['X-Infer-Time'])
+            rtf = float(response.headers['X-RTF'])
+    except urllib.error.HTTPError as e:
+        return None, f"Error: {e.read().decode('utf8', errors='replace')}"
+    output_midi_path = input_audio_path.with_suffix('.mid')
+    output_midi_path.write_bytes(midi_bytes)
+    os.remove(input_audio_path)
+    return output_midi_path, f"Cost {round(infer_time, 2)} s, RTF: {round(rtf, 3)}"
 
 
 def infer(model_rel_path, input_audio_path, tempo_value):
     if not model_rel_path or not input_audio_path or tempo_value is None:
         return None, "Error: required inputs not specified."
+    if _server_url is not None:
+        return infer_remote(model_rel_path, input_audio_path, tempo_value)
     if model_rel_path not in _infer_instances:
         model_path = _work_dir / model_rel_path
         with open(model_path.with_name('config.yaml'), 'r', encoding='utf8') as f:
             config = yaml.safe_load(f)
-        infer_cls = inference.task_inference_mapping[config['task_cls']]
-
-        pkg = ".".join(infer_cls.split(".")[:-1])
-        cls_name = infer_cls.split(".")[-1]
-        infer_cls = getattr(importlib.import_module(pkg), cls_name)
-        assert issubclass(infer_cls, inference.BaseInference), \
-            f'Binarizer class {infer_cls} is not a subclass of {inference.BaseInference}.'
-        infer_ins = infer_cls(config=config, model_path=model_path)
+        if _backend == 'onnx':
+            infer_ins = inference.ONNXInference(config=config, model_path=model_path)
+        else:
+            infer_cls = inference.task_inference_mapping[config['task_cls']]
+
+            pkg = ".".join(infer_cls.split(".")[:-1])
+            cls_name = infer_cls.split(".")[-1]
+            infer_cls = getattr(importlib.import_module(pkg), cls_name)
+            assert issubclass(infer_cls, inference.BaseInference), \
+                f'Binarizer class {infer_cls} is not a subclass of {inference.BaseInference}.'
+            infer_ins = infer_cls(config=config, model_path=model_path)
         print(f"Initialized: {infer_ins}")
         _infer_instances[model_rel_path] = (infer_ins, config)
     else:
@@ -69,20 +106,35 @@ def infer(model_rel_path, input_audio_path, tempo_value):
 @click.option('--port', type=int, default=7860, help='Server port')
 @click.option('--addr', type=str, required=False, help='Server address')
 @click.option('--work_dir', type=str, required=False, help='Directory to read the experiments')
-def webui(port, work_dir, addr):
-    if work_dir is None:
-        work_dir = pathlib.Path(__file__).with_name('experiments')
+@click.option(
+    '--backend', type=click.Choice(['torch', 'onnx']), default='torch',
+    help='Inference backend; onnx lists exported models (*.onnx) and runs them with ONNX Runtime'
+)
+@click.option(
+    '--server', type=str, required=False, metavar='URL',
+    help='URL of an inference server (serve.py) to run the requests on, instead of loading the models here'
+)
+def webui(port, work_dir, addr, backend, server):
+    global _work_dir, _backend, _server_url
+    if server is not None:
+        _server_url = server.rstrip('/')
+        with urllib.request.urlopen(f'{_server_url}/models') as response:
+            choices = json.loads(response.read())
     else:
-        work_dir = pathlib.Path(work_dir)
-    assert work_dir.is_dir(), f'{work_dir} is not a directory.'
-    global _work_dir
-    _work_dir = work_dir
-    choices = [
-        p.relative_to(work_dir).as_posix()
-        for p in work_dir.rglob('*.ckpt')
-    ]
+        if work_dir is None:
+            work_dir = pathlib.Path(__file__).with_name('experiments')
+        else:
+            work_dir = pathlib.Path(work_dir)
+        assert work_dir.is_dir(), f'{work_dir} is not a directory.'
+        _work_dir = work_dir
+        _backend = backend
+        model_suffix = '.onnx' if backend == 'onnx' else '.ckpt'
+        choices = [
+            p.relative_to(work_dir).as_posix()
+            for p in work_dir.rglob(f'*{model_suffix}')
+        ]
     if len(choices) == 0:
-        raise FileNotFoundError(f'No checkpoints found in {work_dir}.')
+        raise FileNotFoundError(f'No models found in {work_dir if server is None else server}.')
     iface = gr.Interface(
         title="SOME: Singing-Oriented MIDI Extractor",
         description="Submit an audio file and download the extracted MIDI file.",